@@ -0,0 +1,144 @@
+"""
+Admission control for requests forwarded to remote servers.
+"""
+import collections
+import time
+
+from twisted.internet import defer
+
+
+class Overloaded(Exception):
+    """
+    A request was rejected, because too many requests are waiting.
+    """
+
+
+
+class _Host(object):
+    """
+    The requests to a remote server that are in flight, and waiting.
+    """
+    def __init__(self):
+        self.running = 0
+        self.waiting = collections.deque()
+
+
+
+class AdmissionControl(object):
+    """
+    Limits how many requests are forwarded at once, to each remote server
+    (``maxPerHost``) and in total (``maxTotal``). Either limit can be
+    ``None``, for no limit.
+
+    Requests over the limits wait in a queue per remote server. When a
+    request finishes, the queues take turns, so that a busy remote server
+    can't hold up requests to the others. Requests that would make a queue
+    longer than ``maxQueued`` are rejected right away.
+
+    A request counts as in flight until its response to the client is
+    finished (including mangling).
+    """
+    def __init__(self, maxPerHost=None, maxTotal=None, maxQueued=100):
+        self.maxPerHost = maxPerHost
+        self.maxTotal = maxTotal
+        self.maxQueued = maxQueued
+        self.running = 0
+        self.hosts = {}
+        self._turns = collections.deque()
+
+
+    def _hasRoom(self, host):
+        if self.maxTotal is not None and self.running >= self.maxTotal:
+            return False
+        return self.maxPerHost is None or host.running < self.maxPerHost
+
+
+    def admit(self, key, request):
+        """
+        Admits a request to the remote server identified by ``key`` (such as
+        a host and port).
+
+        Returns a deferred that fires when the request may be forwarded, or
+        fails with ``Overloaded`` if it was rejected.
+        """
+        host = self.hosts.get(key)
+        if host is None:
+            host = self.hosts[key] = _Host()
+
+        if not host.waiting and self._hasRoom(host):
+            self._start(key, host, request)
+            return defer.succeed(None)
+        elif len(host.waiting) >= self.maxQueued:
+            request.metrics.increment("shed")
+            self._forget(key, host)
+            return defer.fail(Overloaded(key))
+
+        d = defer.Deferred()
+        entry = request, d, time.time()
+        host.waiting.append(entry)
+        if len(host.waiting) == 1:
+            self._turns.append(key)
+        request.metrics.increment("admissionQueued")
+
+        def abandoned(failure):
+            if entry in host.waiting:
+                host.waiting.remove(entry)
+                request.metrics.increment("admissionQueued", -1)
+                if not host.waiting:
+                    self._turns.remove(key)
+                self._forget(key, host)
+
+        request.notifyFinish().addErrback(abandoned)
+        return d
+
+
+    def _start(self, key, host, request):
+        host.running += 1
+        self.running += 1
+        request.notifyFinish().addBoth(lambda _: self._release(key, host))
+
+
+    def _release(self, key, host):
+        host.running -= 1
+        self.running -= 1
+        self._dispatch()
+        self._forget(key, host)
+
+
+    def _forget(self, key, host):
+        """
+        Forgets about a remote server that has no requests left.
+        """
+        if not host.running and not host.waiting:
+            if self.hosts.get(key) is host:
+                del self.hosts[key]
+
+
+    def _dispatch(self):
+        """
+        Starts waiting requests, taking turns between the remote servers.
+        """
+        skipped = 0
+        while self._turns and skipped < len(self._turns):
+            if self.maxTotal is not None and self.running >= self.maxTotal:
+                return
+
+            key = self._turns.popleft()
+            host = self.hosts.get(key)
+            if host is None or not host.waiting:
+                continue
+
+            if not self._hasRoom(host):
+                self._turns.append(key)
+                skipped += 1
+                continue
+
+            request, d, queued = host.waiting.popleft()
+            if host.waiting:
+                self._turns.append(key)
+            skipped = 0
+
+            request.metrics.increment("admissionQueued", -1)
+            request.metrics.recordSince("admission", queued)
+            self._start(key, host, request)
+            d.callback(None)
@@ -0,0 +1,349 @@
+"""
+Throughput and latency benchmarks for the proxy.
+
+Each benchmark run starts a target web site and a proxy, each in a process
+of its own, and then hammers the proxy with requests for the target from a
+number of concurrent clients. The throughput and peak memory use measured
+are those of the proxy alone. Results are written as JSON, one line per
+run, so that runs can be compared::
+
+    python -m minitrue.bench --sizes 1024,1048576 --concurrency 1,10
+
+The proxy is set up in one of several configurations: plain passthrough,
+with a misdirector, with a request mangler, and with a response mangler.
+"""
+import json
+import os
+import resource as _resource
+import sys
+import time
+
+from twisted.internet import defer, error, protocol, reactor
+from twisted.python import usage
+from twisted.web import client, resource, server
+
+from minitrue import misdirection, proxy
+from minitrue.utils import StringIO
+
+
+class _Bytes(resource.Resource):
+    """
+    Serves bodies of the requested size.
+    """
+    def getChild(self, name, request):
+        return _Body(int(name))
+
+
+
+class _Body(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, size):
+        resource.Resource.__init__(self)
+        self.body = "x" * size
+
+
+    def render_GET(self, request):
+        return self.body
+
+
+
+def buildTarget():
+    root = resource.Resource()
+    root.putChild("bytes", _Bytes())
+    return server.Site(root)
+
+
+@misdirection.misdirector
+def misdirector(url):
+    """
+    Misdirects requests for lies to the actual content.
+    """
+    if "/lies/" in url:
+        return url.replace("/lies/", "/bytes/")
+
+
+def requestMangler(request):
+    request.requestHeaders.setRawHeaders("Accept-Language", ["newspeak"])
+
+
+def responseMangler(response):
+    content = response.content.read()
+    response.content = StringIO(content.replace("x", "y"))
+
+
+configurations = {
+    "passthrough": ({}, "/bytes/%d"),
+    "misdirector": ({"requestMangler": misdirector}, "/lies/%d"),
+    "requestMangler": ({"requestMangler": requestMangler}, "/bytes/%d"),
+    "responseMangler": ({"responseMangler": responseMangler}, "/bytes/%d"),
+}
+
+
+def serve(configuration):
+    """
+    Serves a proxy in the given configuration.
+    """
+    kwargs, _ = configurations[configuration]
+    factory = proxy.MinitrueFactory(**kwargs)
+    _serve(factory)
+
+
+def serveTarget():
+    """
+    Serves the target site.
+    """
+    _serve(buildTarget())
+
+
+def _serve(factory):
+    """
+    Serves the factory on a local port.
+
+    The port is written to stdout as JSON. When stdin is closed, the peak
+    resident set size (in kilobytes) is written to stdout, and the process
+    exits.
+    """
+    port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+    sys.stdout.write(json.dumps({"port": port.getHost().port}) + "\n")
+    sys.stdout.flush()
+
+    def waitForEOF():
+        sys.stdin.read()
+        reactor.callFromThread(reactor.stop)
+
+    reactor.callInThread(waitForEOF)
+    reactor.run()
+
+    peak = _resource.getrusage(_resource.RUSAGE_SELF).ru_maxrss
+    sys.stdout.write(json.dumps({"peakRSS": peak}) + "\n")
+    sys.stdout.flush()
+
+
+
+class _ServerProcess(protocol.ProcessProtocol):
+    """
+    Talks to a process that serves a target site or a proxy.
+    """
+    def __init__(self):
+        self.buffer = ""
+        self.lines = []
+        self.waiting = []
+        self.ended = defer.Deferred()
+
+
+    def outReceived(self, data):
+        self.buffer += data
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            self.lines.append(json.loads(line))
+            if self.waiting:
+                self.waiting.pop(0).callback(self.lines.pop(0))
+
+
+    def errReceived(self, data):
+        sys.stderr.write(data)
+
+
+    def readLine(self):
+        if self.lines:
+            return defer.succeed(self.lines.pop(0))
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(fraction * len(ordered)))
+    return ordered[index]
+
+
+def fetch(url, proxyPort):
+    """
+    Fetches a URL through the proxy.
+    """
+    factory = client.HTTPClientFactory(url)
+    factory.setURL = lambda url: None
+    factory.path = url
+    reactor.connectTCP("127.0.0.1", proxyPort, factory)
+    return factory.deferred
+
+
+@defer.inlineCallbacks
+def load(url, proxyPort, concurrency, requests):
+    """
+    Makes the given number of requests through the proxy, with the given
+    number of concurrent clients.
+
+    Returns the latencies of the requests, and the number of failures.
+    """
+    latencies = []
+    failures = [0]
+    remaining = [requests]
+
+    @defer.inlineCallbacks
+    def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            started = time.time()
+            try:
+                yield fetch(url, proxyPort)
+            except Exception:
+                failures[0] += 1
+            else:
+                latencies.append(time.time() - started)
+
+    yield defer.gatherResults([worker() for _ in range(concurrency)])
+    defer.returnValue((latencies, failures[0]))
+
+
+@defer.inlineCallbacks
+def _spawn(*args):
+    """
+    Spawns a process that serves a target site or a proxy.
+
+    Returns the process protocol and the port it serves on.
+    """
+    server = _ServerProcess()
+    argv = [sys.executable, "-m", "minitrue.bench"] + list(args)
+    path = os.pathsep.join(os.path.abspath(entry) for entry in sys.path)
+    env = dict(os.environ, PYTHONPATH=path)
+    reactor.spawnProcess(server, sys.executable, argv, env=env)
+
+    started = yield server.readLine()
+    defer.returnValue((server, started["port"]))
+
+
+@defer.inlineCallbacks
+def _stop(server):
+    """
+    Stops a process spawned by ``_spawn``.
+
+    Returns its peak resident set size.
+    """
+    server.transport.closeStdin()
+    rss = yield server.readLine()
+    yield server.ended
+    defer.returnValue(rss["peakRSS"])
+
+
+@defer.inlineCallbacks
+def run(configuration, size, concurrency, requests):
+    """
+    Benchmarks the proxy in the given configuration.
+    """
+    target, targetPort = yield _spawn("--serve-target")
+    server, proxyPort = yield _spawn("--serve", configuration)
+
+    _, path = configurations[configuration]
+    url = "http://127.0.0.1:%d%s" % (targetPort, path % (size,))
+
+    started = time.time()
+    latencies, failures = yield load(url, proxyPort, concurrency, requests)
+    elapsed = time.time() - started
+
+    rss = yield _stop(server)
+    yield _stop(target)
+
+    latencies.sort()
+    defer.returnValue({
+        "configuration": configuration,
+        "size": size,
+        "concurrency": concurrency,
+        "requests": requests,
+        "failures": failures,
+        "requestsPerSecond": len(latencies) / elapsed,
+        "p50": _percentile(latencies, 0.5),
+        "p99": _percentile(latencies, 0.99),
+        "peakRSS": rss,
+    })
+
+
+
+def _integers(value):
+    return [int(part) for part in value.split(",")]
+
+
+
+class Options(usage.Options):
+    synopsis = "[options]"
+
+    optParameters = [
+        ["configurations", "c", ",".join(sorted(configurations)),
+         "Comma separated proxy configurations to benchmark."],
+        ["sizes", "s", [1024, 65536, 1048576],
+         "Comma separated response body sizes, in bytes.", _integers],
+        ["concurrency", "n", [1, 10, 50],
+         "Comma separated numbers of concurrent clients.", _integers],
+        ["requests", "r", 1000, "The number of requests per run.", int],
+        ["output", "o", None,
+         "The file to write results to (default stdout)."],
+        ["serve", None, None, "Serve a proxy (used internally)."],
+    ]
+
+    optFlags = [
+        ["serve-target", None, "Serve the target site (used internally)."],
+    ]
+
+    def postOptions(self):
+        self["configurations"] = self["configurations"].split(",")
+        for configuration in self["configurations"]:
+            if configuration not in configurations:
+                raise usage.UsageError("Unknown configuration: %s"
+                                       % (configuration,))
+
+
+
+@defer.inlineCallbacks
+def runAll(options, output):
+    try:
+        for configuration in options["configurations"]:
+            for size in options["sizes"]:
+                for concurrency in options["concurrency"]:
+                    result = yield run(configuration, size, concurrency,
+                                       options["requests"])
+                    output.write(json.dumps(result, sort_keys=True) + "\n")
+                    output.flush()
+    finally:
+        try:
+            reactor.stop()
+        except error.ReactorNotRunning:
+            pass
+
+
+def main(argv=None):
+    """
+    Runs the benchmarks from the command line.
+    """
+    options = Options()
+    try:
+        options.parseOptions(sys.argv[1:] if argv is None else argv)
+    except usage.UsageError as e:
+        raise SystemExit("%s\n%s" % (options, e))
+
+    if options["serve"] is not None:
+        serve(options["serve"])
+        return
+    elif options["serve-target"]:
+        serveTarget()
+        return
+
+    if options["output"] is None:
+        output = sys.stdout
+    else:
+        output = open(options["output"], "a")
+
+    reactor.callWhenRunning(runAll, options, output)
+    reactor.run()
+
+
+
+if __name__ == "__main__":
+    main()
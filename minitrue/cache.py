@@ -0,0 +1,211 @@
+"""
+Caching of (mangled) responses.
+"""
+from twisted.internet import reactor
+from twisted.web import http
+
+from minitrue.proxy import _hopByHopHeaders
+from minitrue.utils import LRUCache
+
+
+_cacheableCodes = frozenset([200, 203, 300, 301, 404, 410])
+_unstoredHeaders = _hopByHopHeaders | frozenset(["content-length", "age"])
+
+
+def _directives(headers, name="cache-control"):
+    """
+    Parses the directives in a ``Cache-Control`` (or similar) header.
+    """
+    directives = {}
+    for value in headers.getRawHeaders(name, []):
+        for directive in value.split(","):
+            key, _, argument = directive.strip().partition("=")
+            directives[key.lower()] = argument.strip('"')
+    return directives
+
+
+def _lastHeader(headers, name):
+    values = headers.getRawHeaders(name)
+    if values:
+        return values[-1]
+
+
+
+class _CachedResponse(object):
+    """
+    A response that was sent to a client, as stored in the cache.
+    """
+    __slots__ = ["code", "message", "headers", "body", "stored", "expires"]
+
+    def __init__(self, code, message, headers, body, stored, expires):
+        self.code = code
+        self.message = message
+        self.headers = headers
+        self.body = body
+        self.stored = stored
+        self.expires = expires
+
+
+    def __len__(self):
+        return len(self.body) + sum(len(k) + len(v) for k, v in self.headers)
+
+
+    def replay(self, request, now):
+        """
+        Sends this response to the client.
+        """
+        request.setResponseCode(self.code, self.message)
+        for name, value in self.headers:
+            request.responseHeaders.addRawHeader(name, value)
+
+        request.setHeader("content-length", str(len(self.body)))
+        request.setHeader("age", str(int(now - self.stored)))
+        request.write(self.body)
+        request.finish()
+
+
+
+class ResponseCache(object):
+    """
+    An HTTP cache for the responses sent by the proxy, after mangling.
+
+    Responses to ``GET`` requests are cached according to their
+    ``Cache-Control``, ``Expires`` and ``Vary`` headers. Only responses that
+    explicitly say how long they are fresh for are cached. Responses that
+    set cookies, or that answer requests with credentials, aren't cached.
+
+    The least recently used responses are evicted when the total size of the
+    cached responses exceeds ``maxBytes``. Responses larger than
+    ``maxEntryBytes`` aren't cached at all.
+    """
+    def __init__(self, maxBytes=64 * 1024 * 1024, maxEntryBytes=1024 * 1024,
+                 reactor=reactor):
+        self.maxEntryBytes = maxEntryBytes
+        self.reactor = reactor
+
+        self.responses = LRUCache(maxBytes, sizeOf=len)
+        self._vary = LRUCache(maxBytes // 1024)
+
+
+    def _key(self, request, varying):
+        headers = request.requestHeaders
+        values = tuple(tuple(headers.getRawHeaders(n, ())) for n in varying)
+        return request.method, request.uri, values
+
+
+    def _isCacheableRequest(self, request):
+        if request.method != "GET":
+            return False
+        elif request.requestHeaders.hasHeader("authorization"):
+            return False
+        return "no-store" not in _directives(request.requestHeaders)
+
+
+    def lookup(self, request):
+        """
+        Looks up a fresh response for the request in the cache, and replays
+        it if there is one.
+
+        Returns ``True`` if the response was replayed from the cache.
+        Otherwise, returns ``False`` and prepares to store the response that
+        will be sent instead.
+        """
+        if not self._isCacheableRequest(request):
+            return False
+
+        request.recorded = []
+
+        if "no-cache" in _directives(request.requestHeaders):
+            return False
+
+        varying = self._vary.get((request.method, request.uri))
+        if varying is None:
+            self.responses.misses += 1
+            return False
+
+        key = self._key(request, varying)
+        response = self.responses.get(key)
+        if response is None:
+            return False
+
+        now = self.reactor.seconds()
+        if response.expires <= now:
+            self.responses.invalidate(key)
+            self.responses.hits -= 1
+            self.responses.misses += 1
+            return False
+
+        request.recorded = None
+        response.replay(request, now)
+        return True
+
+
+    def _freshness(self, headers):
+        """
+        Determines how long a response is fresh for, in seconds.
+        """
+        directives = _directives(headers)
+        if set(directives) & set(["no-store", "no-cache", "private"]):
+            return 0
+
+        for directive in ["s-maxage", "max-age"]:
+            if directive in directives:
+                try:
+                    return int(directives[directive])
+                except ValueError:
+                    return 0
+
+        expires = _lastHeader(headers, "expires")
+        if expires is None:
+            return 0
+
+        try:
+            expires = http.stringToDatetime(expires)
+            date = _lastHeader(headers, "date")
+            if date is None:
+                date = self.reactor.seconds()
+            else:
+                date = http.stringToDatetime(date)
+        except ValueError:
+            return 0
+
+        return expires - date
+
+
+    def store(self, request, body):
+        """
+        Stores the response that was sent to the client, if it is cacheable.
+
+        Hop-by-hop headers (such as ``Connection``) are about the connection
+        to this client, so they aren't stored.
+        """
+        headers = request.responseHeaders
+        if request.code not in _cacheableCodes:
+            return
+        elif headers.hasHeader("set-cookie") or request.cookies:
+            return
+
+        varying = []
+        for value in headers.getRawHeaders("vary", []):
+            varying.extend(n.strip().lower() for n in value.split(","))
+        if "*" in varying:
+            return
+
+        freshness = self._freshness(headers)
+        if freshness <= 0:
+            return
+
+        stored = []
+        for name, values in headers.getAllRawHeaders():
+            if name.lower() not in _unstoredHeaders:
+                stored.extend((name, value) for value in values)
+
+        now = self.reactor.seconds()
+        response = _CachedResponse(request.code, request.code_message, stored,
+                                   body, now, now + freshness)
+        if len(response) > self.maxEntryBytes:
+            return
+
+        varying = tuple(sorted(set(varying)))
+        self._vary[request.method, request.uri] = varying
+        self.responses[self._key(request, varying)] = response
@@ -0,0 +1,182 @@
+"""
+Collapsed forwarding of concurrent identical requests.
+
+While a request is being forwarded, identical requests wait for it instead
+of being forwarded themselves. When its (mangled) response is sent, it is
+sent to the waiting requests as well, so the remote server is only asked
+once, and the response is only mangled once.
+"""
+_safeMethods = frozenset(["GET", "HEAD"])
+_unsharedHeaders = frozenset(["connection", "keep-alive", "set-cookie"])
+
+
+class _Flight(object):
+    """
+    A request being forwarded, and the identical requests waiting for it.
+    """
+    def __init__(self, collapser, key, leader):
+        self.collapser = collapser
+        self.key = key
+        self.leader = leader
+        self.followers = []
+        self.started = False
+
+
+    def follow(self, request):
+        self.followers.append(request)
+        d = request.notifyFinish()
+        d.addErrback(lambda _: self._unfollow(request))
+
+
+    def _unfollow(self, request):
+        if request in self.followers:
+            self.followers.remove(request)
+
+
+    def _land(self):
+        """
+        Stops identical requests from joining this flight.
+        """
+        if self.collapser.inFlight.get(self.key) is self:
+            del self.collapser.inFlight[self.key]
+
+
+    def _varying(self):
+        """
+        Gets the names of the request headers the response varies on, or
+        ``None`` if it can't be shared at all.
+        """
+        headers = self.leader.responseHeaders
+        if headers.hasHeader("set-cookie"):
+            return None
+
+        varying = []
+        for value in headers.getRawHeaders("vary", []):
+            varying.extend(n.strip().lower() for n in value.split(","))
+        if "*" in varying:
+            return None
+        return varying
+
+
+    def start(self):
+        """
+        Starts sending the response of the leader to the followers.
+
+        Followers that sent different values for the headers the response
+        varies on are forwarded on their own instead.
+        """
+        self._land()
+        self.started = True
+
+        leader = self.leader
+        varying = self._varying()
+        for follower in self.followers[:]:
+            if varying is None or not self._matches(follower, varying):
+                self.followers.remove(follower)
+                follower._fetch()
+                continue
+
+            follower.setResponseCode(leader.code, leader.code_message)
+            for name, values in leader.responseHeaders.getAllRawHeaders():
+                if name.lower() not in _unsharedHeaders:
+                    follower.responseHeaders.setRawHeaders(name, values)
+
+        leader.metrics.increment("collapsed", len(self.followers))
+
+
+    def _matches(self, follower, varying):
+        leaderHeaders = self.leader.requestHeaders
+        followerHeaders = follower.requestHeaders
+        for name in varying:
+            if (leaderHeaders.getRawHeaders(name)
+                != followerHeaders.getRawHeaders(name)):
+                return False
+        return True
+
+
+    def write(self, data):
+        for follower in self.followers:
+            follower.write(data)
+
+
+    def finish(self):
+        if not self.started:
+            self.start()
+
+        followers, self.followers = self.followers, []
+        for follower in followers:
+            follower.finish()
+
+
+    def abandon(self):
+        """
+        Called when the connection to the leader's client is lost before its
+        response was finished.
+
+        Followers that were still waiting are forwarded on their own, and
+        the connections of the others are closed, because their responses
+        can't be completed.
+        """
+        self._land()
+        followers, self.followers = self.followers, []
+        for follower in followers:
+            if not self.started:
+                follower._fetch()
+            elif follower.channel is not None:
+                follower.channel.transport.loseConnection()
+
+
+
+class Collapser(object):
+    """
+    Collapses concurrent identical requests into one.
+
+    Requests are identical if they have the same method and URL. Only
+    ``GET`` and ``HEAD`` requests without credentials are collapsed, and
+    only if ``predicate`` (if given) returns true for them. It is called
+    with the request, and can be used to only collapse requests for some
+    hosts or URLs.
+
+    Waiting requests only get the response if they sent the same values
+    for the headers it varies on, and if it doesn't set cookies. Otherwise,
+    they are forwarded on their own once the response starts.
+    """
+    def __init__(self, predicate=None):
+        self.predicate = predicate
+        self.inFlight = {}
+
+
+    def _isCollapsible(self, request):
+        if request.method not in _safeMethods:
+            return False
+        elif request.bodyStream is not None:
+            return False
+        elif request.requestHeaders.hasHeader("authorization"):
+            return False
+        elif self.predicate is not None:
+            return self.predicate(request)
+        return True
+
+
+    def join(self, request):
+        """
+        Makes the request wait for an identical request that is in flight,
+        or makes it the leader of a new flight.
+
+        Returns ``True`` if the request is waiting, and ``False`` if it
+        should be forwarded.
+        """
+        if not self._isCollapsible(request):
+            return False
+
+        key = request.method, request.uri
+        flight = self.inFlight.get(key)
+        if flight is not None:
+            flight.follow(request)
+            return True
+
+        flight = self.inFlight[key] = _Flight(self, key, request)
+        request.flight = flight
+        d = request.notifyFinish()
+        d.addErrback(lambda _: flight.abandon())
+        return False
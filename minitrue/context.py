@@ -0,0 +1,84 @@
+"""
+Context of a request, shared by its manglers and the proxy.
+"""
+import urlparse
+
+
+_lastSplit = None, None
+
+
+def splitURL(url):
+    """
+    Splits a URL, reusing the result if the same URL was split last.
+
+    Misdirectors that are stacked are all passed the same URL, so it is
+    only parsed once. The URL is compared by identity, so the check is
+    cheap.
+    """
+    global _lastSplit
+    lastURL, split = _lastSplit
+    if lastURL is not url:
+        split = urlparse.urlsplit(url)
+        _lastSplit = url, split
+    return split
+
+
+
+class RequestContext(object):
+    """
+    The context of a request, as seen by manglers.
+
+    The URL of the request is split when it is first needed, and the split
+    is kept until a mangler rewrites ``request.uri``. Headers are views of
+    the request's headers, not copies.
+    """
+    __slots__ = ["request", "_uri", "_split"]
+
+    def __init__(self, request):
+        self.request = request
+        self._uri = None
+        self._split = None
+
+
+    @property
+    def split(self):
+        """
+        The split URL of the request.
+        """
+        uri = self.request.uri
+        if uri is not self._uri:
+            self._split = splitURL(uri)
+            self._uri = uri
+        return self._split
+
+
+    @property
+    def scheme(self):
+        return self.split.scheme
+
+
+    @property
+    def hostname(self):
+        return self.split.hostname
+
+
+    @property
+    def path(self):
+        return self.split.path
+
+
+    @property
+    def headers(self):
+        """
+        The headers of the request.
+        """
+        return self.request.requestHeaders
+
+
+    def header(self, name):
+        """
+        Gets the last value of a request header, or ``None``.
+        """
+        values = self.request.requestHeaders.getRawHeaders(name)
+        if values:
+            return values[-1]
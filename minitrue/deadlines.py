@@ -0,0 +1,72 @@
+"""
+Deadlines for the phases of proxied requests.
+"""
+from twisted.internet import defer, reactor
+
+
+class DeadlineExceeded(Exception):
+    """
+    A phase of a request took longer than its deadline.
+    """
+    def __init__(self, phase):
+        Exception.__init__(self, phase)
+        self.phase = phase
+
+
+
+class Deadlines(object):
+    """
+    How long (in seconds) each phase of a proxied request may take, or
+    ``None`` for no deadline.
+
+    The phases are ``connect`` (making a connection to the remote server),
+    ``firstByte`` (from having sent the request until the response starts),
+    ``download`` (receiving the rest of the response), ``requestMangler``
+    and ``responseMangler``.
+    """
+    def __init__(self, connect=None, firstByte=None, download=None,
+                 requestMangler=None, responseMangler=None, reactor=reactor):
+        self.connect = connect
+        self.firstByte = firstByte
+        self.download = download
+        self.requestMangler = requestMangler
+        self.responseMangler = responseMangler
+        self.reactor = reactor
+
+
+    def schedule(self, phase, f, *args):
+        """
+        Calls ``f`` with the given arguments when the deadline of the phase
+        passes.
+
+        Returns the delayed call, or ``None`` if the phase has no deadline.
+        """
+        seconds = getattr(self, phase)
+        if seconds is not None:
+            return self.reactor.callLater(seconds, f, *args)
+
+
+    def limit(self, phase, d):
+        """
+        Cancels the deferred if it doesn't fire before the deadline of the
+        phase. It then fails with ``DeadlineExceeded`` instead.
+        """
+        exceeded = []
+
+        def cancel():
+            exceeded.append(True)
+            d.cancel()
+
+        call = self.schedule(phase, cancel)
+        if call is None:
+            return d
+
+        def done(result):
+            if call.active():
+                call.cancel()
+            elif exceeded:
+                result.trap(defer.CancelledError)
+                raise DeadlineExceeded(phase)
+            return result
+
+        return d.addBoth(done)
@@ -0,0 +1,339 @@
+"""
+Interception of TLS connections made through ``CONNECT`` requests.
+
+Instead of tunnelling the encrypted connection, the proxy terminates TLS
+itself with a certificate for the requested host, signed by a local
+certificate authority that the clients trust. The decrypted requests then
+go through the proxy like any other request, and are made to the remote
+server over a new TLS connection, whose certificate is verified.
+
+This requires pyOpenSSL.
+"""
+import calendar
+import errno
+import os
+import random
+import re
+import socket
+import time
+
+try: # pragma: no cover
+    from OpenSSL import SSL, crypto
+except ImportError:
+    SSL = crypto = None
+
+from minitrue.utils import LRUCache
+
+
+def _packedAddress(address):
+    """
+    Gets the packed form of an IPv4 or IPv6 address, or ``None`` if it isn't
+    one.
+    """
+    for family in [socket.AF_INET, socket.AF_INET6]:
+        try:
+            return socket.inet_pton(family, address)
+        except (socket.error, ValueError):
+            continue
+
+
+def _isIPAddress(hostname):
+    return _packedAddress(hostname) is not None
+
+
+
+class _ContextFactory(object):
+    """
+    A context factory for a context that has already been set up.
+    """
+    isClient = False
+
+    def __init__(self, context):
+        self.context = context
+
+
+    def getContext(self):
+        return self.context
+
+
+
+class CertificateAuthority(object):
+    """
+    A certificate authority that mints certificates for intercepted hosts.
+
+    The CA certificate and its private key are read from ``caFile``, in PEM
+    format. All minted certificates are for the same private key, which is
+    generated once (and stored in the cache directory, if there is one), so
+    minting a certificate only takes a signature.
+
+    Minted certificates are kept in memory for the ``cacheSize`` most
+    recently intercepted hosts, together with the TLS contexts that use
+    them, so that TLS sessions can be resumed. If a cache directory is
+    given, certificates are also stored there, and reused after restarts,
+    unless they are about to expire, or they weren't minted by this CA for
+    the current key.
+    """
+    validity = 365 * 24 * 60 * 60
+    renewal = 24 * 60 * 60
+
+    def __init__(self, caFile, cacheDirectory=None, cacheSize=1000,
+                 keyBits=2048):
+        if crypto is None:
+            raise ImportError("Intercepting TLS requires pyOpenSSL")
+
+        with open(caFile) as f:
+            pem = f.read()
+        self.caCertificate = crypto.load_certificate(crypto.FILETYPE_PEM, pem)
+        self.caKey = crypto.load_privatekey(crypto.FILETYPE_PEM, pem)
+
+        self.cacheDirectory = cacheDirectory
+        self.contexts = LRUCache(cacheSize)
+        self.leafKey = self._loadLeafKey(keyBits)
+
+
+    def _loadLeafKey(self, keyBits):
+        """
+        Loads the key for minted certificates, generating it if necessary.
+
+        Several processes may do this at the same time with the same cache
+        directory. The key is written to a temporary file, which is then
+        linked into place, so only one of them stores its key, and the
+        others load that one.
+        """
+        path = None
+        if self.cacheDirectory is not None:
+            path = os.path.join(self.cacheDirectory, "leaf.key")
+            if os.path.exists(path):
+                return self._readLeafKey(path)
+
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, keyBits)
+        if path is None:
+            return key
+
+        temporary = "%s.%d" % (path, os.getpid())
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, "w") as f:
+            f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+
+        try:
+            os.link(temporary, path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            key = self._readLeafKey(path)
+        finally:
+            os.remove(temporary)
+
+        return key
+
+
+    def _readLeafKey(self, path):
+        with open(path) as f:
+            return crypto.load_privatekey(crypto.FILETYPE_PEM, f.read())
+
+
+    def _certificatePath(self, hostname):
+        name = re.sub(r"[^a-z0-9.-]", "_", hostname.lower())
+        return os.path.join(self.cacheDirectory, name + ".pem")
+
+
+    def certificate(self, hostname):
+        """
+        Gets a certificate for a hostname, from the disk cache if possible.
+        """
+        if self.cacheDirectory is not None:
+            path = self._certificatePath(hostname)
+            if os.path.exists(path):
+                with open(path) as f:
+                    pem = f.read()
+                certificate = crypto.load_certificate(crypto.FILETYPE_PEM, pem)
+                if self._isUsable(certificate):
+                    return certificate
+
+        certificate = self.mint(hostname)
+
+        if self.cacheDirectory is not None:
+            temporary = "%s.%d" % (path, os.getpid())
+            with open(temporary, "w") as f:
+                f.write(crypto.dump_certificate(crypto.FILETYPE_PEM,
+                                                certificate))
+            os.rename(temporary, path)
+
+        return certificate
+
+
+    def _isUsable(self, certificate):
+        """
+        Checks if a cached certificate can still be used: it was signed by
+        the CA, it is for the current leaf key, and it doesn't expire soon.
+        """
+        store = crypto.X509Store()
+        store.add_cert(self.caCertificate)
+        try:
+            crypto.X509StoreContext(store, certificate).verify_certificate()
+        except crypto.X509StoreContextError:
+            return False
+
+        dump = crypto.dump_publickey
+        pem = crypto.FILETYPE_PEM
+        if dump(pem, certificate.get_pubkey()) != dump(pem, self.leafKey):
+            return False
+
+        notAfter = time.strptime(certificate.get_notAfter(), "%Y%m%d%H%M%SZ")
+        return calendar.timegm(notAfter) - time.time() > self.renewal
+
+
+    def mint(self, hostname):
+        """
+        Mints a certificate for a hostname.
+        """
+        certificate = crypto.X509()
+        certificate.set_version(2)
+        certificate.set_serial_number(random.getrandbits(64))
+        certificate.get_subject().CN = hostname[:64]
+        certificate.set_issuer(self.caCertificate.get_subject())
+        certificate.gmtime_adj_notBefore(-24 * 60 * 60)
+        certificate.gmtime_adj_notAfter(self.validity)
+        certificate.set_pubkey(self.leafKey)
+
+        kind = "IP" if _isIPAddress(hostname) else "DNS"
+        certificate.add_extensions([
+            crypto.X509Extension("basicConstraints", False, "CA:FALSE"),
+            crypto.X509Extension("subjectAltName", False,
+                                 "%s:%s" % (kind, hostname)),
+        ])
+
+        certificate.sign(self.caKey, "sha256")
+        return certificate
+
+
+    def serverContextFactory(self, hostname):
+        """
+        Gets a context factory to terminate TLS for a hostname with.
+        """
+        hostname = hostname.lower()
+        context = self.contexts.get(hostname)
+        if context is None:
+            context = SSL.Context(SSL.SSLv23_METHOD)
+            context.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3)
+            context.use_privatekey(self.leafKey)
+            context.use_certificate(self.certificate(hostname))
+            context.add_extra_chain_cert(self.caCertificate)
+            context.set_session_id("minitrue")
+            context.set_session_cache_mode(SSL.SESS_CACHE_SERVER)
+            self.contexts[hostname] = context
+
+        return _ContextFactory(context)
+
+
+
+def _hostnameMatches(pattern, hostname):
+    """
+    Checks if a hostname matches a name in a certificate, which may have a
+    wildcard as its leftmost label.
+    """
+    pattern, hostname = pattern.lower().rstrip("."), hostname.lower()
+    if not pattern.startswith("*."):
+        return pattern == hostname
+
+    label, _, rest = hostname.partition(".")
+    return bool(label) and rest == pattern[2:] and "." in rest
+
+
+def _certificateNames(certificate):
+    """
+    Gets the DNS names and IP addresses in a certificate's subjectAltName
+    extension.
+    """
+    names, addresses = [], []
+    for index in range(certificate.get_extension_count()):
+        extension = certificate.get_extension(index)
+        if extension.get_short_name() != "subjectAltName":
+            continue
+
+        for entry in str(extension).split(","):
+            kind, _, value = entry.strip().partition(":")
+            if kind == "DNS":
+                names.append(value)
+            elif kind == "IP Address":
+                addresses.append(_packedAddress(value))
+
+    return names, addresses
+
+
+def _certificateMatches(certificate, hostname):
+    """
+    Checks if a certificate is for a hostname (or IP address).
+
+    The subjectAltName extension is checked if the certificate has one; the
+    common name is only checked for hostnames if it doesn't.
+    """
+    names, addresses = _certificateNames(certificate)
+    if _isIPAddress(hostname):
+        return _packedAddress(hostname) in addresses
+    elif not names and not addresses:
+        commonName = certificate.get_subject().commonName
+        names = [] if commonName is None else [commonName]
+
+    return any(_hostnameMatches(name, hostname) for name in names)
+
+
+
+class ClientContexts(object):
+    """
+    The TLS contexts to connect to remote servers with.
+
+    Certificates of remote servers are verified against the CA certificates
+    in ``caFile`` (in PEM format), or the system's default ones if it isn't
+    given, and have to be for the hostname connected to. The hostname is
+    sent with the Server Name Indication extension.
+
+    Contexts are kept for the ``cacheSize`` most recently used hostnames,
+    so that the CA certificates aren't loaded for every connection.
+    """
+    def __init__(self, caFile=None, cacheSize=1000):
+        if SSL is None:
+            raise ImportError("Connecting over TLS requires pyOpenSSL")
+
+        self.caFile = caFile
+        self.contexts = LRUCache(cacheSize)
+
+
+    def contextFactory(self, hostname):
+        """
+        Gets a context factory to connect to a remote server over TLS with.
+        """
+        hostname = hostname.lower()
+        factory = self.contexts.get(hostname)
+        if factory is None:
+            factory = _ContextFactory(self._buildContext(hostname))
+            factory.isClient = True
+            self.contexts[hostname] = factory
+
+        return factory
+
+
+    def _buildContext(self, hostname):
+        context = SSL.Context(SSL.SSLv23_METHOD)
+        context.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3)
+        if self.caFile is None:
+            context.set_default_verify_paths()
+        else:
+            context.load_verify_locations(self.caFile)
+
+        def verify(connection, certificate, errno, depth, ok):
+            if ok and depth == 0:
+                return _certificateMatches(certificate, hostname)
+            return ok
+
+        context.set_verify(SSL.VERIFY_PEER, verify)
+
+        def sendHostname(connection, where, _):
+            if where & SSL.SSL_CB_HANDSHAKE_START:
+                connection.set_tlsext_host_name(hostname)
+
+        if not _isIPAddress(hostname):
+            context.set_info_callback(sendHostname)
+
+        return context
@@ -0,0 +1,213 @@
+"""
+Instrumentation of the proxy.
+"""
+import bisect
+import collections
+import json
+import time
+
+from twisted.internet import reactor, task
+from twisted.python import log
+from twisted.web import resource
+
+
+def _bucketBounds(smallest=1e-6, largest=100.0, ratio=1.25):
+    bounds = []
+    bound = smallest
+    while bound < largest:
+        bounds.append(bound)
+        bound *= ratio
+    return bounds
+
+
+
+class Histogram(object):
+    """
+    A histogram of durations, with logarithmically spaced buckets.
+
+    Recording a value is cheap, and takes constant memory. Percentiles are
+    approximated by the upper bound of the bucket they fall in.
+    """
+    bounds = _bucketBounds()
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+
+    def percentile(self, fraction):
+        """
+        Approximates the value below which the given fraction of the recorded
+        values falls.
+        """
+        if not self.count:
+            return None
+
+        threshold = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= threshold:
+                break
+
+        if index < len(self.bounds):
+            return min(self.bounds[index], self.max)
+        return self.max
+
+
+    def snapshot(self):
+        mean = self.total / self.count if self.count else None
+        return {"count": self.count, "mean": mean, "max": self.max,
+                "p50": self.percentile(0.5), "p90": self.percentile(0.9),
+                "p99": self.percentile(0.99)}
+
+
+
+class Metrics(object):
+    """
+    Timings of the phases of proxied requests, and counters.
+
+    Timings are recorded in a histogram per phase. The phases recorded by
+    the proxy are ``requestMangler``, ``connect``, ``firstByte``,
+    ``download``, ``responseMangler``, ``replay`` and ``total``. Counters
+    include ``inFlight`` (requests being handled) and ``bufferedBytes``
+    (response bytes buffered for mangling).
+
+    Snapshots of the metrics can be published to sinks periodically. A sink
+    is a callable that takes a snapshot.
+    """
+    def __init__(self, sinks=(), interval=10.0, reactor=reactor):
+        self.histograms = collections.defaultdict(Histogram)
+        self.counters = collections.defaultdict(int)
+        self.sinks = list(sinks)
+        self.interval = interval
+        self.reactor = reactor
+        self._publishing = None
+
+
+    def record(self, phase, duration):
+        """
+        Records how long a phase took.
+        """
+        self.histograms[phase].record(duration)
+
+
+    def recordSince(self, phase, started):
+        """
+        Records how long a phase took, if it was started at the given time.
+        """
+        if started is not None:
+            self.histograms[phase].record(time.time() - started)
+
+
+    def timeDeferred(self, phase, d):
+        """
+        Records how long it takes for the deferred to fire.
+        """
+        started = time.time()
+
+        def recordPhase(result):
+            self.recordSince(phase, started)
+            return result
+
+        return d.addBoth(recordPhase)
+
+
+    def increment(self, counter, amount=1):
+        self.counters[counter] += amount
+
+
+    def snapshot(self):
+        """
+        Takes a snapshot of the metrics, which can be serialized as JSON.
+        """
+        phases = dict((phase, histogram.snapshot())
+                      for phase, histogram in self.histograms.iteritems())
+        return {"phases": phases, "counters": dict(self.counters)}
+
+
+    def publish(self):
+        """
+        Publishes a snapshot of the metrics to the sinks.
+        """
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink(snapshot)
+
+
+    def start(self):
+        """
+        Starts publishing the metrics periodically.
+        """
+        self._publishing = task.LoopingCall(self.publish)
+        self._publishing.clock = self.reactor
+        self._publishing.start(self.interval, now=False)
+
+
+    def stop(self):
+        if self._publishing is not None:
+            self._publishing.stop()
+            self._publishing = None
+
+
+
+class _NullMetrics(object):
+    """
+    Metrics that aren't recorded.
+    """
+    def record(self, phase, duration):
+        pass
+
+
+    def recordSince(self, phase, started):
+        pass
+
+
+    def timeDeferred(self, phase, d):
+        return d
+
+
+    def increment(self, counter, amount=1):
+        pass
+
+
+
+nullMetrics = _NullMetrics()
+
+
+def logSink(snapshot):
+    """
+    A sink that logs the snapshot.
+    """
+    log.msg("Proxy metrics: %s" % (json.dumps(snapshot, sort_keys=True),))
+
+
+
+class MetricsResource(resource.Resource):
+    """
+    A resource that serves a snapshot of the metrics as JSON.
+
+    Serve it on a local port to have a stats endpoint, for example with
+    ``reactor.listenTCP(8081, server.Site(MetricsResource(metrics)),
+    interface="127.0.0.1")``.
+    """
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "application/json")
+        return json.dumps(self.metrics.snapshot(), sort_keys=True)
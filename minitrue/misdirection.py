@@ -1,22 +1,44 @@
 """
 Mechanism for misdirecting requests to different URLs easily.
 """
-import urlparse
+import functools
 
 from twisted.python import log
 
+from minitrue.context import splitURL
+from minitrue.utils import LRUCache
 
-def misdirector(f):
+
+_missing = object()
+
+
+def misdirector(f=None, cacheSize=None):
     """
     A decorator to turn something that modifies the URL a request is directed
     at into a request mangler.
+
+    If a ``cacheSize`` is given, the decisions of the misdirector are cached
+    (keyed on the original URL) in an LRU cache of that size, which is
+    available as the ``cache`` attribute of the request mangler. Use it as
+    ``@misdirector(cacheSize=1000)`` in that case. Only use it for
+    misdirectors that always misdirect the same URL to the same place.
     """
+    if f is None:
+        return functools.partial(misdirector, cacheSize=cacheSize)
+
+    cache = None if cacheSize is None else LRUCache(cacheSize)
+
     def requestMangler(request):
         """
         A request mangler that misdirects a request to a different URL.
         """
         original = request.uri
-        misdirected = f(original)
+        if cache is None:
+            misdirected = f(original)
+        else:
+            misdirected = cache.get(original, _missing)
+            if misdirected is _missing:
+                misdirected = cache[original] = f(original)
 
         if misdirected is None or misdirected == original:
             return
@@ -24,12 +46,13 @@ def misdirector(f):
         log.msg("Misdirecting %s to %s..." % (original, misdirected))
         request.uri = misdirected
 
+    requestMangler.cache = cache
     return requestMangler
 
 
 def affectHostnames(hostnames):
     def accessor(url):
-        hostname = urlparse.urlsplit(url).hostname
+        hostname = splitURL(url).hostname
         if hostname is not None:
             return hostname.lower()
 
@@ -38,7 +61,7 @@ def affectHostnames(hostnames):
 
 def affectPaths(paths):
     def accessor(url):
-        return urlparse.urlsplit(url).path
+        return splitURL(url).path
 
     return _affect(paths, accessor=accessor)
 
@@ -46,6 +69,7 @@ def affectPaths(paths):
 def _affect(affected, accessor=None, affectedMap=None):
     if affectedMap is not None:
         affected = map(affectedMap, affected)
+    affected = frozenset(affected)
 
     def decorator(md):
         def decorated(url):
@@ -57,3 +81,227 @@ def _affect(affected, accessor=None, affectedMap=None):
         return decorated
 
     return decorator
+
+
+class _Node(object):
+    """
+    A node in a trie of hostname labels or path segments.
+
+    The values stored at nodes are rules, or in the trie of hostname labels,
+    the path indexes (``_PathIndex``) of the rules for that domain.
+    """
+    __slots__ = ["children", "rules", "strictRules"]
+
+    def __init__(self):
+        self.children = {}
+        self.rules = []
+        self.strictRules = []
+
+
+    def insert(self, keys):
+        """
+        Gets the node for the given sequence of keys, creating it (and any
+        intermediate nodes) if necessary.
+        """
+        node = self
+        for key in keys:
+            child = node.children.get(key)
+            if child is None:
+                child = node.children[key] = _Node()
+            node = child
+        return node
+
+
+    def collect(self, keys, found):
+        """
+        Collects the rules of all nodes along the given sequence of keys.
+
+        Rules in ``strictRules`` are only collected if there are more keys
+        after the node they're stored at.
+        """
+        node = self
+        remaining = len(keys)
+        for key in keys:
+            node = node.children.get(key)
+            if node is None:
+                return
+
+            remaining -= 1
+            found.extend(node.rules)
+            if remaining:
+                found.extend(node.strictRules)
+
+
+
+class _PathIndex(object):
+    """
+    Rules indexed by path: exact paths in a dictionary, and path prefixes in
+    a trie of path segments. Rules without paths apply to every path.
+    """
+    __slots__ = ["everywhere", "paths", "prefixes"]
+
+    def __init__(self):
+        self.everywhere = []
+        self.paths = {}
+        self.prefixes = _Node()
+
+
+    def add(self, rule, paths, prefixes):
+        if not paths and not prefixes:
+            self.everywhere.append(rule)
+
+        for path in paths:
+            self.paths.setdefault(path, []).append(rule)
+
+        for prefix in prefixes:
+            self.prefixes.insert(prefix).rules.append(rule)
+
+
+    def collect(self, path, segments, found):
+        """
+        Collects the rules that apply to the given path.
+        """
+        found.extend(self.everywhere)
+        found.extend(self.paths.get(path, ()))
+        self.prefixes.collect(segments, found)
+
+
+
+class _Rule(object):
+    """
+    A misdirector that only applies to some hostnames and/or paths.
+    """
+    __slots__ = ["order", "misdirector"]
+
+    def __init__(self, order, misdirector):
+        self.order = order
+        self.misdirector = misdirector
+
+
+
+def _reversedLabels(hostname):
+    return hostname.lower().split(".")[::-1]
+
+
+def _pathSegments(path):
+    return path.rstrip("/").split("/")
+
+
+
+class Rules(object):
+    """
+    A compiled set of misdirection rules.
+
+    Each rule is a misdirector that only applies to URLs with some hostnames
+    and/or paths. The rules are indexed so that finding the ones that apply
+    to a URL doesn't get slower as more rules are added: exact hostnames
+    are looked up in a dictionary, and domains in a trie of reversed
+    hostname labels. Those lead to an index of the paths of the rules for
+    that host, as do rules without hostnames: exact paths are looked up in
+    a dictionary, and path prefixes in a trie of path segments.
+
+    A set of rules is itself a misdirector: it returns the misdirected URL of
+    the first rule (in the order they were added) that applies to the URL and
+    doesn't return ``None``. It parses the URL only once.
+    """
+    def __init__(self):
+        self._order = 0
+        self._hostnames = {}
+        self._domains = _Node()
+        self._anyHost = _PathIndex()
+
+
+    def _domainIndex(self, domain):
+        """
+        Gets the path index for a domain, creating it if necessary.
+        """
+        strict = domain.startswith("*.")
+        if strict:
+            domain = domain[2:]
+
+        node = self._domains.insert(_reversedLabels(domain))
+        indexes = node.strictRules if strict else node.rules
+        if not indexes:
+            indexes.append(_PathIndex())
+        return indexes[0]
+
+
+    def rule(self, hostnames=(), domains=(), paths=(), pathPrefixes=()):
+        """
+        A decorator that adds a misdirector as a rule.
+
+        The rule applies to URLs that have one of the given hostnames, or a
+        hostname in one of the given domains (if any are given), and that
+        have one of the given paths, or a path starting with one of the given
+        path prefixes (if any are given).
+
+        A domain applies to itself and all of its subdomains, unless it is
+        given as ``*.example.com``, in which case it only applies to the
+        subdomains. Path prefixes match whole path segments, so ``/ministry``
+        matches ``/ministry/truth`` but not ``/ministryoftruth``.
+        """
+        def decorator(md):
+            rule = _Rule(self._order, md)
+            self._order += 1
+            prefixes = [_pathSegments(p) for p in pathPrefixes]
+
+            indexes = []
+            for hostname in hostnames:
+                index = self._hostnames.get(hostname.lower())
+                if index is None:
+                    index = self._hostnames[hostname.lower()] = _PathIndex()
+                indexes.append(index)
+
+            indexes.extend(self._domainIndex(d) for d in domains)
+            for index in indexes or [self._anyHost]:
+                index.add(rule, paths, prefixes)
+
+            return md
+
+        return decorator
+
+
+    def affectHostnames(self, hostnames):
+        return self.rule(hostnames=hostnames)
+
+
+    def affectDomains(self, domains):
+        return self.rule(domains=domains)
+
+
+    def affectPaths(self, paths):
+        return self.rule(paths=paths)
+
+
+    def affectPathPrefixes(self, pathPrefixes):
+        return self.rule(pathPrefixes=pathPrefixes)
+
+
+    def __call__(self, url):
+        """
+        Misdirects the URL according to the first applicable rule.
+        """
+        split = splitURL(url)
+        hostname, path = split.hostname, split.path
+        segments = _pathSegments(path)
+
+        indexes = [self._anyHost]
+        if hostname is not None:
+            index = self._hostnames.get(hostname)
+            if index is not None:
+                indexes.append(index)
+            self._domains.collect(_reversedLabels(hostname), indexes)
+
+        found = []
+        for index in indexes:
+            index.collect(path, segments, found)
+
+        seen = set()
+        for rule in sorted(found, key=lambda rule: rule.order):
+            if rule.order in seen:
+                continue
+            seen.add(rule.order)
+
+            misdirected = rule.misdirector(url)
+            if misdirected is not None:
+                return misdirected
@@ -0,0 +1,514 @@
+"""
+Offloading of CPU-bound response manglers to worker processes.
+
+Response bodies are passed to and from the workers through memory mapped
+files (in ``/dev/shm`` where available), so that large bodies don't have to
+be serialized. Everything else about the response goes over a pipe.
+
+Offloaded manglers are looked up in the workers by their fully qualified
+name, so they must be importable module-level functions. In the workers,
+they get a stand-in for the response, whose ``client.father`` has the
+method, URI, headers and response code of the request. Changes to the body,
+the response code and the response headers are sent back. Offloaded
+manglers can't return deferreds.
+
+Compressed bodies are sent to the workers as they were received, and only
+decompressed there if the mangler reads them, so that decompressing them
+doesn't block the reactor. Bodies the mangler didn't change aren't sent
+back, so they are sent to the client as they were received.
+"""
+import json
+import mmap
+import multiprocessing
+import os
+import sys
+import tempfile
+import traceback
+import zlib
+
+from twisted.internet import defer, error, protocol, reactor
+from twisted.python import log, reflect
+from twisted.web.http_headers import Headers
+
+from minitrue.context import RequestContext
+from minitrue.utils import SpillingBuffer, StringIO
+
+
+_sharedDirectory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+_copyChunkSize = 1024 * 1024
+
+# Relative entries on the path are relative to the directory this process
+# was in when it started, which may not be the current directory anymore.
+_absolutePaths = dict((entry, os.path.abspath(entry)) for entry in sys.path)
+
+
+class OffloadError(Exception):
+    """
+    Offloaded mangling failed, because the mangler raised an exception, or
+    because the worker process died.
+    """
+
+
+
+class OffloadTimeout(OffloadError):
+    """
+    Offloaded mangling took too long.
+    """
+
+
+
+def _writeShared(path, data):
+    """
+    Writes data (a string, or a memory map) to a memory mapped file.
+
+    The data is copied in chunks, so that memory maps aren't read into
+    memory all at once.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+    try:
+        os.ftruncate(fd, len(data))
+        if len(data):
+            mapped = mmap.mmap(fd, len(data))
+            for offset in xrange(0, len(data), _copyChunkSize):
+                end = offset + _copyChunkSize
+                mapped[offset:end] = data[offset:end]
+            mapped.close()
+    finally:
+        os.close(fd)
+
+
+def _readShared(path):
+    """
+    Reads data from a memory mapped file.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if not size:
+            return ""
+        mapped = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        try:
+            return mapped[:]
+        finally:
+            mapped.close()
+    finally:
+        os.close(fd)
+
+
+def _encodeHeaders(headers):
+    return [[name.decode("latin-1"), [v.decode("latin-1") for v in values]]
+            for name, values in headers.getAllRawHeaders()]
+
+
+def _decodeHeaders(encoded):
+    return Headers(dict((name.encode("latin-1"),
+                         [v.encode("latin-1") for v in values])
+                        for name, values in encoded))
+
+
+
+class _Request(object):
+    """
+    Stands in for the request in a worker process.
+    """
+    def __init__(self, job):
+        self.method = job["method"].encode("latin-1")
+        self.uri = job["uri"].encode("latin-1")
+        self.requestHeaders = _decodeHeaders(job["requestHeaders"])
+        self.responseHeaders = _decodeHeaders(job["responseHeaders"])
+        self.code = job["requestCode"]
+        self.code_message = job["message"].encode("latin-1")
+
+
+    def setResponseCode(self, code, message=None):
+        self.code = code
+        if message is not None:
+            self.code_message = message
+
+
+    def setHeader(self, name, value):
+        self.responseHeaders.setRawHeaders(name, [value])
+
+
+
+class _Client(object):
+    def __init__(self, father):
+        self.father = father
+
+
+
+class _Response(object):
+    """
+    Stands in for the response in a worker process.
+
+    The body is decompressed when the ``content`` is first accessed, if it
+    was sent with an encoding. Like the response in the proxy, the content
+    is a writable ``minitrue.utils.SpillingBuffer``.
+    """
+    def __init__(self, job):
+        request = _Request(job)
+        self.client = _Client(request)
+        self.code = job["code"]
+        self.headers = request.responseHeaders
+        self.context = RequestContext(request)
+
+        self.encoding = job["encoding"]
+        self.maxDecodedBytes = job["maxDecodedBytes"]
+        self.input = SpillingBuffer()
+        self.input.write(_readShared(job["input"]))
+        self.input.seek(0, 0)
+        self._content = None
+        self._received = None
+
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = self.input
+            if self.encoding is not None and len(self.input):
+                self._decodeInput()
+            self._received = self._content, self._content.changes
+        return self._content
+
+
+    @content.setter
+    def content(self, content):
+        self._content = content
+
+
+    def _decodeInput(self):
+        """
+        Decompresses the body. If it can't be decompressed, it is left as it
+        is.
+        """
+        # minitrue.proxy imports this module.
+        from minitrue.proxy import _decode
+
+        decoded = SpillingBuffer()
+        try:
+            _decode(self.input.view(), self.encoding, decoded,
+                    self.maxDecodedBytes)
+        except zlib.error:
+            decoded.close()
+            return
+
+        decoded.seek(0, 0)
+        self._content = decoded
+
+
+    def changed(self):
+        """
+        Checks if the mangler changed the body.
+        """
+        content = self._content
+        if content is None:
+            return False
+        elif not isinstance(content, SpillingBuffer):
+            return True
+        return (content, content.changes) != self._received
+
+
+    def isRaw(self):
+        """
+        Checks if the content is the body as it was received, because it
+        couldn't be decompressed.
+        """
+        return self.encoding is not None and self._content is self.input
+
+
+
+def _mangle(job):
+    """
+    Mangles a response in a worker process.
+    """
+    mangler = reflect.namedAny(job["mangler"])
+    response = _Response(job)
+    mangler(response)
+
+    changed = response.changed()
+    if changed:
+        content = response.content
+        if isinstance(content, SpillingBuffer):
+            _writeShared(job["output"], content.view())
+        else:
+            content.seek(0, 0)
+            _writeShared(job["output"], content.read())
+
+    request = response.client.father
+    return {"code": response.code, "requestCode": request.code,
+            "message": request.code_message.decode("latin-1"),
+            "responseHeaders": _encodeHeaders(request.responseHeaders),
+            "changed": changed, "raw": response.isRaw()}
+
+
+def work(jobs, replies):
+    """
+    Mangles responses until there are no more jobs.
+
+    Jobs are read from the jobs file, and replies are written to the
+    replies file, one JSON object per line.
+    """
+    for line in iter(jobs.readline, ""):
+        try:
+            reply = _mangle(json.loads(line))
+        except Exception:
+            reply = {"error": traceback.format_exc()}
+        replies.write(json.dumps(reply) + "\n")
+        replies.flush()
+
+
+
+class _Worker(protocol.ProcessProtocol):
+    """
+    Talks to a worker process.
+
+    Jobs are written to its stdin, and replies are read from file descriptor
+    3, so that manglers that print things don't confuse the pool.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.job = None
+        self._buffer = ""
+
+
+    def childDataReceived(self, fd, data):
+        if fd != 3:
+            log.msg("Offload worker output: %r" % (data,))
+            return
+
+        self._buffer += data
+        while "\n" in self._buffer:
+            line, self._buffer = self._buffer.split("\n", 1)
+            self.pool._replyReceived(self, json.loads(line))
+
+
+    def processEnded(self, reason):
+        self.pool._workerEnded(self, reason)
+
+
+
+class _Job(object):
+    def __init__(self, mangler, response, encoding):
+        self.mangler = mangler
+        self.response = response
+        self.encoding = encoding
+        self.deferred = defer.Deferred()
+        self.timeout = None
+
+        fd, self.input = tempfile.mkstemp(dir=_sharedDirectory)
+        os.close(fd)
+        self.output = self.input + ".out"
+
+
+    def describe(self):
+        response = self.response
+        request = response.client.father
+        return {"mangler": reflect.qual(self.mangler),
+                "input": self.input, "output": self.output,
+                "method": request.method.decode("latin-1"),
+                "uri": request.uri.decode("latin-1"),
+                "requestHeaders": _encodeHeaders(request.requestHeaders),
+                "responseHeaders": _encodeHeaders(request.responseHeaders),
+                "requestCode": request.code,
+                "message": (request.code_message or "").decode("latin-1"),
+                "code": response.code, "encoding": self.encoding,
+                "maxDecodedBytes": request.maxDecodedBytes}
+
+
+    def cleanUp(self):
+        for path in [self.input, self.output]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+
+class ProcessPool(object):
+    """
+    A pool of worker processes that response manglers are offloaded to.
+
+    At most ``size`` workers are started (by default, as many as there are
+    CPUs); they are started when they are first needed. Mangling that takes
+    longer than ``timeout`` seconds is abandoned, and its worker killed.
+    Workers that die are replaced when they are needed again.
+    """
+    def __init__(self, size=None, timeout=30.0, reactor=reactor):
+        self.size = multiprocessing.cpu_count() if size is None else size
+        self.timeout = timeout
+        self.reactor = reactor
+
+        self.workers = set()
+        self._idle = []
+        self._pending = []
+        self._stopped = []
+
+
+    def mangle(self, mangler, response):
+        """
+        Mangles a response in a worker process.
+
+        If the content of the response hasn't been accessed yet, the body is
+        sent to the worker as it was received, and decompressed there.
+
+        Returns a deferred that fires when the response has been updated
+        with the result, or fails with an ``OffloadError``.
+        """
+        if response._content is None:
+            job = _Job(mangler, response, response._contentEncoding())
+            _writeShared(job.input, response.raw.view())
+        else:
+            job = _Job(mangler, response, None)
+            content = response.content
+            if isinstance(content, SpillingBuffer):
+                _writeShared(job.input, content.view())
+            else:
+                content.seek(0, 0)
+                _writeShared(job.input, content.read())
+
+        self._pending.append(job)
+        self._dispatch()
+        return job.deferred
+
+
+    def _dispatch(self):
+        while self._pending:
+            if self._idle:
+                worker = self._idle.pop()
+            elif len(self.workers) < self.size:
+                worker = self._spawn()
+            else:
+                return
+
+            job = worker.job = self._pending.pop(0)
+            job.timeout = self.reactor.callLater(self.timeout,
+                                                 self._timedOut, worker)
+            worker.transport.write(json.dumps(job.describe()) + "\n")
+
+
+    def _spawn(self):
+        worker = _Worker(self)
+        argv = [sys.executable, "-m", "minitrue.offload"]
+        path = os.pathsep.join(_absolutePaths.get(entry)
+                               or os.path.abspath(entry)
+                               for entry in sys.path)
+        env = dict(os.environ, PYTHONPATH=path)
+        childFDs = {0: "w", 1: "r", 2: "r", 3: "r"}
+        self.reactor.spawnProcess(worker, sys.executable, argv, env=env,
+                                  childFDs=childFDs)
+        self.workers.add(worker)
+        return worker
+
+
+    def _finishJob(self, worker):
+        job, worker.job = worker.job, None
+        if job.timeout.active():
+            job.timeout.cancel()
+        return job
+
+
+    def _replyReceived(self, worker, reply):
+        if worker.job is None:
+            return
+
+        job = self._finishJob(worker)
+        self._idle.append(worker)
+
+        try:
+            if "error" in reply:
+                raise OffloadError(reply["error"])
+            self._apply(job, reply)
+        except Exception:
+            job.deferred.errback()
+        else:
+            job.deferred.callback(None)
+        finally:
+            job.cleanUp()
+
+        self._dispatch()
+
+
+    def _apply(self, job, reply):
+        """
+        Updates a response with the result of mangling it.
+        """
+        response = job.response
+        if reply["changed"]:
+            self._applyBody(job, reply["raw"])
+        response.code = reply["code"]
+
+        request = response.client.father
+        request.setResponseCode(reply["requestCode"],
+                                reply["message"].encode("latin-1"))
+        headers = _decodeHeaders(reply["responseHeaders"])
+        request.responseHeaders = response.headers = headers
+
+
+    def _applyBody(self, job, raw):
+        """
+        Replaces the body of a response with the changed one.
+
+        A changed body that was sent compressed, but couldn't be decompressed
+        in the worker, replaces the received body as it is.
+        """
+        response = job.response
+        body = _readShared(job.output)
+        if not raw:
+            response.content = StringIO(body)
+            return
+
+        raw = response.raw
+        raw.seek(0, 0)
+        raw.write(body)
+        raw.truncate()
+        response.content = raw
+
+
+    def _timedOut(self, worker):
+        job = self._finishJob(worker)
+        job.cleanUp()
+        worker.transport.signalProcess("KILL")
+        job.deferred.errback(OffloadTimeout(reflect.qual(job.mangler)))
+
+
+    def _workerEnded(self, worker, reason):
+        self.workers.discard(worker)
+        if worker in self._idle:
+            self._idle.remove(worker)
+
+        if worker.job is not None:
+            job = self._finishJob(worker)
+            job.cleanUp()
+            message = "Offload worker died: %s" % (reason.value,)
+            job.deferred.errback(OffloadError(message))
+
+        if not self.workers:
+            stopped, self._stopped = self._stopped, []
+            for d in stopped:
+                d.callback(None)
+
+        self._dispatch()
+
+
+    def stop(self):
+        """
+        Stops all workers.
+
+        Returns a deferred that fires when they have all exited.
+        """
+        if not self.workers:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        self._stopped.append(d)
+        for worker in list(self.workers):
+            try:
+                worker.transport.closeStdin()
+            except error.ProcessExitedAlready:
+                pass
+        return d
+
+
+
+if __name__ == "__main__":
+    work(sys.stdin, os.fdopen(3, "w"))
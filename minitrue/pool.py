@@ -0,0 +1,122 @@
+"""
+Persistent connections to upstream servers.
+"""
+from twisted.internet import defer, reactor
+
+
+class ConnectionPool(object):
+    """
+    A pool of idle, persistent HTTP/1.1 connections to upstream servers.
+
+    Connections are keyed on ``(host, port)``. At most ``maxIdlePerKey`` idle
+    connections are kept per key, and idle connections are closed after
+    ``idleTimeout`` seconds.
+
+    ``created`` counts the connections that were made because no idle
+    connection was available, ``reused`` counts the requests that were sent
+    over an idle connection instead, and ``expired`` counts the idle
+    connections that were closed because they timed out.
+    """
+    def __init__(self, maxIdlePerKey=8, idleTimeout=60, reactor=reactor):
+        self.maxIdlePerKey = maxIdlePerKey
+        self.idleTimeout = idleTimeout
+        self.reactor = reactor
+
+        self._idle = {}
+        self._closing = {}
+
+        self.created = 0
+        self.reused = 0
+        self.expired = 0
+
+
+    def reuse(self, host, port, factory):
+        """
+        Tries to make a request using the given client factory over an idle
+        connection.
+
+        Returns ``True`` if there was an idle connection to use. Otherwise,
+        the caller should make a new connection using the factory, which will
+        be put in this pool once the request is done.
+        """
+        key = factory.poolKey = host, port
+        factory.pool = self
+
+        idle = self._idle.get(key)
+        if not idle:
+            self.created += 1
+            return False
+
+        protocol, timeout = idle.pop()
+        if not idle:
+            del self._idle[key]
+
+        timeout.cancel()
+        self.reused += 1
+        factory.reuse(protocol)
+        return True
+
+
+    def release(self, protocol):
+        """
+        Puts a connection that has finished its request back in the pool.
+
+        If there are already enough idle connections for the same key, the
+        connection is closed instead.
+        """
+        key = protocol.factory.poolKey
+        idle = self._idle.setdefault(key, [])
+        if len(idle) >= self.maxIdlePerKey:
+            protocol.transport.loseConnection()
+            return
+
+        timeout = self.reactor.callLater(self.idleTimeout,
+                                         self._expire, protocol)
+        idle.append((protocol, timeout))
+
+
+    def discard(self, protocol):
+        """
+        Forgets about a connection, typically because it was lost.
+        """
+        key = protocol.factory.poolKey
+        idle = self._idle.get(key, [])
+        for entry in idle:
+            if entry[0] is protocol:
+                idle.remove(entry)
+                if entry[1].active():
+                    entry[1].cancel()
+                break
+
+        if not idle:
+            self._idle.pop(key, None)
+
+        d = self._closing.pop(protocol, None)
+        if d is not None:
+            d.callback(None)
+
+
+    def _expire(self, protocol):
+        """
+        Closes an idle connection that hasn't been used for a while.
+        """
+        self.expired += 1
+        self.discard(protocol)
+        protocol.transport.loseConnection()
+
+
+    def closeCachedConnections(self):
+        """
+        Closes all idle connections.
+
+        Returns a deferred that fires when they have all been closed.
+        """
+        ds = []
+        for idle in self._idle.values():
+            for protocol, timeout in idle:
+                timeout.cancel()
+                d = self._closing[protocol] = defer.Deferred()
+                ds.append(d)
+                protocol.transport.loseConnection()
+
+        return defer.DeferredList(ds)
@@ -0,0 +1,224 @@
+"""
+Profiling of manglers.
+"""
+import collections
+import os
+import random
+import sys
+import threading
+import time
+
+from twisted.internet import defer
+from twisted.python import log
+
+try: # pragma: no cover
+    import resource
+except ImportError:
+    resource = None
+
+
+if resource is not None and sys.platform.startswith("linux"):
+    _RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", 1)
+
+    def _cpuTime():
+        """
+        Gets the CPU time used by the current thread.
+        """
+        usage = resource.getrusage(_RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+else: # pragma: no cover
+    _cpuTime = time.clock
+
+
+def _nameOf(f):
+    return getattr(f, "__name__", type(f).__name__)
+
+
+def _uriOf(args):
+    """
+    Gets the URI of the request a mangler was called for, from its first
+    argument (a request or a response).
+    """
+    if not args:
+        return None
+    context = getattr(args[0], "context", None)
+    if context is not None:
+        return context.request.uri
+    return getattr(args[0], "uri", None)
+
+
+
+class _Stats(object):
+    """
+    The calls to a mangler.
+    """
+    __slots__ = ["calls", "wallTime", "cpuTime", "slowCalls"]
+
+    def __init__(self):
+        self.calls = 0
+        self.wallTime = 0.0
+        self.cpuTime = 0.0
+        self.slowCalls = 0
+
+
+    def snapshot(self):
+        return {"calls": self.calls, "wallTime": self.wallTime,
+                "cpuTime": self.cpuTime, "slowCalls": self.slowCalls}
+
+
+
+class _StackCapture(object):
+    """
+    Captures the stacks of a call, with the time spent in each of them.
+
+    This uses a profile function, so it works in any thread, but it is slow;
+    it is only used for a sample of the calls.
+    """
+    def __init__(self, root):
+        self.stack = [root]
+        self.times = collections.Counter()
+        self._last = None
+
+
+    def run(self, f, *a, **kw):
+        previous = sys.getprofile()
+        self._last = time.time()
+        sys.setprofile(self._event)
+        try:
+            return f(*a, **kw)
+        finally:
+            sys.setprofile(previous)
+            self._charge()
+
+
+    def _charge(self):
+        now = time.time()
+        self.times[tuple(self.stack)] += now - self._last
+        self._last = now
+
+
+    def _event(self, frame, event, arg):
+        self._charge()
+        if event == "call":
+            code = frame.f_code
+            filename = os.path.basename(code.co_filename)
+            self.stack.append("%s:%s" % (filename, code.co_name))
+        elif event == "c_call":
+            self.stack.append(_nameOf(arg))
+        elif len(self.stack) > 1:
+            self.stack.pop()
+
+
+
+class Profiler(object):
+    """
+    Records the wall and CPU time of calls to manglers (and parts of
+    ``minitrue.utils.Combined`` manglers), per mangler name.
+
+    Calls that take at least ``slowThreshold`` seconds are logged, with the
+    URI of the request they were for. For a ``sampleRate`` fraction of the
+    calls, the time spent in each stack is captured as well. The captured
+    stacks are available in the folded format that flame graph tools read.
+
+    For manglers that return deferreds, the wall time is until the deferred
+    fires, but the CPU time and stacks are only those of the call itself.
+    """
+    def __init__(self, slowThreshold=None, sampleRate=0.0,
+                 random=random.random):
+        self.slowThreshold = slowThreshold
+        self.sampleRate = sampleRate
+        self.random = random
+        self.stats = collections.defaultdict(_Stats)
+        self.stacks = collections.Counter()
+        self._lock = threading.Lock()
+
+
+    def _invoke(self, f, a, kw):
+        if self.sampleRate and self.random() < self.sampleRate:
+            capture = _StackCapture(_nameOf(f))
+            try:
+                return capture.run(f, *a, **kw)
+            finally:
+                with self._lock:
+                    self.stacks.update(capture.times)
+        return f(*a, **kw)
+
+
+    def run(self, f, *a, **kw):
+        """
+        Calls a function that doesn't return a deferred, profiling it.
+        """
+        started, cpuStarted = time.time(), _cpuTime()
+        try:
+            return self._invoke(f, a, kw)
+        finally:
+            self._record(f, a, time.time() - started,
+                         _cpuTime() - cpuStarted)
+
+
+    def call(self, f, *a, **kw):
+        """
+        Calls a function that may return a deferred, profiling it.
+
+        Returns a deferred that fires with its result.
+        """
+        started, cpuStarted = time.time(), _cpuTime()
+        d = defer.maybeDeferred(self._invoke, f, a, kw)
+        cpuTime = _cpuTime() - cpuStarted
+
+        def done(result):
+            self._record(f, a, time.time() - started, cpuTime)
+            return result
+
+        return d.addBoth(done)
+
+
+    def _record(self, f, a, wallTime, cpuTime):
+        name = _nameOf(f)
+        threshold = self.slowThreshold
+        slow = threshold is not None and wallTime >= threshold
+
+        with self._lock:
+            stats = self.stats[name]
+            stats.calls += 1
+            stats.wallTime += wallTime
+            stats.cpuTime += cpuTime
+            stats.slowCalls += slow
+
+        if slow:
+            log.msg("Slow call to %s: %.3fs (%.3fs CPU) for %s"
+                    % (name, wallTime, cpuTime, _uriOf(a)))
+
+
+    def snapshot(self):
+        """
+        Takes a snapshot of the stats, which can be serialized as JSON.
+        """
+        with self._lock:
+            return dict((name, stats.snapshot())
+                        for name, stats in self.stats.iteritems())
+
+
+    def foldedStacks(self):
+        """
+        Gets the captured stacks in folded format: one line per stack, with
+        the frames separated by semicolons, and the time spent in that stack
+        in microseconds.
+        """
+        with self._lock:
+            stacks = self.stacks.items()
+
+        lines = []
+        for stack, seconds in sorted(stacks):
+            microseconds = int(round(seconds * 1e6))
+            if microseconds:
+                lines.append("%s %d\n" % (";".join(stack), microseconds))
+        return "".join(lines)
+
+
+    def dumpStacks(self, path):
+        """
+        Writes the captured stacks to a file, in folded format.
+        """
+        with open(path, "w") as f:
+            f.write(self.foldedStacks())
@@ -2,25 +2,314 @@
 HTTP proxy facilities.
 """
 import functools
+import time
 import urlparse
-try: # pragma: no cover
-    import cStringIO as StringIO; StringIO
-except ImportError:
-    import StringIO
+import zlib
 
-from twisted.internet import defer
+from zope.interface import implements
+
+from twisted.internet import defer, error, interfaces
+from twisted.python import log
 from twisted.web import http, proxy
 
-from minitrue.utils import passthrough
+from minitrue import admission, intercept, offload
+from minitrue.context import RequestContext
+from minitrue.deadlines import DeadlineExceeded, Deadlines
+from minitrue.metrics import nullMetrics
+from minitrue.tunnel import TunnelFactory, TunnelProtocol
+from minitrue.utils import BufferBudget, SpillingBuffer, passthrough
+
+
+_hopByHopHeaders = frozenset(["connection", "keep-alive", "proxy-connection",
+                              "transfer-encoding", "te", "trailer", "upgrade",
+                              "expect"])
+_idempotentMethods = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS",
+                                "TRACE"])
+
+
+
+_decodeChunkSize = 64 * 1024
+
+
+class DecodedBodyTooLarge(Exception):
+    """
+    A compressed response body is larger than allowed once decompressed.
+    """
+
+
+
+def _hasZlibHeader(data):
+    """
+    Checks if deflate encoded data has a zlib header, as it should (but
+    often doesn't).
+    """
+    if len(data) < 2:
+        return False
+    first, second = ord(data[0]), ord(data[1])
+    return first & 0x0f == zlib.DEFLATED and (first * 256 + second) % 31 == 0
+
+
+def _decode(data, encoding, output, maxLength=None):
+    """
+    Decompresses a gzip or deflate encoded body into a file-like object.
+
+    The body is decompressed in chunks, so that neither the compressed nor
+    the decompressed body has to be in memory all at once. Raises
+    ``DecodedBodyTooLarge`` if the decompressed body is longer than
+    ``maxLength``.
+    """
+    if encoding == "deflate":
+        wbits = zlib.MAX_WBITS if _hasZlibHeader(data) else -zlib.MAX_WBITS
+    else:
+        wbits = 16 + zlib.MAX_WBITS
+
+    decompressor = zlib.decompressobj(wbits)
+    length = 0
+    for offset in xrange(0, len(data), _decodeChunkSize):
+        chunk = data[offset:offset + _decodeChunkSize]
+        while chunk:
+            decoded = decompressor.decompress(chunk, _decodeChunkSize)
+            length += len(decoded)
+            if maxLength is not None and length > maxLength:
+                raise DecodedBodyTooLarge(maxLength)
+            output.write(decoded)
+            chunk = decompressor.unconsumed_tail
+
+    output.write(decompressor.flush())
+
+
+def _encode(data, encoding, level):
+    """
+    Compresses a body with gzip or deflate.
+    """
+    wbits = zlib.MAX_WBITS if encoding == "deflate" else 16 + zlib.MAX_WBITS
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
 
 
 class _Response(object):
-    code = None
+    """
+    A response received from a remote server, as seen by response manglers.
+
+    The body is buffered in a ``minitrue.utils.SpillingBuffer``, so large
+    bodies are kept in a temporary file instead of in memory. Manglers can
+    use the ``view`` method of the content to read such bodies without
+    copying them into memory.
+
+    If the body is compressed (with gzip or deflate), it is decompressed
+    into another ``SpillingBuffer`` when the ``content`` is first accessed.
+    Accessing it fails with ``DecodedBodyTooLarge`` if the decompressed body
+    would be larger than ``maxDecodedBytes``. If the body isn't accessed, or
+    it isn't changed, the compressed body that was received is sent to the
+    client as is.
+
+    The context of the request (a ``minitrue.context.RequestContext``) is
+    available as ``context``.
+    """
+    __slots__ = ["client", "code", "headers", "raw", "_content", "_decoded",
+                 "_decodedChanges"]
 
     def __init__(self, client):
         self.client = client
-        self.content = StringIO.StringIO()
+        self.code = None
+        self.headers = None
+        father = client.father
+        self.raw = SpillingBuffer(father.bufferThreshold, father.bufferBudget)
+        self._content = None
+        self._decoded = None
+        self._decodedChanges = None
+
+
+    @property
+    def context(self):
+        return self.client.father.context
+
+
+    def _contentEncoding(self):
+        if self.headers is None:
+            return None
+        values = self.headers.getRawHeaders("content-encoding", [])
+        encoding = ",".join(values).strip().lower()
+        if encoding == "x-gzip":
+            return "gzip"
+        elif encoding in ("gzip", "deflate"):
+            return encoding
+
+
+    @property
+    def content(self):
+        """
+        The (decompressed) body of the response, as a file-like object.
+        """
+        if self._content is None:
+            encoding = self._contentEncoding()
+            if len(self.raw) and encoding is not None:
+                self._decodeRaw(encoding)
+
+            if self._decoded is None:
+                self.raw.seek(0, 0)
+                self._content = self.raw
+            else:
+                self._content = self._decoded
+
+        return self._content
+
+
+    def _decodeRaw(self, encoding):
+        """
+        Decompresses the received body. If it can't be decompressed, it is
+        left as it is.
+        """
+        father = self.client.father
+        decoded = SpillingBuffer(father.bufferThreshold, father.bufferBudget)
+        try:
+            _decode(self.raw.view(), encoding, decoded,
+                    father.maxDecodedBytes)
+        except zlib.error:
+            decoded.close()
+            return
+        except DecodedBodyTooLarge:
+            decoded.close()
+            raise
+
+        decoded.seek(0, 0)
+        self._decoded = decoded
+        self._decodedChanges = decoded.changes
+
+
+    @content.setter
+    def content(self, content):
+        self._content = content
+
+
+    def body(self, compressionLevel):
+        """
+        Gets the body to send to the client, fixing up the ``Content-Length``
+        and ``Content-Encoding`` headers if it was changed.
+
+        A changed body that was compressed is compressed again with the
+        given compression level, or sent uncompressed if that is ``None``.
+
+        The body is returned as a string, or as a memory map of the buffered
+        body if it was spilled to disk.
+        """
+        content = self._content
+        if content is None or content is self.raw:
+            return self.raw.view()
+        elif (content is self._decoded
+              and content.changes == self._decodedChanges):
+            return self.raw.view()
+
+        if isinstance(content, SpillingBuffer):
+            body = content.view()
+        else:
+            content.seek(0, 0)
+            body = content.read()
+
+        if self._contentEncoding() is None:
+            self.headers.setRawHeaders("content-length", [str(len(body))])
+            return body
+        elif compressionLevel is None:
+            self.headers.removeHeader("content-encoding")
+        else:
+            body = _encode(body, self._contentEncoding(), compressionLevel)
+        self.headers.setRawHeaders("content-length", [str(len(body))])
+        return body
+
+
+    def close(self):
+        """
+        Discards the buffered bodies.
+        """
+        self.raw.close()
+        if self._decoded is not None:
+            self._decoded.close()
+
+
+
+class StreamingMangler(object):
+    """
+    A response mangler that mangles the response body while it is being
+    received, instead of after it has been received in full.
+
+    Streaming manglers are used by subclassing this class and passing the
+    subclass as the response mangler. It is instantiated for each response
+    once the headers have been received, so the initializer can still
+    modify the response headers. Mangled parts are sent to the client right
+    away.
+    """
+    streaming = True
 
+    def __init__(self, response):
+        self.response = response
+
+
+    def mangle(self, part):
+        """
+        Mangles a part of the response body.
+
+        Returns the data that should be sent to the client, which may be
+        empty.
+        """
+        return part
+
+
+    def finish(self):
+        """
+        Called when the entire response body has been received.
+
+        Returns any remaining data that should be sent to the client.
+        """
+        return ""
+
+
+
+def mangles(contentTypes=None, maxLength=None, codes=None, predicate=None):
+    """
+    Decorator to declare which responses a response mangler mangles, based
+    on the response code and headers.
+
+    Only responses with one of the given content types (ignoring
+    parameters), a ``Content-Length`` that is at most ``maxLength`` (or no
+    ``Content-Length``), one of the given response codes, and for which
+    ``predicate(code, headers)`` is true are mangled. Other responses are
+    passed through to the client as they are received, without buffering.
+    """
+    if contentTypes is not None:
+        contentTypes = frozenset(t.lower() for t in contentTypes)
+    if codes is not None:
+        codes = frozenset(codes)
+
+    def matches(code, headers):
+        if codes is not None and code not in codes:
+            return False
+
+        if contentTypes is not None:
+            contentType = headers.getRawHeaders("content-type", [""])[-1]
+            mediaType = contentType.split(";", 1)[0].strip().lower()
+            if mediaType not in contentTypes:
+                return False
+
+        if maxLength is not None:
+            length = headers.getRawHeaders("content-length")
+            if length is not None:
+                try:
+                    if int(length[-1]) > maxLength:
+                        return False
+                except ValueError:
+                    pass
+
+        return predicate is None or predicate(code, headers)
+
+    def decorator(mangler):
+        if isinstance(mangler, type):
+            mangler.predicate = staticmethod(matches)
+        else:
+            mangler.predicate = matches
+        return mangler
+
+    return decorator
 
 
 def onlyWhenMangling(f):
@@ -39,21 +328,67 @@ def onlyWhenMangling(f):
 class MinitrueClient(proxy.ProxyClient):
     """
     Client that makes a request on behalf of this proxy server.
+
+    If the factory that built this client has a connection pool, the
+    request is made over a persistent HTTP/1.1 connection, which is handed
+    back to the pool once the response has been received.
     """
+    factory = None
+    keepAlive = False
+    chunkedBody = False
+    _reused = False
+    _sendingBody = False
+    _relaying = False
+    replayChunkSize = 64 * 1024
+    _buffered = 0
+    _deadline = None
+
     def __init__(self, father, command, rest, headers, content, mangler=None):
+        self._prepare(father, command, rest, headers, content, mangler)
+
+
+    def _prepare(self, father, command, rest, headers, content, mangler):
+        """
+        Prepares this client to make a request, and resets the state for
+        parsing the response to it.
+        """
         self.father = father
         self.command = command
         self.rest = rest
         self._setScrubbedHeaders(headers)
         self.content = content
         self.mangler = mangler
+        self.streaming = getattr(mangler, "streaming", False)
+        self.stream = None
         if mangler is not None:
             self.response = _Response(self)
 
+        self._finished = False
+        self.firstLine = True
+        self.length = None
+        self._header = ""
+        self._code = None
+        self._responseVersion = None
+        self._connectionTokens = ()
+        self._decoder = None
+        self._delimited = False
+        self._sent = self._firstByte = None
+        self._recording = None
+
+
+    def reuse(self, *args):
+        """
+        Makes another request over this (idle, persistent) connection.
+        """
+        self._prepare(*args)
+        self._reused = True
+        self.setLineMode()
+        self._sendRequest()
+
 
     def _setScrubbedHeaders(self, headers):
-        if "proxy-connection" in headers:
-            del headers["proxy-connection"]
+        for header in _hopByHopHeaders:
+            headers.pop(header, None)
         headers["connection"] = "close"
 
         self.headers = headers
@@ -65,11 +400,86 @@ class MinitrueClient(proxy.ProxyClient):
 
         This forwards the request data to the remote server.
         """
+        self.father.metrics.recordSince("connect", self.father._connecting)
+        highWaterMark = getattr(self.father.channel, "highWaterMark", None)
+        if highWaterMark is not None:
+            self.transport.bufferSize = highWaterMark
+        self._sendRequest()
+
+
+    def _sendRequest(self):
+        """
+        Forwards the request to the remote server.
+        """
+        self.keepAlive = getattr(self.factory, "pool", None) is not None
+        if self.keepAlive:
+            self.headers["connection"] = "keep-alive"
+
+        streamed = isinstance(self.content, _RequestBodyStream)
+        self.chunkedBody = streamed and self.content.length is None
+        if self.chunkedBody:
+            self.headers["transfer-encoding"] = "chunked"
+
         self.sendCommand(self.command, self.rest)
         self._sendHeaders()
         self._sendRequestBody()
 
 
+    def _startPhase(self, phase):
+        """
+        Starts the deadline of a phase of receiving the response, stopping
+        that of the previous phase.
+        """
+        self._stopPhase()
+        deadlines = self.father.deadlines
+        self._deadline = deadlines.schedule(phase, self._deadlineExceeded,
+                                            phase)
+
+
+    def _stopPhase(self):
+        if self._deadline is not None:
+            if self._deadline.active():
+                self._deadline.cancel()
+            self._deadline = None
+
+
+    def _deadlineExceeded(self, phase):
+        """
+        Gives up on the response, because a phase took too long.
+        """
+        self._deadline = None
+        self.abort()
+        self.father._deadlineExceeded(phase)
+
+
+    def abort(self):
+        """
+        Gives up on the response, and closes the connection to the server.
+        """
+        if self._finished:
+            return
+        self._finished = True
+        self._stopPhase()
+        self._stopRelaying()
+        self._stopRecording(False)
+        if self.mangler is not None and not self.streaming:
+            self._releaseBuffer(None)
+
+        self.keepAlive = False
+        self._releaseConnection()
+
+
+    def sendCommand(self, command, path):
+        """
+        Sends the request line, using HTTP/1.1 for persistent connections and
+        chunked request bodies.
+        """
+        useHTTP11 = self.keepAlive or self.chunkedBody
+        version = "HTTP/1.1" if useHTTP11 else "HTTP/1.0"
+        self.transport.writeSequence([command, " ", path, " ", version,
+                                      "\r\n"])
+
+
     def _sendHeaders(self):
         """
         Sends the headers to the server.
@@ -83,61 +493,452 @@ class MinitrueClient(proxy.ProxyClient):
     def _sendRequestBody(self):
         """
         Sends the request body to the server.
+
+        Streamed request bodies are sent as they are received instead.
         """
+        if isinstance(self.content, _RequestBodyStream):
+            self._sendingBody = True
+            self.content.attach(self)
+            return
+
         self.content.seek(0, 0)
         data = self.content.read()
         self.transport.write(data)
+        self._requestSent()
+
+
+    def _requestSent(self):
+        """
+        Starts waiting for the response, now that all of the request has been
+        sent, unless it has already started.
+        """
+        if self._firstByte is None and not self._finished:
+            self._sent = time.time()
+            self._startPhase("firstByte")
+
+
+    def writeBody(self, data):
+        """
+        Sends a part of a streamed request body to the server.
+        """
+        if not data:
+            return
+        elif self.chunkedBody:
+            self.transport.writeSequence(http.toChunk(data))
+        else:
+            self.transport.write(data)
+
+
+    def finishBody(self):
+        """
+        Called when all of a streamed request body has been sent.
+        """
+        self._sendingBody = False
+        if self.chunkedBody:
+            self.transport.write("0\r\n\r\n")
+
+        if self.transport.producer is not None:
+            self.transport.unregisterProducer()
+
+        self._requestSent()
+
+
+    def dataReceived(self, data):
+        """
+        Receives data from the server, dropping the connection if it sends
+        anything when no response is expected.
+        """
+        if self._finished:
+            self.transport.loseConnection()
+            return
+
+        proxy.ProxyClient.dataReceived(self, data)
+
+
+    def lineReceived(self, line):
+        """
+        Parses the status line and headers, and sets up for reading the
+        response body once the headers have been received.
+        """
+        proxy.ProxyClient.lineReceived(self, line)
+        if not self.line_mode and not self._finished:
+            self._startBody()
+
+
+    def _startBody(self):
+        """
+        Figures out how the response body is delimited.
+        """
+        noBody = (self.command == "HEAD" or self._code in (204, 304)
+                  or 100 <= self._code < 200)
+        if self._decoder is not None:
+            self.length = None
+
+        self._delimited = (noBody or self.length is not None
+                           or self._decoder is not None)
+        if noBody or self.length == 0:
+            self.handleResponseEnd()
+
+
+    def rawDataReceived(self, data):
+        """
+        Receives a part of the response body.
+        """
+        if self._decoder is None:
+            proxy.ProxyClient.rawDataReceived(self, data)
+            return
+
+        try:
+            self._decoder.dataReceived(data)
+        except http._MalformedChunkedDataError:
+            self.keepAlive = False
+            self.transport.loseConnection()
+
+
+    def _chunkedBodyFinished(self, rest):
+        """
+        Called when the last chunk of a chunked response body is received.
+        """
+        self.handleResponseEnd()
 
 
-    @onlyWhenMangling
     def handleStatus(self, version, code, message):
-        self.response.code = int(code)
+        self._firstByte = time.time()
+        self._startPhase("download")
+        self.father.metrics.recordSince("firstByte", self._sent)
+
+        self._responseVersion = version
+        self._code = int(code)
+        if self.mangler is not None:
+            self.response.code = self._code
+
         proxy.ProxyClient.handleStatus(self, version, code, message)
 
 
-    @onlyWhenMangling
+    def handleHeader(self, key, value):
+        """
+        Handles a response header.
+
+        Hop-by-hop headers are interpreted here, and not passed on to the
+        client.
+        """
+        lowered = key.lower()
+        if lowered == "connection":
+            self._connectionTokens = [t.strip().lower()
+                                      for t in value.split(",")]
+        elif lowered == "transfer-encoding":
+            if value.strip().lower() == "chunked":
+                self._decoder = http._ChunkedTransferDecoder(
+                    self.handleResponsePart, self._chunkedBodyFinished)
+
+        if lowered not in _hopByHopHeaders:
+            proxy.ProxyClient.handleHeader(self, key, value)
+
+
     def handleEndHeaders(self):
         """
         Makes the response headers available on the response object.
+
+        If the mangler has a predicate (see ``mangles``) that doesn't match
+        the response, the response isn't mangled, and is passed through to
+        the client as it is received instead.
+
+        For streaming manglers, this starts mangling the response. Since the
+        length of the mangled body isn't known in advance, the
+        ``Content-Length`` header is dropped.
+
+        When the response is relayed to the client as it is received, the
+        connection to the server is paused while the client is slow to read.
+
+        If responses are being recorded, this starts recording the response,
+        before it is mangled.
         """
-        self.response.headers = self.father.responseHeaders
+        father = self.father
+        if father.recorder is not None:
+            self._recording = father.recorder.start(
+                father, self._code, father.code_message,
+                father.responseHeaders)
+
+        if self.mangler is not None:
+            predicate = getattr(self.mangler, "predicate", None)
+            if predicate is not None:
+                if not predicate(self._code, self.father.responseHeaders):
+                    self.father.metrics.increment("unmangled")
+                    self.mangler = self.response = None
+                    self.streaming = False
+
+        if self.mangler is not None:
+            self.response.headers = self.father.responseHeaders
+            if self.streaming:
+                self.response.headers.removeHeader("content-length")
+                self.stream = self.mangler(self.response)
+
+        if self.mangler is None or self.streaming:
+            self.father.registerProducer(self.transport, True)
+            self._relaying = True
 
 
-    @onlyWhenMangling
     def handleResponsePart(self, part):
         """
-        Saves a part of the response body.
+        Saves a part of the response body, or mangles it and sends it to the
+        client right away for streaming manglers. Without a mangler, it is
+        sent to the client as it is.
         """
-        self.response.content.write(part)
+        if self._recording is not None:
+            self._recording.write(part)
+
+        if self.mangler is None:
+            proxy.ProxyClient.handleResponsePart(self, part)
+        elif self.streaming:
+            self._writeMangled(self.stream.mangle(part))
+        else:
+            self.response.raw.write(part)
+            self._buffered += len(part)
+            self.father.metrics.increment("bufferedBytes", len(part))
+
+
+    def _writeMangled(self, data):
+        """
+        Sends some mangled data to the client.
+        """
+        if data:
+            self.father.write(data)
 
 
-    @onlyWhenMangling
     def handleResponseEnd(self):
         """
-        Mangles the received response, and then replays that response to
-        the client using the proxy.
+        Finishes the response, once it has been received in full.
 
-        Closes both the connection to the client and the server.
+        If there is a (non-streaming) response mangler, the received response
+        is mangled first (in a worker process, if mangling is offloaded), and
+        then replayed to the client.
+
+        The connection to the server is closed, or handed back to the pool.
         """
         if self._finished:
             return
         self._finished = True
+        self.father.upstreamComplete = True
+
+        metrics = self.father.metrics
+        metrics.recordSince("download", self._firstByte)
+        self._stopPhase()
+        self._stopRecording(True)
+        self._stopRelaying()
+        self._releaseConnection()
+
+        if self.mangler is None:
+            self.father.finish()
+            return
+        elif self.streaming:
+            if self.stream is not None:
+                self._writeMangled(self.stream.finish())
+            self.father.finish()
+            return
+
+        if self.father.offload is not None:
+            d = defer.maybeDeferred(self.father.offload.mangle, self.mangler,
+                                    self.response)
+        else:
+            d = self.father._callMangler(self.mangler, self.response)
+        d = self.father.deadlines.limit("responseMangler", d)
+        metrics.timeDeferred("responseMangler", d)
+        d.addCallbacks(self._replayContent, self._manglingFailed)
+        d.addBoth(self._releaseBuffer)
+
 
-        self.transport.loseConnection()
-        self.response.content.seek(0, 0)
-        d = defer.maybeDeferred(self.mangler, self.response)
-        d.addCallback(passthrough(self._replayContent))
-        d.addCallback(passthrough(self.father.transport.loseConnection))
+    def _stopRecording(self, complete):
+        """
+        Stops recording the response, keeping the recording only if the
+        response is complete.
+        """
+        if self._recording is not None:
+            recording, self._recording = self._recording, None
+            if complete:
+                recording.finish()
+            else:
+                recording.discard()
+
+
+    def _stopRelaying(self):
+        """
+        Stops relaying the response to the client, so the connection to the
+        server is no longer paused by the client.
+        """
+        if self._relaying:
+            self._relaying = False
+            self.father.unregisterProducer()
+            if self.transport.connected:
+                self.transport.resumeProducing()
+
+
+    def _isPersistent(self):
+        """
+        Checks if the connection to the server can be used for another
+        request.
+        """
+        return (self.keepAlive and self._responseVersion == "HTTP/1.1"
+                and "close" not in self._connectionTokens and self._delimited
+                and not self._sendingBody and self.transport.connected)
+
+
+    def _releaseConnection(self):
+        """
+        Hands the connection to the server back to the pool if possible, or
+        closes it otherwise.
+        """
+        if self._isPersistent():
+            self.factory.pool.release(self)
+        else:
+            if self._sendingBody:
+                self.content.detach()
+            if self.connected:
+                self.transport.loseConnection()
 
 
-    def _replayContent(self):
+    def connectionLost(self, reason):
+        """
+        Called when the connection to the server is lost.
+
+        If this was a reused connection that the server closed before it
+        started responding, the request is retried over a new connection, as
+        long as it can be (see ``_isRetryable``).
+
+        If the response body isn't delimited, this is where it ends. If it
+        is, and it hadn't been received in full, the response is incomplete:
+        it isn't mangled or sent to the client as if it were complete.
+        """
+        self.connected = False
+        self._stopPhase()
+        if self.keepAlive:
+            self.factory.pool.discard(self)
+
+            if (self._reused and self.firstLine and not self._finished
+                and self._isRetryable()):
+                self._finished = True
+                self.factory.retry()
+                return
+
+        if self._finished:
+            return
+        elif self._delimited or self.line_mode:
+            self.abort()
+            self.father._responseIncomplete()
+        else:
+            self.handleResponseEnd()
+
+
+    def _isRetryable(self):
+        """
+        Checks if the request can be made again: it must be idempotent, and
+        its body must not have been streamed to the server already.
+        """
+        if self.command not in _idempotentMethods:
+            return False
+        return not isinstance(self.content, _RequestBodyStream)
+
+
+    def _releaseBuffer(self, result):
+        """
+        Releases the buffered response.
+        """
+        self.response.close()
+        self.father.metrics.increment("bufferedBytes", -self._buffered)
+        self._buffered = 0
+        return result
+
+
+    def _manglingFailed(self, failure):
+        """
+        Sends an error response to the client, because mangling failed.
+        """
+        father = self.father
+        if failure.check(DeadlineExceeded):
+            father._deadlineExceeded(failure.value.phase)
+            return
+
+        log.err(failure, "Mangling the response failed")
+        if failure.check(offload.OffloadTimeout):
+            father.setResponseCode(http.GATEWAY_TIMEOUT)
+        else:
+            father.setResponseCode(http.BAD_GATEWAY)
+
+        body = "Mangling the response failed."
+        father.responseHeaders = http.Headers()
+        father.setHeader("content-type", "text/plain")
+        father.setHeader("content-length", str(len(body)))
+        father.write(body)
+        father.finish()
+
+
+    def _replayContent(self, _):
         """
         Replays the (potentially mangled) content of the response object.
+
+        The body is written in chunks, as the client reads it, so that bodies
+        that were spilled to disk aren't read into memory all at once. Since
+        the whole body is known, it is always sent with a ``Content-Length``,
+        so that the connection to the client can be kept alive.
+
+        Returns a deferred that fires when the response is finished.
         """
-        content = self.response.content
-        content.seek(0, 0)
-        self.father.write(content.read())
-        self.father.finish()
+        started = time.time()
+        father = self.father
+        body = self.response.body(father.compressionLevel)
+        if father.method != "HEAD" and self._code not in (204, 304):
+            father.setHeader("content-length", str(len(body)))
+        producer = _BodyProducer(self.father, body, self.replayChunkSize)
+        d = producer.start()
+        d.addCallback(lambda _: self.father.metrics.recordSince("replay",
+                                                                started))
+        return d
+
+
+
+class _BodyProducer(object):
+    """
+    A pull producer that writes a response body to the client in chunks,
+    and finishes the response.
+    """
+    implements(interfaces.IPullProducer)
+
+    def __init__(self, request, body, chunkSize):
+        self.request = request
+        self.body = body
+        self.chunkSize = chunkSize
+        self.offset = 0
+        self.done = defer.Deferred()
+
+
+    def start(self):
+        self.request.registerProducer(self, False)
+        return self.done
+
+
+    def resumeProducing(self):
+        if self.offset >= len(self.body):
+            return self._finish()
+
+        chunk = self.body[self.offset:self.offset + self.chunkSize]
+        self.offset += len(chunk)
+        self.request.write(chunk)
+
+
+    def _finish(self):
+        if self.done.called:
+            return
+        self.request.unregisterProducer()
+        self.request.finish()
+        self.done.callback(None)
+
+
+    def stopProducing(self):
+        """
+        Stops writing, because the connection to the client was lost.
+        """
+        self.offset = len(self.body)
+        if not self.done.called:
+            self.done.callback(None)
 
 
 
@@ -147,6 +948,9 @@ class MinitrueClientFactory(proxy.ProxyClientFactory):
     """
     protocol = MinitrueClient
     noisy = False
+    pool = None
+    poolKey = None
+    contextFactory = None
 
     def __init__(self, father, method, path, headers, content, mangler=None):
         self.father = father
@@ -154,7 +958,153 @@ class MinitrueClientFactory(proxy.ProxyClientFactory):
 
 
     def buildProtocol(self, _):
-        return self.protocol(*self.protocolArgs)
+        p = self.protocol(*self.protocolArgs)
+        p.factory = self
+        return p
+
+
+    def reuse(self, protocol):
+        """
+        Makes the request over an existing, idle connection.
+        """
+        protocol.factory = self
+        protocol.reuse(*self.protocolArgs)
+
+
+    def clientConnectionFailed(self, connector, reason):
+        """
+        Tells the client that the connection to the remote server failed, or
+        took longer than its deadline.
+        """
+        if reason.check(error.TimeoutError):
+            self.father._deadlineExceeded("connect")
+        else:
+            proxy.ProxyClientFactory.clientConnectionFailed(self, connector,
+                                                            reason)
+
+
+    def retry(self):
+        """
+        Makes the request again, over a new connection.
+        """
+        host, port = self.poolKey
+        self.pool.created += 1
+        self.father._openConnection(host, port, self)
+
+
+
+class _RequestBodyStream(object):
+    """
+    The body of a request that is relayed to the server while it is being
+    received from the client.
+
+    Parts of the body that arrive before the connection to the server has
+    been made are kept until it has. This is also a push producer for the
+    transport to the server: when the server is slow to read the body, this
+    stops reading from the client.
+    """
+    consumer = None
+    done = False
+
+    def __init__(self, request, length):
+        self.request = request
+        self.length = length
+        self.transport = request.channel.transport
+        self._parts = []
+        self._notifications = []
+
+        self.transport.pauseProducing()
+
+
+    def write(self, data):
+        """
+        Receives a part of the body from the client.
+        """
+        if self.consumer is not None:
+            self.consumer.writeBody(data)
+        elif self._parts is not None:
+            self._parts.append(data)
+
+
+    def finish(self):
+        """
+        Called when the entire body has been received from the client.
+        """
+        self.done = True
+        if self.consumer is not None:
+            self.consumer.finishBody()
+            self.consumer = None
+
+        for d in self._notifications:
+            d.callback(None)
+        self._notifications = []
+
+
+    def notifyDone(self):
+        """
+        Returns a deferred that fires once the entire body has been received.
+        """
+        d = defer.Deferred()
+        if self.done:
+            d.callback(None)
+        else:
+            self._notifications.append(d)
+        return d
+
+
+    def attach(self, client):
+        """
+        Starts relaying the body to a client connected to the server.
+        """
+        parts, self._parts = self._parts, None
+        for part in parts:
+            client.writeBody(part)
+
+        if self.done:
+            client.finishBody()
+        else:
+            self.consumer = client
+            client.transport.registerProducer(self, True)
+            self.transport.resumeProducing()
+
+
+    def detach(self):
+        """
+        Stops relaying the body, and drains the rest of it from the client.
+        """
+        consumer, self.consumer = self.consumer, None
+        self._parts = None
+        if consumer is not None and consumer.transport.producer is self:
+            consumer.transport.unregisterProducer()
+
+        self.transport.resumeProducing()
+
+
+    def pauseProducing(self):
+        if self.consumer is not None:
+            self.transport.pauseProducing()
+
+
+    def resumeProducing(self):
+        if self.consumer is not None:
+            self.transport.resumeProducing()
+
+
+    def stopProducing(self):
+        self.detach()
+
+
+    def seek(self, offset, whence=0):
+        pass
+
+
+    def read(self, size=-1):
+        return ""
+
+
+    def close(self):
+        if not self.done:
+            self.detach()
 
 
 
@@ -174,38 +1124,470 @@ class MinitrueRequest(proxy.ProxyRequest):
     """
     A request made to a proxy server that forwards that request to a remote
     server on behalf of the client.
+
+    ``upstreamComplete`` is set once the response of the remote server has
+    been received in full.
     """
-    protocols = {'http': MinitrueClientFactory}
+    protocols = {'http': MinitrueClientFactory,
+                 'https': MinitrueClientFactory}
+    ports = {'http': 80, 'https': 443}
     mangler = None
-
-    def __init__(self, channel, queued, responseMangler):
+    bodyStream = None
+    recorded = None
+    _connecting = None
+    _keepAlive = False
+    flight = None
+    upstreamComplete = False
+
+    def __init__(self, channel, queued, responseMangler, pool=None,
+                 streamBodies=False, resolver=None, cache=None, metrics=None,
+                 offload=None, compressionLevel=6, bufferThreshold=1024 * 1024,
+                 bufferBudget=None, tunnelIdleTimeout=300, interceptor=None,
+                 collapser=None, admission=None, deadlines=None,
+                 recorder=None, replayer=None, profiler=None,
+                 maxDecodedBytes=None, connectPorts=None,
+                 clientContexts=None):
         proxy.ProxyRequest.__init__(self, channel, queued)
         self.responseMangler = responseMangler
+        self.pool = pool
+        self.streamBodies = streamBodies
+        self.resolver = resolver
+        self.cache = cache
+        self.metrics = nullMetrics if metrics is None else metrics
+        self.offload = offload
+        self.compressionLevel = compressionLevel
+        self.bufferThreshold = bufferThreshold
+        self.bufferBudget = bufferBudget
+        self.tunnelIdleTimeout = tunnelIdleTimeout
+        self.interceptor = interceptor
+        self.collapser = collapser
+        self.admission = admission
+        self.deadlines = Deadlines() if deadlines is None else deadlines
+        self.recorder = recorder
+        self.replayer = replayer
+        self.profiler = profiler
+        self.maxDecodedBytes = maxDecodedBytes
+        self.connectPorts = connectPorts
+        self.clientContexts = clientContexts
+        self.context = RequestContext(self)
+        self._recordedLength = 0
+
+
+    def gotLength(self, length):
+        """
+        Called when the headers have been received.
+
+        If request bodies are streamed, and this request has a body, this
+        starts processing the request immediately, instead of when the body
+        has been received.
+        """
+        if not self.streamBodies or length == 0:
+            proxy.ProxyRequest.gotLength(self, length)
+            return
+
+        self.content = self.bodyStream = _RequestBodyStream(self, length)
+
+        channel = self.channel
+        self.method, self.uri = channel._command, channel._path
+        self.clientproto = channel._version
+        self.path = self.uri.split("?", 1)[0]
+        self.args = {}
+        self.client = channel.transport.getPeer()
+        self.host = channel.transport.getHost()
+
+        self.process()
+
+
+    def requestReceived(self, command, path, version):
+        """
+        Called when the request has been received in full.
+        """
+        if self.bodyStream is None:
+            proxy.ProxyRequest.requestReceived(self, command, path, version)
+        else:
+            self.bodyStream.finish()
+
+
+    def finish(self):
+        """
+        Finishes the response.
+
+        The response is stored in the cache (if there is one, and it is
+        cacheable) only if the response of the remote server was complete.
+
+        If the request body is streamed, the response isn't finished until
+        the rest of the body has been received (and discarded), so that it
+        isn't mistaken for the next request.
+        """
+        if self.recorded is not None:
+            recorded, self.recorded = self.recorded, None
+            if self.upstreamComplete:
+                self.cache.store(self, "".join(recorded))
+
+        if self.flight is not None:
+            flight, self.flight = self.flight, None
+            flight.finish()
+
+        if self.bodyStream is None or self.bodyStream.done:
+            proxy.ProxyRequest.finish(self)
+        else:
+            self.bodyStream.detach()
+            d = self.bodyStream.notifyDone()
+            d.addCallback(lambda _: proxy.ProxyRequest.finish(self))
 
 
     def process(self):
         """
         Processes this request.
+
+        ``CONNECT`` requests are tunnelled (or intercepted), without being
+        mangled.
         """
-        if self.mangler is not None:
-            d = defer.maybeDeferred(self.mangler, self)
+        self._trackInFlight()
+
+        intercepted = self.channel.intercepted
+        if intercepted is not None and self.uri.startswith("/"):
+            self.uri = "https://%s:%d%s" % (intercepted + (self.uri,))
+
+        if self.method == "CONNECT":
+            self._tunnel()
+        elif self.mangler is not None:
+            d = self._callMangler(self.mangler, self)
+            d = self.deadlines.limit("requestMangler", d)
+            self.metrics.timeDeferred("requestMangler", d)
             d.addCallback(passthrough(self._finishProcessing))
+            d.addErrback(self._requestManglingFailed)
         else:
             self._finishProcessing()
 
 
+    def _callMangler(self, mangler, *args):
+        """
+        Calls a mangler, profiling it if there is a profiler.
+        """
+        if self.profiler is None:
+            return defer.maybeDeferred(mangler, *args)
+        return self.profiler.call(mangler, *args)
+
+
+    def _requestManglingFailed(self, failure):
+        failure.trap(DeadlineExceeded)
+        self._deadlineExceeded(failure.value.phase)
+
+
+    def _deadlineExceeded(self, phase):
+        """
+        Gives up on this request, because a phase took longer than its
+        deadline.
+        """
+        self.metrics.increment("timeout:" + phase)
+        body = "The %s deadline was exceeded." % (phase,)
+        self._giveUp(http.GATEWAY_TIMEOUT, body)
+
+
+    def _responseIncomplete(self):
+        """
+        Gives up on this request, because the connection to the remote
+        server was lost before its response was received in full.
+        """
+        self.metrics.increment("incomplete")
+        body = "The response from the remote server was incomplete."
+        self._giveUp(http.BAD_GATEWAY, body)
+
+
+    def _giveUp(self, code, body):
+        """
+        Sends an error response to the client, or if the response was
+        already being sent, closes its connection so that it can tell the
+        response is incomplete.
+        """
+        if self.finished or self._disconnected:
+            return
+        elif self.startedWriting:
+            self.channel.transport.loseConnection()
+            return
+
+        self.setResponseCode(code)
+        self.responseHeaders = http.Headers()
+        self.setHeader("content-type", "text/plain")
+        self.setHeader("content-length", str(len(body)))
+        self.write(body)
+        self.finish()
+
+
+    def _tunnel(self):
+        """
+        Opens a tunnel to the host and port in the URI of this ``CONNECT``
+        request, if that port is allowed.
+
+        Data the client sends while the connection to the remote server is
+        being made is held until it has been made.
+        """
+        host, _, port = self.uri.rpartition(":")
+        host = host.strip("[]")
+        if not host or not port.isdigit():
+            self.setResponseCode(http.BAD_REQUEST)
+            self.finish()
+            return
+        elif not self._connectAllowed(int(port)):
+            self._refuseTunnel(port)
+            return
+
+        if self.interceptor is not None:
+            self._intercept(host, int(port))
+            return
+
+        channel = self.channel
+        tunnel = channel.tunnel = TunnelProtocol(self, self.tunnelIdleTimeout)
+        channel.setRawMode()
+        channel.transport.pauseProducing()
+        self._openConnection(host, int(port), TunnelFactory(tunnel))
+
+
+    def _connectAllowed(self, port):
+        return self.connectPorts is None or port in self.connectPorts
+
+
+    def _refuseTunnel(self, port):
+        """
+        Tells the client that tunnelling to the port isn't allowed.
+        """
+        channel = self.channel
+        self.metrics.increment("connectRefused")
+        self.setResponseCode(http.FORBIDDEN)
+        self.setHeader("content-type", "text/plain")
+        self.write("Tunnelling to port %s is not allowed." % (port,))
+        self.finish()
+        channel.transport.loseConnection()
+
+
+    def _intercept(self, host, port):
+        """
+        Terminates TLS for the host in the URI of this ``CONNECT`` request,
+        so that the requests made over the connection can be mangled.
+
+        Those requests have URIs relative to the host, which are made
+        absolute with the host and port.
+        """
+        channel = self.channel
+        channel.intercepted = host, port
+        contextFactory = self.interceptor.serverContextFactory(host)
+
+        status = "%s 200 Connection established\r\n\r\n" % (self.clientproto,)
+        channel.transport.write(status)
+        self.startedWriting = True
+        channel.persistent = True
+        self.finish()
+
+        channel.transport.startTLS(contextFactory)
+        self.metrics.increment("intercepted")
+
+
+    def _tunnelFailed(self, reason):
+        """
+        Tells the client that the tunnel couldn't be opened.
+        """
+        channel = self.channel
+        channel.tunnel = None
+        self.setResponseCode(http.BAD_GATEWAY)
+        self.setHeader("content-type", "text/plain")
+        self.write("Could not connect to %s." % (self.uri,))
+        self.finish()
+        channel.transport.loseConnection()
+
+
+    def _trackInFlight(self):
+        """
+        Counts this request as in flight until it is done, and records how
+        long it took in total.
+        """
+        started = time.time()
+        self.metrics.increment("inFlight")
+
+        def done(_):
+            self.metrics.increment("inFlight", -1)
+            self.metrics.recordSince("total", started)
+
+        self.notifyFinish().addBoth(done)
+
+
+    def write(self, data):
+        """
+        Writes part of the response body, recording it if the response might
+        be cached, and sending it to identical requests that were collapsed
+        into this one.
+        """
+        if self._keepAlive and not self.startedWriting:
+            self._confirmKeepAlive()
+
+        if self.flight is not None:
+            if not self.flight.started:
+                self.flight.start()
+            self.flight.write(data)
+
+        if self.recorded is not None:
+            self._recordedLength += len(data)
+            if self._recordedLength > self.cache.maxEntryBytes:
+                self.recorded = None
+            else:
+                self.recorded.append(data)
+
+        proxy.ProxyRequest.write(self, data)
+
+
+    def _confirmKeepAlive(self):
+        """
+        Keeps the connection to an HTTP/1.0 client alive, if the end of the
+        response can be told without closing the connection.
+        """
+        headers = self.responseHeaders
+        if (headers.hasHeader("content-length") or self.method == "HEAD"
+            or self.code in (204, 304)):
+            self.setHeader("connection", "Keep-Alive")
+        else:
+            self.channel.persistent = False
+
+
+    def noLongerQueued(self):
+        """
+        Starts writing the response to a pipelined request.
+
+        A response that was being relayed while the request was queued had
+        its producer paused, so it is resumed here.
+        """
+        proxy.ProxyRequest.noLongerQueued(self)
+        if self.producer is not None and self.streamingProducer:
+            self.producer.resumeProducing()
+
+
     def _finishProcessing(self):
         """
         Finish processing the mangled request.
+
+        If there is a response cache, and it has a response for this request,
+        that response is sent instead. If an identical request is already
+        being forwarded, this request waits for its response instead.
+        """
+        if self.cache is not None and self.cache.lookup(self):
+            return
+        elif self.collapser is not None and self.collapser.join(self):
+            return
+
+        self._fetch()
+
+
+    def _fetch(self):
+        """
+        Forwards this request to the remote server, once it is admitted if
+        there is admission control.
         """
-        url = urlparse.urlsplit(self.uri)
+        url = self.context.split
+        if url.scheme == "https" and self.clientContexts is None:
+            self._notImplemented("Requests for https URLs need pyOpenSSL.")
+            return
+
         host, port = self._getHostAndPort(url.netloc, url.scheme)
         rest = _getRestOfURL(url)
         headers = self._buildHeaders(host)
         
         builder = self._getClientFactoryBuilder(url.scheme)
         clientFactory = builder(path=rest, headers=headers)
-        self.reactor.connectTCP(host, port, clientFactory)
+        if url.scheme == "https":
+            contextFactory = self.clientContexts.contextFactory(host)
+            clientFactory.contextFactory = contextFactory
+
+        if self.admission is None:
+            self._connect(host, port, clientFactory)
+        else:
+            d = self.admission.admit((host, port), self)
+            d.addCallbacks(lambda _: self._connect(host, port, clientFactory),
+                           self._overloaded)
+
+
+    def _notImplemented(self, body):
+        """
+        Tells the client that the proxy can't make this request.
+        """
+        self.setResponseCode(http.NOT_IMPLEMENTED)
+        self.setHeader("content-type", "text/plain")
+        self.setHeader("content-length", str(len(body)))
+        self.write(body)
+        self.finish()
+
+
+    def _overloaded(self, failure):
+        """
+        Tells the client that the request was rejected, because too many
+        requests to the remote server are waiting.
+        """
+        failure.trap(admission.Overloaded)
+        body = "Too many requests are waiting for %s." % (failure.value,)
+        self.setResponseCode(http.SERVICE_UNAVAILABLE)
+        self.setHeader("content-type", "text/plain")
+        self.setHeader("content-length", str(len(body)))
+        self.setHeader("retry-after", "1")
+        self.write(body)
+        self.finish()
+
+
+    def _connect(self, host, port, clientFactory):
+        """
+        Connects to the remote server, through the connection pool if there
+        is one.
+
+        When replaying a recording, the recorded response is used instead.
+        """
+        if self.replayer is not None:
+            if not self.replayer.replay(self, clientFactory):
+                self._notRecorded()
+            return
+
+        if self.pool is None or not self.pool.reuse(host, port, clientFactory):
+            self._openConnection(host, port, clientFactory)
+
+
+    def _notRecorded(self):
+        """
+        Tells the client that there is no recorded response to replay.
+        """
+        self.metrics.increment("notRecorded")
+        body = "No response to %s %s was recorded." % (self.method, self.uri)
+        self.setResponseCode(http.BAD_GATEWAY)
+        self.setHeader("content-type", "text/plain")
+        self.setHeader("content-length", str(len(body)))
+        self.write(body)
+        self.finish()
+
+
+    def _openConnection(self, host, port, clientFactory):
+        """
+        Opens a new connection to the remote server, which may take as long
+        as the ``connect`` deadline.
+
+        If there is a resolver, it is used to look up the host first. If the
+        client factory has a context factory, the connection uses TLS.
+        """
+        self._connecting = time.time()
+        contextFactory = getattr(clientFactory, "contextFactory", None)
+
+        timeout = self.deadlines.connect or 30
+
+        def connect(address):
+            if contextFactory is None:
+                self.reactor.connectTCP(address, port, clientFactory, timeout)
+            else:
+                self.reactor.connectSSL(address, port, clientFactory,
+                                        contextFactory, timeout)
+
+        if self.resolver is None:
+            connect(host)
+            return
+
+        def lookupFailed(failure):
+            clientFactory.clientConnectionFailed(None, failure)
+
+        d = self.resolver.getHostByName(host)
+        d.addCallbacks(connect, lookupFailed)
 
 
     def _getClientFactoryBuilder(self, scheme):
@@ -237,13 +1619,23 @@ class MinitrueRequest(proxy.ProxyRequest):
         """
         Builds the headers for the outgoing request.
 
-        This copies the incoming headers and sets the ``Host`` header if it
-        hasn't been set.
+        This takes the incoming headers (``getAllHeaders`` already builds a
+        new dictionary) and sets the ``Host`` header if it hasn't been set.
+        If the request body has already been received in full, it is sent
+        with a ``Content-Length`` header.
         """
-        headers = self.getAllHeaders().copy()
+        headers = self.getAllHeaders()
         if 'host' not in headers:
             headers["host"] = host
 
+        if self.bodyStream is not None:
+            return headers
+
+        self.content.seek(0, 2)
+        length = self.content.tell()
+        if length or 'content-length' in headers:
+            headers['content-length'] = str(length)
+
         return headers
 
 
@@ -254,12 +1646,72 @@ class Minitrue(proxy.Proxy):
     """
     requestFactoryClass = MinitrueRequest
 
+    highWaterMark = None
+    tunnel = None
+    intercepted = None
+
     def __init__(self, **kwargs):
         proxy.Proxy.__init__(self)
         self.requestMangler = kwargs.pop("requestMangler")
+        self.highWaterMark = kwargs.pop("highWaterMark", None)
         self.kwargs = kwargs
 
 
+    def connectionMade(self):
+        """
+        Limits how much data is buffered for writing to the client before the
+        producer of that data is paused.
+        """
+        proxy.Proxy.connectionMade(self)
+        if self.highWaterMark is not None:
+            self.transport.bufferSize = self.highWaterMark
+
+
+    def dataReceived(self, data):
+        """
+        Parses requests, or relays data through the tunnel once this
+        connection has become one.
+        """
+        if self.tunnel is None:
+            proxy.Proxy.dataReceived(self, data)
+        else:
+            self.tunnel.relayFromClient(data)
+
+
+    def rawDataReceived(self, data):
+        if self.tunnel is None:
+            proxy.Proxy.rawDataReceived(self, data)
+        else:
+            self.tunnel.relayFromClient(data)
+
+
+    def connectionLost(self, reason):
+        if self.tunnel is not None:
+            self.tunnel.clientConnectionLost()
+        proxy.Proxy.connectionLost(self, reason)
+
+
+    def checkPersistence(self, request, version):
+        """
+        Checks if the connection should be kept alive after the response to
+        a request.
+
+        Unlike ``HTTPChannel``, this also keeps connections to HTTP/1.0
+        clients that ask for it alive, as long as the responses have a
+        ``Content-Length`` (see ``MinitrueRequest._confirmKeepAlive``).
+        """
+        if version == "HTTP/1.0":
+            headers = request.requestHeaders
+            connection = (headers.getRawHeaders("connection", [])
+                          + headers.getRawHeaders("proxy-connection", []))
+            tokens = [token.strip().lower()
+                      for token in ",".join(connection).split(",")]
+            request._keepAlive = "keep-alive" in tokens
+            return request._keepAlive
+
+        return proxy.Proxy.checkPersistence(self, request, version)
+
+
     def requestFactory(self, *args, **kwargs):
         """
         Builds a new request by calling C{self.requestClass}.
@@ -276,19 +1728,128 @@ class Minitrue(proxy.Proxy):
 class MinitrueFactory(http.HTTPFactory):
     """
     A factory that builds proxies.
+
+    If a connection pool is given, requests are made to remote servers over
+    persistent connections from that pool.
+
+    If ``streamBodies`` is set, request bodies are relayed to the remote
+    server as they are received, instead of after they have been received in
+    full. Request manglers then can't read the request body.
+
+    If a resolver (such as a ``minitrue.resolver.CachingResolver``) is given,
+    it is used to look up the hosts of remote servers.
+
+    If a response cache (a ``minitrue.cache.ResponseCache``) is given,
+    cached responses are sent without contacting the remote server or
+    mangling the response again.
+
+    If metrics (a ``minitrue.metrics.Metrics``) are given, the phases of
+    each request are timed, and in-flight requests and buffered bytes are
+    counted.
+
+    If a process pool (a ``minitrue.offload.ProcessPool``) is given as
+    ``offload``, (non-streaming) response manglers are run in its worker
+    processes instead of in the reactor thread.
+
+    Compressed response bodies are decompressed for (non-streaming) response
+    manglers when they read them. Bodies they change are compressed again
+    with ``compressionLevel``, or sent uncompressed if it is ``None``.
+    Bodies that are larger than ``maxDecodedBytes`` once decompressed aren't
+    mangled; the client gets a 502 instead.
+
+    Response bodies buffered for mangling are kept in memory up to
+    ``bufferThreshold`` bytes each, and ``maxBufferedBytes`` bytes in total.
+    Larger bodies are spilled to temporary files.
+
+    Responses are written to clients as fast as they read them. At most
+    ``highWaterMark`` bytes are buffered for writing to each client; beyond
+    that, reading from the remote server is paused.
+
+    ``CONNECT`` requests are tunnelled to the remote server, if their port is
+    one of ``connectPorts`` (only 443 by default, or any port if it is
+    ``None``); others are answered with a 403. Tunnels are closed after
+    being idle for ``tunnelIdleTimeout`` seconds. If an interceptor (a
+    ``minitrue.intercept.CertificateAuthority``) is given, TLS connections
+    made through ``CONNECT`` requests are intercepted instead, and the
+    requests made over them are mangled like any other.
+
+    Requests for ``https`` URLs are made over TLS connections from
+    ``clientContexts`` (a ``minitrue.intercept.ClientContexts``), which
+    verify the certificates of remote servers. By default, they are
+    verified against the system's CA certificates. Without pyOpenSSL, such
+    requests are answered with a 501.
+
+    If a collapser (a ``minitrue.collapse.Collapser``) is given, concurrent
+    identical requests are collapsed into one, and share its response.
+
+    If admission control (a ``minitrue.admission.AdmissionControl``) is
+    given, it limits how many requests are forwarded at once. Requests over
+    its limits wait, or are answered with a 503 if too many are waiting.
+
+    If deadlines (a ``minitrue.deadlines.Deadlines``) are given, requests
+    whose phases take longer are given up on, and answered with a 504.
+
+    If a recorder (a ``minitrue.recording.Recorder``) is given, the responses
+    of remote servers are recorded before they are mangled. If a replayer
+    (a ``minitrue.recording.Replayer``) is given, recorded responses are
+    replayed (and mangled) instead of making requests to remote servers.
+
+    If a profiler (a ``minitrue.profiling.Profiler``) is given, calls to the
+    request and (non-streaming) response manglers are profiled. Manglers
+    that run in worker processes aren't.
     """
     protocol = Minitrue
     noisy = False
 
-    def __init__(self, requestMangler=None, responseMangler=None):
+    _requestOptions = ["responseMangler", "pool", "streamBodies", "resolver",
+                       "cache", "metrics", "offload", "compressionLevel",
+                       "bufferThreshold", "bufferBudget", "tunnelIdleTimeout",
+                       "interceptor", "collapser", "admission", "deadlines",
+                       "recorder", "replayer", "profiler", "maxDecodedBytes",
+                       "connectPorts", "clientContexts"]
+
+    def __init__(self, requestMangler=None, responseMangler=None, pool=None,
+                 streamBodies=False, resolver=None, cache=None, metrics=None,
+                 offload=None, compressionLevel=6, bufferThreshold=1024 * 1024,
+                 maxBufferedBytes=256 * 1024 * 1024, highWaterMark=64 * 1024,
+                 tunnelIdleTimeout=300, interceptor=None, collapser=None,
+                 admission=None, deadlines=None, recorder=None,
+                 replayer=None, profiler=None,
+                 maxDecodedBytes=64 * 1024 * 1024, connectPorts=(443,),
+                 clientContexts=None):
         http.HTTPFactory.__init__(self)
         self.requestMangler = requestMangler
         self.responseMangler = responseMangler
+        self.pool = pool
+        self.streamBodies = streamBodies
+        self.resolver = resolver
+        self.cache = cache
+        self.metrics = metrics
+        self.offload = offload
+        self.compressionLevel = compressionLevel
+        self.bufferThreshold = bufferThreshold
+        self.bufferBudget = BufferBudget(maxBufferedBytes)
+        self.highWaterMark = highWaterMark
+        self.tunnelIdleTimeout = tunnelIdleTimeout
+        self.interceptor = interceptor
+        self.collapser = collapser
+        self.admission = admission
+        self.deadlines = deadlines
+        self.recorder = recorder
+        self.replayer = replayer
+        self.profiler = profiler
+        self.maxDecodedBytes = maxDecodedBytes
+        self.connectPorts = connectPorts
+        if clientContexts is None and intercept.SSL is not None:
+            clientContexts = intercept.ClientContexts()
+        self.clientContexts = clientContexts
 
 
     def buildProtocol(self, _):
         """
         Creates a new proxy protocol instance to talk to the client.
         """
+        options = dict((name, getattr(self, name))
+                       for name in self._requestOptions)
         return self.protocol(requestMangler=self.requestMangler,
-                             responseMangler=self.responseMangler)
+                             highWaterMark=self.highWaterMark, **options)
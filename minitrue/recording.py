@@ -0,0 +1,252 @@
+"""
+Recording responses from remote servers, and replaying them without a
+network.
+
+Recordings are kept in two append-only files: the responses themselves,
+and an index with the method, URL, offset and length of each response, one
+per line. Responses are recorded as they are received, before they are
+mangled, so replayed responses go through the response mangler again.
+"""
+import json
+import mmap
+import os
+
+from zope.interface import implements
+
+from twisted.internet import error, interfaces, reactor
+from twisted.python import failure
+
+from minitrue.utils import SpillingBuffer
+
+
+def _indexPath(path):
+    return path + ".index"
+
+
+
+class _Recording(object):
+    """
+    A response that is being recorded.
+    """
+    def __init__(self, recorder, key, code, message, headers):
+        self.recorder = recorder
+        self.key = key
+        self.code = code
+        self.message = message
+        self.headers = [(name, value)
+                        for name, values in headers.getAllRawHeaders()
+                        for value in values
+                        if name.lower() != "content-length"]
+        self.body = SpillingBuffer()
+
+
+    def write(self, data):
+        self.body.write(data)
+
+
+    def finish(self):
+        self.recorder._append(self)
+        self.body.close()
+
+
+    def discard(self):
+        self.body.close()
+
+
+
+class Recorder(object):
+    """
+    Records the responses of remote servers to a file.
+
+    Responses are recorded when they have been received in full. Responses
+    that are cut short aren't recorded.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._data = open(path, "ab")
+        self._index = open(_indexPath(path), "ab")
+
+
+    def start(self, request, code, message, headers):
+        """
+        Starts recording the response to a request.
+        """
+        key = request.method, request.uri
+        return _Recording(self, key, code, message, headers)
+
+
+    def _append(self, recording):
+        lines = ["HTTP/1.1 %d %s" % (recording.code, recording.message)]
+        lines.extend("%s: %s" % header for header in recording.headers)
+        lines.append("Content-Length: %d" % (len(recording.body),))
+        head = "\r\n".join(lines) + "\r\n\r\n"
+
+        self._data.seek(0, os.SEEK_END)
+        offset = self._data.tell()
+        self._data.write(head)
+        if len(recording.body):
+            self._data.write(recording.body.view())
+        self._data.flush()
+
+        method, url = recording.key
+        entry = {"method": method, "url": url, "offset": offset,
+                 "length": len(head) + len(recording.body)}
+        self._index.write(json.dumps(entry) + "\n")
+        self._index.flush()
+
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+
+
+class _ReplayTransport(object):
+    """
+    A transport for a client that receives a recorded response instead of
+    connecting to the remote server.
+
+    Requests written to it are discarded. The response is fed to the client
+    in chunks, and is paused and resumed like the transport of a real
+    connection.
+    """
+    implements(interfaces.ITransport, interfaces.IPushProducer)
+
+    connected = True
+    disconnecting = False
+    producer = None
+    bufferSize = None
+    chunkSize = 64 * 1024
+
+    def __init__(self, protocol, view, reactor=reactor):
+        self.protocol = protocol
+        self.view = view
+        self.reactor = reactor
+        self.offset = 0
+        self.paused = False
+        self._feeding = None
+
+
+    def write(self, data):
+        pass
+
+
+    def writeSequence(self, data):
+        pass
+
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+    def getPeer(self):
+        return None
+
+
+    def getHost(self):
+        return None
+
+
+    def feed(self):
+        """
+        Feeds the response to the client until it's done, or paused.
+        """
+        self._feeding = None
+        while self.connected and not self.paused:
+            if self.offset >= len(self.view):
+                self.loseConnection()
+                return
+
+            chunk = self.view[self.offset:self.offset + self.chunkSize]
+            self.offset += len(chunk)
+            self.protocol.dataReceived(chunk)
+
+
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.connected and self._feeding is None:
+            self._feeding = self.reactor.callLater(0, self.feed)
+
+
+    def stopProducing(self):
+        self.loseConnection()
+
+
+    def loseConnection(self):
+        if not self.connected:
+            return
+        self.connected = False
+        if self._feeding is not None:
+            self._feeding.cancel()
+            self._feeding = None
+        reason = failure.Failure(error.ConnectionDone())
+        self.protocol.connectionLost(reason)
+
+
+
+class Replayer(object):
+    """
+    Replays recorded responses instead of making requests to remote servers.
+
+    The recording is memory mapped, and the responses are fed to the same
+    clients that would receive them from the remote servers. If a request
+    was recorded several times, the last response is replayed.
+    """
+    def __init__(self, path, reactor=reactor):
+        self.reactor = reactor
+        self.entries = {}
+        with open(_indexPath(path)) as index:
+            for line in index:
+                entry = json.loads(line)
+                key = (entry["method"].encode("ascii"),
+                       entry["url"].encode("utf-8"))
+                self.entries[key] = entry["offset"], entry["length"]
+
+        self._map = None
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+    def lookup(self, request):
+        """
+        Looks up the recorded response to a request, as a buffer over the
+        memory mapped recording, or ``None`` if there isn't one.
+        """
+        entry = self.entries.get((request.method, request.uri))
+        if entry is None or self._map is None:
+            return None
+        offset, length = entry
+        return buffer(self._map, offset, length)
+
+
+    def replay(self, request, clientFactory):
+        """
+        Feeds the recorded response to a request to a new client built by
+        the client factory.
+
+        Returns ``False`` if the request wasn't recorded.
+        """
+        view = self.lookup(request)
+        if view is None:
+            return False
+
+        protocol = clientFactory.buildProtocol(None)
+        transport = _ReplayTransport(protocol, view, self.reactor)
+        protocol.makeConnection(transport)
+        transport.resumeProducing()
+        return True
+
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
@@ -0,0 +1,117 @@
+"""
+Caching hostname resolution for connections to remote servers.
+"""
+from twisted.internet import abstract, defer, error, reactor
+from twisted.python import failure
+
+from minitrue.utils import LRUCache
+
+
+class CachingResolver(object):
+    """
+    A resolver that caches the results of looking up hostnames.
+
+    Successful lookups are cached for ``ttl`` seconds, failed ones for
+    ``negativeTTL`` seconds, unless a different TTL is given for a specific
+    entry. At most ``maxSize`` entries are kept. Concurrent lookups for the
+    same hostname share a single lookup.
+
+    Hostnames can be added up front with ``addHosts``, which is useful for
+    pinning hostnames to specific addresses, or for testing without a
+    network. The lookups themselves are done by ``resolver``, which defaults
+    to the reactor's resolver.
+
+    The same instance is meant to be shared by everything that connects to
+    remote servers in a process.
+    """
+    def __init__(self, ttl=300, negativeTTL=30, maxSize=10000, resolver=None,
+                 reactor=reactor):
+        self.ttl = ttl
+        self.negativeTTL = negativeTTL
+        self.resolver = resolver
+        self.reactor = reactor
+
+        self.cache = LRUCache(maxSize)
+        self._hosts = {}
+        self._pending = {}
+
+
+    def addHosts(self, hosts, ttl=None):
+        """
+        Adds a mapping of hostnames to addresses.
+
+        If no TTL is given, the entries never expire, and are never evicted.
+        """
+        for name, address in hosts.iteritems():
+            name = name.lower()
+            if ttl is None:
+                self._hosts[name] = address
+            else:
+                self._store(name, address, ttl)
+
+
+    def getHostByName(self, name):
+        """
+        Looks up the address of a hostname.
+
+        Returns a deferred that fires with the address.
+        """
+        if abstract.isIPAddress(name):
+            return defer.succeed(name)
+
+        name = name.lower()
+        if name in self._hosts:
+            return defer.succeed(self._hosts[name])
+
+        entry = self.cache.get(name)
+        if entry is not None:
+            result, expires = entry
+            if expires > self.reactor.seconds():
+                if isinstance(result, failure.Failure):
+                    return defer.fail(result)
+                return defer.succeed(result)
+
+            self.cache.invalidate(name)
+
+        d = defer.Deferred()
+        waiting = self._pending.get(name)
+        if waiting is None:
+            self._pending[name] = [d]
+            self._lookup(name)
+        else:
+            waiting.append(d)
+        return d
+
+
+    def _lookup(self, name):
+        """
+        Actually looks up a hostname, and caches the result.
+        """
+        if self.resolver is None:
+            d = self.reactor.resolve(name)
+        else:
+            d = self.resolver.getHostByName(name)
+
+        def found(address):
+            self._store(name, address, self.ttl)
+            return address
+
+        def failed(reason):
+            if not reason.check(error.DNSLookupError):
+                reason = failure.Failure(error.DNSLookupError(name))
+            self._store(name, reason, self.negativeTTL)
+            return reason
+
+        def notify(result):
+            for waiting in self._pending.pop(name):
+                if isinstance(result, failure.Failure):
+                    waiting.errback(result)
+                else:
+                    waiting.callback(result)
+
+        d.addCallbacks(found, failed)
+        d.addBoth(notify)
+
+
+    def _store(self, name, result, ttl):
+        self.cache[name] = result, self.reactor.seconds() + ttl
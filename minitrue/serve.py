@@ -0,0 +1,312 @@
+"""
+Running the proxy, optionally in several worker processes.
+
+The workers all accept connections on the same listening socket, which is
+opened before they are forked. They are supervised, and restarted when they
+die.
+"""
+import errno
+import os
+import signal
+import socket
+import sys
+import time
+
+# Importing the reactor here would create it in the supervising process,
+# and share its internal state with all workers. Anything that imports it
+# (including minitrue.proxy) is only imported in the workers.
+from twisted.python import log, reflect, usage
+
+
+def _ports(value):
+    return tuple(int(port) for port in value.split(","))
+
+
+
+class Options(usage.Options):
+    synopsis = "[options]"
+
+    optParameters = [
+        ["port", "p", 8080, "The port to listen on.", int],
+        ["interface", "i", "", "The interface to listen on."],
+        ["backlog", None, 128, "The size of the listen queue.", int],
+        ["workers", "w", 1, "The number of worker processes.", int],
+        ["request-mangler", None, None,
+         "The fully qualified name of the request mangler."],
+        ["response-mangler", None, None,
+         "The fully qualified name of the response mangler."],
+        ["offload", None, 0,
+         "The number of processes to run the response mangler in.", int],
+        ["compression-level", None, 6,
+         "The level to compress mangled bodies with again (0 to 9).", int],
+        ["intercept-ca", None, None,
+         "A PEM file with a CA certificate and key to intercept TLS with."],
+        ["certificate-cache", None, None,
+         "A directory to store intercepted hosts' certificates in."],
+        ["upstream-ca", None, None,
+         "A PEM file with the CA certificates to verify remote servers with "
+         "(default: the system's)."],
+        ["connect-ports", None, (443,),
+         "Comma separated ports that CONNECT requests may tunnel to.", _ports],
+        ["max-per-host", None, None,
+         "The most requests to forward to a remote server at once.", int],
+        ["max-requests", None, None,
+         "The most requests to forward at once.", int],
+        ["max-queued", None, 100,
+         "The most requests to queue per remote server.", int],
+        ["connect-timeout", None, None,
+         "How long connecting to a remote server may take.", float],
+        ["first-byte-timeout", None, None,
+         "How long a remote server may take to start responding.", float],
+        ["download-timeout", None, None,
+         "How long receiving the rest of a response may take.", float],
+        ["mangler-timeout", None, None,
+         "How long each request or response mangler may take.", float],
+        ["record", None, None,
+         "A file to record the responses of remote servers to."],
+        ["replay", None, None,
+         "A recording to replay, instead of contacting remote servers."],
+        ["profile-slow", None, None,
+         "Log mangler calls that take at least this many seconds.", float],
+        ["profile-sample", None, 0.0,
+         "The fraction of mangler calls to capture the stacks of.", float],
+        ["profile-stacks", None, None,
+         "A file to write captured stacks to, in folded format."],
+        ["shutdown-timeout", None, 10.0,
+         "How long to wait for open connections when shutting down.", float],
+    ]
+
+    optFlags = [
+        ["pool", None, "Use persistent connections to remote servers."],
+        ["stream-bodies", None, "Relay request bodies as they arrive."],
+        ["collapse", None, "Collapse concurrent identical requests."],
+    ]
+
+    def postOptions(self):
+        if self["workers"] < 1:
+            raise usage.UsageError("There must be at least one worker.")
+        elif self["record"] is not None and self["workers"] > 1:
+            raise usage.UsageError("Only one worker can record responses.")
+
+
+
+def listen(interface, port, backlog):
+    """
+    Opens a listening socket, to be shared by all workers.
+    """
+    family = socket.AF_INET6 if ":" in interface else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def buildFactory(options):
+    """
+    Builds a proxy factory as configured by the command line options.
+    """
+    from minitrue import admission, collapse, intercept, offload, pool, proxy
+    from minitrue import profiling, recording
+    from minitrue.utils import Combined
+    from minitrue.deadlines import Deadlines
+
+    manglers = {}
+    for kind in ["request", "response"]:
+        name = options[kind + "-mangler"]
+        if name is not None:
+            manglers[kind + "Mangler"] = reflect.namedAny(name)
+
+    if options["pool"]:
+        manglers["pool"] = pool.ConnectionPool()
+
+    if options["max-per-host"] or options["max-requests"]:
+        manglers["admission"] = admission.AdmissionControl(
+            options["max-per-host"], options["max-requests"],
+            options["max-queued"])
+
+    manglers["deadlines"] = Deadlines(
+        connect=options["connect-timeout"],
+        firstByte=options["first-byte-timeout"],
+        download=options["download-timeout"],
+        requestMangler=options["mangler-timeout"],
+        responseMangler=options["mangler-timeout"])
+
+    if options["record"] is not None:
+        manglers["recorder"] = recording.Recorder(options["record"])
+
+    if options["replay"] is not None:
+        manglers["replayer"] = recording.Replayer(options["replay"])
+
+    if options["profile-slow"] is not None or options["profile-sample"]:
+        profiler = manglers["profiler"] = profiling.Profiler(
+            options["profile-slow"], options["profile-sample"])
+        for kind in ["request", "response"]:
+            mangler = manglers.get(kind + "Mangler")
+            if isinstance(mangler, Combined) and mangler.profiler is None:
+                mangler.profiler = profiler
+
+    if options["collapse"]:
+        manglers["collapser"] = collapse.Collapser()
+
+    if options["intercept-ca"] is not None:
+        manglers["interceptor"] = intercept.CertificateAuthority(
+            options["intercept-ca"], options["certificate-cache"])
+
+    if options["upstream-ca"] is not None:
+        manglers["clientContexts"] = intercept.ClientContexts(
+            options["upstream-ca"])
+
+    if options["offload"]:
+        manglers["offload"] = offload.ProcessPool(size=options["offload"])
+
+    return proxy.MinitrueFactory(streamBodies=options["stream-bodies"],
+                                 compressionLevel=options["compression-level"],
+                                 connectPorts=options["connect-ports"],
+                                 **manglers)
+
+
+def runWorker(sock, options):
+    """
+    Serves the proxy on the shared listening socket until told to stop.
+
+    When told to stop, the worker stops accepting connections, and waits for
+    the open connections to close (for at most the shutdown timeout).
+    """
+    from twisted.internet import reactor
+    from twisted.protocols import policies
+
+    proxyFactory = buildFactory(options)
+    factory = policies.WrappingFactory(proxyFactory)
+    port = reactor.adoptStreamPort(sock.fileno(), sock.family, factory)
+    sock.close()
+
+    def shutdown():
+        port.stopListening()
+        deadline = time.time() + options["shutdown-timeout"]
+
+        def check():
+            if factory.protocols and time.time() < deadline:
+                reactor.callLater(0.1, check)
+            else:
+                reactor.stop()
+
+        check()
+
+    def stop(signum, frame):
+        reactor.callFromThread(shutdown)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    reactor.run(installSignalHandlers=False)
+
+    path = options["profile-stacks"]
+    if path is not None and proxyFactory.profiler is not None:
+        if options["workers"] > 1:
+            path = "%s.%d" % (path, os.getpid())
+        proxyFactory.profiler.dumpStacks(path)
+
+
+
+class Supervisor(object):
+    """
+    Supervises worker processes, restarting them when they die.
+
+    Workers that die quickly after starting are restarted after a delay, so
+    that a broken configuration doesn't turn into a fork loop.
+    """
+    minimumUptime = 1.0
+
+    def __init__(self, sock, options):
+        self.sock = sock
+        self.options = options
+        self.workers = {}
+        self.stopping = False
+
+
+    def spawn(self):
+        """
+        Starts a new worker process.
+
+        The worker doesn't keep the supervisor's signal handlers: until it
+        installs its own, signals just end it.
+        """
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 0
+            try:
+                runWorker(self.sock, self.options)
+            except:
+                log.err(None, "Worker failed")
+                status = 1
+            os._exit(status)
+
+        log.msg("Started worker %s" % (pid,))
+        self.workers[pid] = time.time()
+
+
+    def stop(self, signum=None, frame=None):
+        """
+        Tells all workers to stop.
+        """
+        self.stopping = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+
+    def run(self):
+        """
+        Starts the workers, and supervises them until they have all stopped.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for _ in range(self.options["workers"]):
+            self.spawn()
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            started = self.workers.pop(pid, None)
+            if started is None:
+                continue
+
+            log.msg("Worker %s exited with status %s" % (pid, status))
+            uptime = time.time() - started
+            if not self.stopping and uptime < self.minimumUptime:
+                time.sleep(self.minimumUptime)
+            if not self.stopping:
+                self.spawn()
+
+
+
+def main(argv=None):
+    """
+    Runs the proxy from the command line.
+    """
+    options = Options()
+    try:
+        options.parseOptions(sys.argv[1:] if argv is None else argv)
+    except usage.UsageError as e:
+        raise SystemExit("%s\n%s" % (options, e))
+
+    log.startLogging(sys.stdout)
+    sock = listen(options["interface"], options["port"], options["backlog"])
+    Supervisor(sock, options).run()
+
+
+
+if __name__ == "__main__":
+    main()
@@ -25,8 +25,8 @@ class _ProxyClientFactory(client.HTTPClientFactory):
 
 
 
-def getWithProxy(url, proxyHost, proxyPort, headers=None):
-    factory = _ProxyClientFactory(url, headers=headers)
+def getWithProxy(url, proxyHost, proxyPort, headers=None, **kwargs):
+    factory = _ProxyClientFactory(url, headers=headers, **kwargs)
     reactor.connectTCP(proxyHost, proxyPort, factory)
     return factory
 
@@ -39,8 +39,8 @@ class _HTTPClientFactory(client.HTTPClientFactory):
     gotHeaders = _gotHeaders
 
 
-def getWithoutProxy(url, headers=None):
-    factory = _HTTPClientFactory(url, headers=headers)
+def getWithoutProxy(url, headers=None, **kwargs):
+    factory = _HTTPClientFactory(url, headers=headers, **kwargs)
     splitURL = urlparse.urlsplit(url)
     host, port = splitURL.hostname, splitURL.port or 80
     reactor.connectTCP(host, port, factory)
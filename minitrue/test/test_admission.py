@@ -0,0 +1,141 @@
+"""
+Tests for admission control.
+"""
+from twisted.internet import defer, reactor
+from twisted.python import failure
+from twisted.trial.unittest import TestCase
+from twisted.web import resource, server
+from twisted.web.test.requesthelper import DummyRequest
+
+from minitrue import admission, metrics, proxy
+from minitrue.test.test_functional import ProxyTestMixin, buildTarget
+
+
+class AdmissionControlTest(TestCase):
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+        self.admitted = []
+
+
+    def request(self, control, key):
+        request = DummyRequest([])
+        request.metrics = self.metrics
+        d = control.admit(key, request)
+        d.addCallback(lambda _: self.admitted.append((key, request)))
+        return request, d
+
+
+    def test_perHost(self):
+        """
+        Requests over the limit for a remote server wait until one of its
+        requests is finished.
+        """
+        control = admission.AdmissionControl(maxPerHost=1)
+        first, _ = self.request(control, "minitrue")
+        second, _ = self.request(control, "minitrue")
+        other, _ = self.request(control, "miniluv")
+        self.assertEqual(self.admitted, [("minitrue", first),
+                                         ("miniluv", other)])
+        self.assertEqual(self.metrics.counters["admissionQueued"], 1)
+
+        first.finish()
+        self.assertEqual(self.admitted[-1], ("minitrue", second))
+        self.assertEqual(self.metrics.counters["admissionQueued"], 0)
+
+
+    def test_fair(self):
+        """
+        When a request finishes, the queues of the remote servers take turns.
+        """
+        control = admission.AdmissionControl(maxTotal=1)
+        running, _ = self.request(control, "minitrue")
+        for key in ["minitrue", "minitrue", "miniluv"]:
+            self.request(control, key)
+
+        running.finish()
+        running = self.admitted[-1][1]
+        running.finish()
+        self.assertEqual([key for key, _ in self.admitted],
+                         ["minitrue", "minitrue", "miniluv"])
+
+
+    def test_shed(self):
+        """
+        Requests that would make a queue too long are rejected.
+        """
+        control = admission.AdmissionControl(maxPerHost=1, maxQueued=1)
+        self.request(control, "minitrue")
+        self.request(control, "minitrue")
+        _, d = self.request(control, "minitrue")
+        self.assertFailure(d, admission.Overloaded)
+        self.assertEqual(self.metrics.counters["shed"], 1)
+        return d
+
+
+    def test_abandoned(self):
+        """
+        Waiting requests whose clients go away are forgotten.
+        """
+        control = admission.AdmissionControl(maxPerHost=1)
+        first, _ = self.request(control, "minitrue")
+        second, _ = self.request(control, "minitrue")
+        second.processingFailed(failure.Failure(Exception("Unpersoned")))
+        first.finish()
+        self.assertEqual(self.admitted, [("minitrue", first)])
+        self.assertEqual(control.hosts, {})
+
+
+
+class _Ministry(resource.Resource):
+    """
+    A ministry that answers when it is told to.
+    """
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.waiting = []
+
+
+    def render_GET(self, request):
+        self.waiting.append(request)
+        return server.NOT_DONE_YET
+
+
+
+class SheddingTest(ProxyTestMixin, TestCase):
+    def proxyConstructor(self):
+        control = admission.AdmissionControl(maxPerHost=1, maxQueued=0)
+        return proxy.MinitrueFactory(admission=control)
+
+
+    def buildTarget(self):
+        site = buildTarget()
+        self.ministry = _Ministry()
+        site.resource.putChild("ministry", self.ministry)
+        return site
+
+
+    @defer.inlineCallbacks
+    def test_shed(self):
+        """
+        Rejected requests are answered with a 503 right away.
+        """
+        first = self.get("/ministry").deferred
+        while not self.ministry.waiting:
+            yield self.wait(0.01)
+
+        factory = self.get("/ministry")
+        yield self.assertFailure(factory.deferred, Exception)
+        self.assertEqual(factory.status, "503")
+
+        request = self.ministry.waiting.pop()
+        request.write("Ready.")
+        request.finish()
+        self.assertEqual((yield first), "Ready.")
+
+
+    def wait(self, seconds):
+        d = defer.Deferred()
+        reactor.callLater(seconds, d.callback, None)
+        return d
@@ -0,0 +1,67 @@
+"""
+Tests for the benchmarks.
+"""
+from twisted.internet import defer, reactor
+from twisted.python import usage
+from twisted.trial.unittest import TestCase
+
+from minitrue import bench
+
+
+class OptionsTest(TestCase):
+    def parse(self, *argv):
+        options = bench.Options()
+        options.parseOptions(argv)
+        return options
+
+
+    def test_defaults(self):
+        options = self.parse()
+        self.assertEqual(options["configurations"],
+                         sorted(bench.configurations))
+        self.assertEqual(options["requests"], 1000)
+
+
+    def test_lists(self):
+        options = self.parse("--sizes", "1,2", "--concurrency", "3",
+                             "--configurations", "passthrough")
+        self.assertEqual(options["sizes"], [1, 2])
+        self.assertEqual(options["concurrency"], [3])
+        self.assertEqual(options["configurations"], ["passthrough"])
+
+
+    def test_serveTarget(self):
+        self.assertFalse(self.parse()["serve-target"])
+        self.assertTrue(self.parse("--serve-target")["serve-target"])
+
+
+    def test_unknownConfiguration(self):
+        self.assertRaises(usage.UsageError, self.parse,
+                          "--configurations", "doublethink")
+
+
+
+class LoadTest(TestCase):
+    def setUp(self):
+        self.target = reactor.listenTCP(0, bench.buildTarget(),
+                                        interface="127.0.0.1")
+        factory = bench.proxy.MinitrueFactory(
+            responseMangler=bench.responseMangler)
+        self.proxy = reactor.listenTCP(0, factory, interface="127.0.0.1")
+
+
+    def tearDown(self):
+        return defer.gatherResults([self.target.stopListening(),
+                                    self.proxy.stopListening()])
+
+
+    @defer.inlineCallbacks
+    def test_load(self):
+        url = "http://127.0.0.1:%d/bytes/10" % (self.target.getHost().port,)
+        body = yield bench.fetch(url, self.proxy.getHost().port)
+        self.assertEqual(body, "y" * 10)
+
+        latencies, failures = yield bench.load(url, self.proxy.getHost().port,
+                                               concurrency=3, requests=7)
+        self.assertEqual(len(latencies), 7)
+        self.assertEqual(failures, 0)
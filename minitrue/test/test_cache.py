@@ -0,0 +1,225 @@
+"""
+Tests for caching mangled responses.
+"""
+import time
+
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+from twisted.web import http, resource
+from twisted.web.test.requesthelper import DummyChannel
+
+from minitrue import cache, proxy
+from minitrue.utils import StringIO
+from minitrue.test.test_functional import ProxyTestMixin, buildTarget
+
+
+class _Speech(resource.Resource):
+    """
+    A speech by Big Brother, which doesn't change for a while.
+    """
+    def __init__(self, cacheControl, expires=None):
+        resource.Resource.__init__(self)
+        self.cacheControl = cacheControl
+        self.expires = expires
+        self.renders = 0
+
+
+    def render_GET(self, request):
+        self.renders += 1
+        if self.cacheControl is not None:
+            request.setHeader("Cache-Control", self.cacheControl)
+        if self.expires is not None:
+            expires = http.datetimeToString(time.time() + self.expires)
+            request.setHeader("Expires", expires)
+        request.setHeader("Vary", "Accept-Language")
+        language = request.getHeader("Accept-Language") or "newspeak"
+        return "We are at war with Eurasia (%s)." % (language,)
+
+
+
+class _CacheTestMixin(ProxyTestMixin):
+    expires = None
+
+    def proxyConstructor(self):
+        self.cache = cache.ResponseCache()
+        self.mangled = 0
+
+        def responseMangler(response):
+            self.mangled += 1
+            content = response.content.read()
+            replaced = content.replace("Eurasia", "Eastasia")
+            response.content = StringIO(replaced)
+
+        return proxy.MinitrueFactory(responseMangler=responseMangler,
+                                     cache=self.cache)
+
+
+    def buildTarget(self):
+        site = buildTarget()
+        self.speech = _Speech(self.cacheControl, self.expires)
+        site.resource.putChild("speech", self.speech)
+        return site
+
+
+    def getSpeech(self, language="newspeak"):
+        headers = {"Accept-Language": language}
+        return self.get("/speech", headers=headers).deferred
+
+
+    def verifyCounts(self, result, renders, mangled):
+        self.assertEqual(self.speech.renders, renders)
+        self.assertEqual(self.mangled, mangled)
+        return result
+
+
+
+class ResponseCacheTest(_CacheTestMixin, TestCase):
+    cacheControl = "max-age=60"
+
+    def test_cached(self):
+        """
+        Cached responses are sent without contacting the remote server or
+        mangling the response again.
+        """
+        d = self.getSpeech()
+        d.addCallback(lambda _: self.getSpeech())
+        expected = "We are at war with Eastasia (newspeak)."
+        d.addCallback(self.assertEqual, expected)
+        d.addCallback(self.verifyCounts, 1, 1)
+        d.addCallback(lambda _: self.assertEqual(self.cache.responses.hits, 1))
+        return d
+
+
+    def test_vary(self):
+        """
+        Responses are cached separately for each value of the headers they
+        vary on.
+        """
+        d = self.getSpeech()
+        d.addCallback(lambda _: self.getSpeech("oldspeak"))
+        d.addCallback(lambda content: self.assertIn("oldspeak", content))
+        d.addCallback(lambda _: self.getSpeech("oldspeak"))
+        d.addCallback(self.verifyCounts, 2, 2)
+        return d
+
+
+
+class UncacheableResponseTest(_CacheTestMixin, TestCase):
+    cacheControl = "no-store"
+
+    def test_notCached(self):
+        d = self.getSpeech()
+        d.addCallback(lambda _: self.getSpeech())
+        d.addCallback(self.verifyCounts, 2, 2)
+        return d
+
+
+
+class ExpiresTest(_CacheTestMixin, TestCase):
+    cacheControl = None
+    expires = 60
+
+    def test_cached(self):
+        """
+        Responses with an ``Expires`` header in the future are cached.
+        """
+        d = self.getSpeech()
+        d.addCallback(lambda _: self.getSpeech())
+        d.addCallback(self.verifyCounts, 1, 1)
+        return d
+
+
+
+class ExpiredTest(UncacheableResponseTest):
+    cacheControl = None
+    expires = -60
+
+
+
+class StoreTest(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = cache.ResponseCache(maxBytes=2048, reactor=self.clock)
+
+
+    def request(self, path):
+        request = proxy.MinitrueRequest(DummyChannel(), False, None,
+                                        cache=self.cache)
+        request.method, request.uri = "GET", "http://minitrue.test" + path
+        request.clientproto = "HTTP/1.1"
+        request.content = StringIO()
+        return request
+
+
+    def respond(self, path, size=512, complete=True):
+        """
+        Sends a response to a request, which is stored in the cache if it is
+        complete (or replayed from it).
+        """
+        request = self.request(path)
+        if not self.cache.lookup(request):
+            request.setHeader("cache-control", "max-age=60")
+            request.write("x" * size)
+            request.upstreamComplete = complete
+            request.finish()
+
+
+    def isCached(self, path):
+        return self.cache.lookup(self.request(path))
+
+
+    def test_incomplete(self):
+        """
+        Responses that weren't received from the remote server in full
+        aren't stored.
+        """
+        self.respond("/speech", complete=False)
+        self.assertEqual(len(self.cache.responses), 0)
+        self.assertFalse(self.isCached("/speech"))
+
+
+    def test_stale(self):
+        """
+        Responses aren't used anymore once they have expired.
+        """
+        self.respond("/speech")
+        self.clock.advance(59)
+        self.assertTrue(self.isCached("/speech"))
+        self.clock.advance(1)
+        self.assertFalse(self.isCached("/speech"))
+
+
+    def test_hopByHop(self):
+        """
+        Hop-by-hop headers aren't stored.
+        """
+        request = self.request("/speech")
+        self.cache.lookup(request)
+        request.setHeader("cache-control", "max-age=60")
+        request.setHeader("connection", "Keep-Alive")
+        request.setHeader("keep-alive", "timeout=5")
+        request.write("Big Brother is watching you")
+        request.upstreamComplete = True
+        request.finish()
+
+        replayed = self.request("/speech")
+        self.assertTrue(self.cache.lookup(replayed))
+        headers = replayed.responseHeaders
+        self.assertFalse(headers.hasHeader("connection"))
+        self.assertFalse(headers.hasHeader("keep-alive"))
+        self.assertTrue(headers.hasHeader("cache-control"))
+
+
+    def test_evicted(self):
+        """
+        The least recently used responses are evicted once the cached
+        responses take up more than ``maxBytes``.
+        """
+        self.respond("/speech")
+        self.respond("/slogan")
+        self.respond("/speech")
+        self.respond("/anthem")
+        self.assertTrue(self.cache.responses.size <= 2048)
+        self.assertFalse(self.isCached("/slogan"))
+        self.assertTrue(self.isCached("/anthem"))
+        self.assertTrue(self.isCached("/speech"))
@@ -0,0 +1,131 @@
+"""
+Tests for collapsing concurrent identical requests.
+"""
+from twisted.internet import defer, reactor
+from twisted.trial.unittest import TestCase
+from twisted.web import resource, server
+
+from minitrue import collapse, metrics, proxy
+from minitrue.utils import StringIO
+from minitrue.test.test_functional import ProxyTestMixin, buildTarget
+
+
+class _Announcement(resource.Resource):
+    """
+    An announcement from the Ministry of Plenty, which takes a while.
+    """
+    isLeaf = True
+
+    def __init__(self, vary=None):
+        resource.Resource.__init__(self)
+        self.vary = vary
+        self.renders = 0
+
+
+    def render_GET(self, request):
+        self.renders += 1
+        if self.vary is not None:
+            request.setHeader("Vary", self.vary)
+
+        language = request.getHeader("Accept-Language") or "newspeak"
+        body = "Production has increased by 98%% (%s)." % (language,)
+
+        def finish():
+            request.write(body)
+            request.finish()
+
+        reactor.callLater(0.1, finish)
+        return server.NOT_DONE_YET
+
+
+
+class _CollapseTestMixin(ProxyTestMixin):
+    predicate = None
+    vary = None
+
+    def proxyConstructor(self):
+        self.metrics = metrics.Metrics()
+        self.mangled = 0
+
+        def responseMangler(response):
+            self.mangled += 1
+            content = response.content.read()
+            response.content = StringIO(content.replace("98", "98.4"))
+
+        collapser = collapse.Collapser(self.predicate)
+        return proxy.MinitrueFactory(responseMangler=responseMangler,
+                                     collapser=collapser,
+                                     metrics=self.metrics)
+
+
+    def buildTarget(self):
+        site = buildTarget()
+        self.announcement = _Announcement(self.vary)
+        site.resource.putChild("announcement", self.announcement)
+        return site
+
+
+    def getAll(self, languages):
+        return defer.gatherResults([
+            self.get("/announcement",
+                     headers={"Accept-Language": language}).deferred
+            for language in languages])
+
+
+    def verifyCounts(self, result, renders, mangled, collapsed):
+        self.assertEqual(self.announcement.renders, renders)
+        self.assertEqual(self.mangled, mangled)
+        self.assertEqual(self.metrics.counters.get("collapsed", 0), collapsed)
+        return result
+
+
+
+class CollapseTest(_CollapseTestMixin, TestCase):
+    def test_collapsed(self):
+        """
+        Concurrent identical requests are forwarded and mangled once, and
+        all get the same response.
+        """
+        d = self.getAll(["newspeak"] * 3)
+        expected = "Production has increased by 98.4% (newspeak)."
+        d.addCallback(self.assertEqual, [expected] * 3)
+        d.addCallback(self.verifyCounts, 1, 1, 2)
+        return d
+
+
+    def test_sequential(self):
+        """
+        Requests made after the response was sent are forwarded again.
+        """
+        d = self.getAll(["newspeak"])
+        d.addCallback(lambda _: self.getAll(["newspeak"]))
+        d.addCallback(self.verifyCounts, 2, 2, 0)
+        return d
+
+
+
+class VaryingCollapseTest(_CollapseTestMixin, TestCase):
+    vary = "Accept-Language"
+
+    def test_vary(self):
+        """
+        Waiting requests that differ in the headers the response varies on
+        are forwarded on their own.
+        """
+        d = self.getAll(["newspeak", "newspeak", "oldspeak"])
+        d.addCallback(lambda contents: self.assertIn("oldspeak", contents[2]))
+        d.addCallback(self.verifyCounts, 2, 2, 1)
+        return d
+
+
+
+class PredicateCollapseTest(_CollapseTestMixin, TestCase):
+    predicate = staticmethod(lambda request: "/news" in request.uri)
+
+    def test_notCollapsed(self):
+        """
+        Requests the predicate rejects aren't collapsed.
+        """
+        d = self.getAll(["newspeak"] * 2)
+        d.addCallback(self.verifyCounts, 2, 2, 0)
+        return d
@@ -0,0 +1,218 @@
+"""
+Tests for mangling compressed responses.
+"""
+import zlib
+
+from twisted.trial.unittest import TestCase
+from twisted.web import error, resource, server
+
+from minitrue import proxy
+from minitrue.proxy import _decode, _encode
+from minitrue.utils import StringIO
+from minitrue.test.test_functional import ProxyTestMixin, _News
+from minitrue.test.test_functional import responseMangler
+
+
+def replacingMangler(response):
+    """
+    Replaces the body of reports, without reading it.
+    """
+    if "report" in response.client.father.uri:
+        response.content = StringIO("Chocolate rations have been increased.")
+
+
+def inPlaceMangler(response):
+    """
+    Corrects the body of reports, in place.
+    """
+    if "report" in response.client.father.uri:
+        content = response.content
+        content.seek(_News.message.index("decreased"), 0)
+        content.write("increased")
+
+
+class _Compressed(resource.Resource):
+    """
+    Serves a news report, gzip compressed.
+    """
+    isLeaf = True
+    body = _encode(_News.message, "gzip", 9)
+
+    def render_GET(self, request):
+        request.setHeader("Content-Encoding", "gzip")
+        return self.body
+
+
+
+def buildCompressedTarget():
+    root = resource.Resource()
+    root.putChild("news", _Compressed())
+    root.putChild("book", _Compressed())
+    root.putChild("report", _Compressed())
+    return server.Site(root)
+
+
+
+class DecodeTest(TestCase):
+    def test_rawDeflate(self):
+        """
+        Deflate encoded bodies are decompressed whether or not they have a
+        zlib header.
+        """
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        raw = compressor.compress(_News.message) + compressor.flush()
+        for data in [raw, zlib.compress(_News.message)]:
+            output = StringIO()
+            _decode(data, "deflate", output)
+            self.assertEqual(output.getvalue(), _News.message)
+
+
+    def test_tooLarge(self):
+        """
+        Decompressing a body stops once it gets longer than the limit.
+        """
+        self.patch(proxy, "_decodeChunkSize", 16)
+        data = _encode("x" * 1000, "gzip", 9)
+        output = StringIO()
+        self.assertRaises(proxy.DecodedBodyTooLarge, _decode, data, "gzip",
+                          output, 100)
+        self.assertTrue(len(output.getvalue()) <= 100)
+
+
+
+class CompressedManglingTest(ProxyTestMixin, TestCase):
+    compressionLevel = 6
+    responseMangler = staticmethod(responseMangler)
+    maxDecodedBytes = 1024
+
+    def proxyConstructor(self):
+        return proxy.MinitrueFactory(responseMangler=self.responseMangler,
+                                     compressionLevel=self.compressionLevel,
+                                     maxDecodedBytes=self.maxDecodedBytes)
+
+
+    def buildTarget(self):
+        return buildCompressedTarget()
+
+
+    def test_mangled(self):
+        """
+        Compressed bodies are decompressed for the mangler, and compressed
+        again afterwards.
+        """
+        factory = self.get("/news")
+
+        @factory.deferred.addCallback
+        def verify(content):
+            headers = factory.response_headers
+            self.assertEqual(headers["content-encoding"], ["gzip"])
+            self.assertEqual(headers["content-length"], [str(len(content))])
+            content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+            self.assertIn("increased", content)
+
+        return factory.deferred
+
+
+    def test_unchanged(self):
+        """
+        Compressed bodies that the mangler didn't change are sent as they
+        were received.
+        """
+        factory = self.get("/book")
+        factory.deferred.addCallback(self.assertEqual, _Compressed.body)
+        return factory.deferred
+
+
+
+class UncompressedManglingTest(CompressedManglingTest):
+    compressionLevel = None
+
+    def test_mangled(self):
+        """
+        Without a compression level, changed bodies are sent uncompressed.
+        """
+        factory = self.get("/news")
+
+        @factory.deferred.addCallback
+        def verify(content):
+            headers = factory.response_headers
+            self.assertNotIn("content-encoding", headers)
+            self.assertEqual(headers["content-length"], [str(len(content))])
+            self.assertIn("increased", content)
+
+        return factory.deferred
+
+
+
+class ReplacedCompressedTest(CompressedManglingTest):
+    """
+    Bodies that manglers replace without reading them first are compressed
+    again too.
+    """
+    responseMangler = staticmethod(replacingMangler)
+
+    def getReport(self):
+        factory = self.get("/report")
+
+        @factory.deferred.addCallback
+        def decode(content):
+            headers = factory.response_headers
+            self.assertEqual(headers["content-length"], [str(len(content))])
+            if self.compressionLevel is None:
+                self.assertNotIn("content-encoding", headers)
+                return content
+            self.assertEqual(headers["content-encoding"], ["gzip"])
+            return zlib.decompress(content, 16 + zlib.MAX_WBITS)
+
+        return factory.deferred
+
+
+    def test_mangled(self):
+        d = self.getReport()
+        d.addCallback(self.assertEqual,
+                      "Chocolate rations have been increased.")
+        return d
+
+
+
+class ReplacedUncompressedTest(ReplacedCompressedTest):
+    compressionLevel = None
+
+
+
+class InPlaceCompressedTest(ReplacedCompressedTest):
+    """
+    Manglers can write to decompressed bodies in place.
+    """
+    responseMangler = staticmethod(inPlaceMangler)
+
+    def test_mangled(self):
+        d = self.getReport()
+        expected = _News.message.replace("decreased", "increased")
+        d.addCallback(self.assertEqual, expected)
+        return d
+
+
+
+class DecodedTooLargeTest(ProxyTestMixin, TestCase):
+    def proxyConstructor(self):
+        return proxy.MinitrueFactory(responseMangler=responseMangler,
+                                     maxDecodedBytes=10)
+
+
+    def buildTarget(self):
+        return buildCompressedTarget()
+
+
+    def test_mangled(self):
+        """
+        Bodies that would be too large once decompressed aren't mangled.
+        """
+        d = self.assertFailure(self.get("/news").deferred, error.Error)
+
+        @d.addCallback
+        def verify(e):
+            self.assertEqual(e.status, "502")
+            self.flushLoggedErrors(proxy.DecodedBodyTooLarge)
+
+        return d
@@ -0,0 +1,69 @@
+"""
+Tests for the context of requests.
+"""
+from twisted.trial.unittest import TestCase
+from twisted.web.http_headers import Headers
+
+from minitrue import context
+
+
+class _Request(object):
+    def __init__(self, uri):
+        self.uri = uri
+        self.requestHeaders = Headers()
+
+
+
+class SplitURLTest(TestCase):
+    def test_reused(self):
+        """
+        Splitting the same URL again reuses the split.
+        """
+        url = "http://minitrue.oc/news?day=1"
+        split = context.splitURL(url)
+        self.assertEqual(split.path, "/news")
+        self.assertIdentical(context.splitURL(url), split)
+
+        other = context.splitURL("http://miniluv.oc/")
+        self.assertEqual(other.hostname, "miniluv.oc")
+
+
+
+class RequestContextTest(TestCase):
+    def setUp(self):
+        self.request = _Request("http://Minitrue.oc/news")
+        self.request.requestHeaders.setRawHeaders("accept-language",
+                                                  ["oldspeak", "newspeak"])
+        self.context = context.RequestContext(self.request)
+
+
+    def test_split(self):
+        """
+        The URL is split once, and the split is kept.
+        """
+        split = self.context.split
+        self.assertEqual(self.context.hostname, "minitrue.oc")
+        self.assertEqual(self.context.path, "/news")
+        self.assertIdentical(self.context.split, split)
+
+
+    def test_rewritten(self):
+        """
+        When the URI of the request is rewritten, it is split again.
+        """
+        self.assertEqual(self.context.path, "/news")
+        self.request.uri = "http://minitrue.oc/lies"
+        self.assertEqual(self.context.path, "/lies")
+
+
+    def test_headers(self):
+        """
+        Headers are those of the request, not copies.
+        """
+        self.assertIdentical(self.context.headers, self.request.requestHeaders)
+        self.assertEqual(self.context.header("Accept-Language"), "newspeak")
+        self.assertIdentical(self.context.header("Cookie"), None)
+
+
+    def test_slots(self):
+        self.assertRaises(AttributeError, setattr, self.context, "hat", 1)
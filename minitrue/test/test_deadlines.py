@@ -0,0 +1,191 @@
+"""
+Tests for deadlines of the phases of proxied requests.
+"""
+from twisted.internet import defer, protocol, reactor, task
+from twisted.trial.unittest import TestCase
+from twisted.web import resource, server
+
+from minitrue import metrics, proxy
+from minitrue.deadlines import DeadlineExceeded, Deadlines
+from minitrue.test.test_functional import ProxyTestMixin, buildTarget
+from minitrue.test.test_tunnel import _Client
+
+
+class DeadlinesTest(TestCase):
+    def test_limit(self):
+        """
+        Deferreds that don't fire before the deadline are cancelled, and
+        fail with ``DeadlineExceeded``.
+        """
+        clock = task.Clock()
+        deadlines = Deadlines(responseMangler=5, reactor=clock)
+        d = deadlines.limit("responseMangler", defer.Deferred())
+        clock.advance(5)
+        failure = self.failureResultOf(d)
+        failure.trap(DeadlineExceeded)
+        self.assertEqual(failure.value.phase, "responseMangler")
+
+
+    def test_noDeadline(self):
+        """
+        Phases without a deadline aren't limited.
+        """
+        clock = task.Clock()
+        d = defer.Deferred()
+        self.assertIdentical(Deadlines(reactor=clock).limit("connect", d), d)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    def test_fired(self):
+        """
+        The deadline is forgotten once the deferred fires.
+        """
+        clock = task.Clock()
+        deadlines = Deadlines(requestMangler=5, reactor=clock)
+        d = deadlines.limit("requestMangler", defer.succeed("Oceania"))
+        self.assertEqual(clock.getDelayedCalls(), [])
+        d.addCallback(self.assertEqual, "Oceania")
+        return d
+
+
+
+class _Hanging(resource.Resource):
+    """
+    A remote server that starts responding, but never finishes.
+    """
+    isLeaf = True
+
+    def __init__(self, partial):
+        resource.Resource.__init__(self)
+        self.partial = partial
+        self.lost = defer.Deferred()
+
+
+    def render_GET(self, request):
+        request.notifyFinish().addErrback(lambda _: self.lost.callback(None))
+        if self.partial:
+            request.setHeader("content-length", "100")
+            request.write("War is peace.")
+        return server.NOT_DONE_YET
+
+
+
+class _DeadlineTestMixin(ProxyTestMixin):
+    requestMangler = None
+    responseMangler = None
+
+    def proxyConstructor(self):
+        self.metrics = metrics.Metrics()
+        deadlines = Deadlines(firstByte=0.1, download=0.1,
+                              requestMangler=0.1, responseMangler=0.1)
+        return proxy.MinitrueFactory(requestMangler=self.requestMangler,
+                                     responseMangler=self.responseMangler,
+                                     metrics=self.metrics, deadlines=deadlines)
+
+
+    def buildTarget(self):
+        site = buildTarget()
+        self.hanging = _Hanging(partial=False)
+        self.partial = _Hanging(partial=True)
+        site.resource.putChild("hanging", self.hanging)
+        site.resource.putChild("partial", self.partial)
+        return site
+
+
+    @defer.inlineCallbacks
+    def assertTimedOut(self, path, phase):
+        factory = self.get(path)
+        yield self.assertFailure(factory.deferred, Exception)
+        self.assertEqual(factory.status, "504")
+        self.assertEqual(self.metrics.counters["timeout:" + phase], 1)
+
+
+
+class DeadlineTest(_DeadlineTestMixin, TestCase):
+    @defer.inlineCallbacks
+    def test_firstByte(self):
+        """
+        When the remote server doesn't respond in time, the client gets a
+        504, and the connection to the remote server is closed.
+        """
+        yield self.assertTimedOut("/hanging", "firstByte")
+        yield self.hanging.lost
+
+
+    @defer.inlineCallbacks
+    def test_download(self):
+        """
+        When the rest of the response doesn't arrive in time, both
+        connections are closed.
+        """
+        factory = self.get("/partial")
+        yield self.assertFailure(factory.deferred, Exception)
+        self.assertEqual(factory.status, "200")
+        yield self.partial.lost
+        self.assertEqual(self.metrics.counters["timeout:download"], 1)
+
+
+
+class ResponseManglerDeadlineTest(_DeadlineTestMixin, TestCase):
+    responseMangler = staticmethod(lambda response: defer.Deferred())
+
+    def test_responseMangler(self):
+        """
+        When the response mangler doesn't finish in time, the client gets a
+        504.
+        """
+        return self.assertTimedOut("/book", "responseMangler")
+
+
+
+class RequestManglerDeadlineTest(_DeadlineTestMixin, TestCase):
+    requestMangler = staticmethod(lambda request: defer.Deferred())
+
+    def test_requestMangler(self):
+        """
+        When the request mangler doesn't finish in time, the client gets a
+        504.
+        """
+        return self.assertTimedOut("/book", "requestMangler")
+
+
+
+class SlowUploadTest(TestCase):
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+        deadlines = Deadlines(firstByte=0.3)
+        factory = proxy.MinitrueFactory(metrics=self.metrics,
+                                        deadlines=deadlines,
+                                        streamBodies=True)
+        self.proxy = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        self.target = reactor.listenTCP(0, buildTarget(),
+                                        interface="127.0.0.1")
+
+
+    def tearDown(self):
+        return defer.gatherResults([self.proxy.stopListening(),
+                                    self.target.stopListening()])
+
+
+    @defer.inlineCallbacks
+    def test_slowUpload(self):
+        """
+        The ``firstByte`` deadline only starts once all of the request body
+        has been sent, so slow uploads aren't cut off.
+        """
+        creator = protocol.ClientCreator(reactor, _Client)
+        client = yield creator.connectTCP("127.0.0.1",
+                                          self.proxy.getHost().port)
+        self.addCleanup(client.transport.loseConnection)
+
+        url = "http://127.0.0.1:%d/telescreen" % (self.target.getHost().port,)
+        client.transport.write("POST %s HTTP/1.0\r\nHost: 127.0.0.1\r\n"
+                               "Content-Length: 100\r\n\r\n" % (url,))
+        for _ in range(10):
+            yield task.deferLater(reactor, 0.1, lambda: None)
+            client.transport.write("x" * 10)
+
+        received = yield client.closed
+        self.assertIn(" 200 ", received.split("\r\n", 1)[0])
+        self.assertTrue(received.endswith("x" * 100))
+        self.assertEqual(self.metrics.counters["timeout:firstByte"], 0)
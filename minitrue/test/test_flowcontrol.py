@@ -0,0 +1,92 @@
+"""
+Tests for flow control between clients and remote servers.
+"""
+from twisted.trial.unittest import TestCase
+from twisted.web import resource, server
+from twisted.web.test.requesthelper import DummyRequest
+
+from minitrue import proxy
+from minitrue.test.test_functional import ProxyTestMixin, responseMangler
+
+
+class _Archive(resource.Resource):
+    """
+    A large archive of old newspapers, to be rectified.
+    """
+    isLeaf = True
+    body = "The chocolate ration was decreased. " * 50000
+
+    def render_GET(self, request):
+        if request.postpath != ["unframed"]:
+            return self.body
+
+        # Without a Content-Length, the end of the body is marked by closing
+        # the connection.
+        request.write(self.body)
+        request.finish()
+        return server.NOT_DONE_YET
+
+
+
+class BodyProducerTest(TestCase):
+    def test_chunks(self):
+        """
+        The body is written in chunks, and the request is finished.
+        """
+        request = DummyRequest([])
+        producer = proxy._BodyProducer(request, "x" * 10, 4)
+        d = producer.start()
+        self.assertEqual(request.written, ["xxxx", "xxxx", "xx"])
+        self.assertEqual(request.finished, 1)
+        self.assertTrue(d.called)
+
+
+    def test_stopProducing(self):
+        """
+        When the connection to the client is lost, nothing else is written.
+        """
+        request = DummyRequest([])
+        producer = proxy._BodyProducer(request, "x" * 10, 4)
+        producer.resumeProducing()
+        producer.stopProducing()
+        producer.resumeProducing()
+        self.assertEqual(request.written, ["xxxx"])
+        self.assertTrue(producer.done.called)
+
+
+
+class FlowControlTest(ProxyTestMixin, TestCase):
+    responseMangler = None
+
+    def proxyConstructor(self):
+        return proxy.MinitrueFactory(responseMangler=self.responseMangler,
+                                     highWaterMark=1024)
+
+
+    def buildTarget(self):
+        return server.Site(_Archive())
+
+
+    def test_largeBody(self):
+        """
+        Large bodies are relayed completely, even though reading them from
+        the remote server is paused while the client catches up.
+        """
+        d = self.get("/").deferred
+        d.addCallback(self.assertEqual, _Archive.body)
+        return d
+
+
+    def test_closedByServer(self):
+        """
+        Bodies that end when the remote server closes the connection are
+        relayed completely.
+        """
+        d = self.get("/unframed").deferred
+        d.addCallback(self.assertEqual, _Archive.body)
+        return d
+
+
+
+class MangledFlowControlTest(FlowControlTest):
+    responseMangler = staticmethod(responseMangler)
@@ -7,7 +7,7 @@ from twisted.internet import reactor
 from twisted.trial.unittest import TestCase
 from twisted.web import server, resource
 
-from minitrue import misdirection, proxy
+from minitrue import metrics, misdirection, proxy
 from minitrue.utils import StringIO, Constructor
 from minitrue.test.observer import ObserverMixin, SubstringObserver
 from minitrue.test.connect import getWithProxy, getWithoutProxy
@@ -37,10 +37,20 @@ class _Book(resource.Resource):
 
 
 
+class _Telescreen(resource.Resource):
+    """
+    Repeats everything it hears.
+    """
+    def render_POST(self, request):
+        return request.content.read()
+
+
+
 def buildTarget():
     root = resource.Resource()
     root.putChild("news", _News())
     root.putChild("book", _Book())
+    root.putChild("telescreen", _Telescreen())
 
     return server.Site(root)
 
@@ -54,6 +64,11 @@ class _MinitrueConstructor(Constructor):
 misdirectingProxyConstructor = _MinitrueConstructor()
 requestManglingProxyConstructor = _MinitrueConstructor()
 responseManglingProxyConstructor = _MinitrueConstructor()
+bodyStreamingProxyConstructor = _MinitrueConstructor()
+bodyStreamingProxyConstructor.kw["streamBodies"] = True
+streamingManglingProxyConstructor = _MinitrueConstructor()
+spillingManglingProxyConstructor = _MinitrueConstructor()
+spillingManglingProxyConstructor.kw["bufferThreshold"] = 10
 
 
 @misdirectingProxyConstructor.kwarg(kwargName="requestMangler")
@@ -69,6 +84,7 @@ def misdirector(url):
 
 
 @requestManglingProxyConstructor.kwarg()
+@bodyStreamingProxyConstructor.kwarg()
 def requestMangler(request):
     """
     Modifies requests for oldspeak into requests for newspeak.
@@ -78,6 +94,7 @@ def requestMangler(request):
 
 
 @responseManglingProxyConstructor.kwarg()
+@spillingManglingProxyConstructor.kwarg()
 def responseMangler(response):
     """
     Modifies some response content, because the chocolate rations have
@@ -91,6 +108,33 @@ def responseMangler(response):
 
 
 
+@streamingManglingProxyConstructor.kwarg(kwargName="responseMangler")
+class StreamingMangler(proxy.StreamingMangler):
+    """
+    Modifies response content as it comes in, because the chocolate rations
+    have ostensibly not been decreased.
+    """
+    def __init__(self, response):
+        proxy.StreamingMangler.__init__(self, response)
+        self.buffer = ""
+
+
+    def mangle(self, part):
+        """
+        Mangles everything except for a potentially partial word at the end.
+        """
+        data = self.buffer + part
+        data, _, self.buffer = data.rpartition(" ")
+        if data:
+            data += " "
+        return data.replace("decreased", "increased")
+
+
+    def finish(self):
+        return self.buffer.replace("decreased", "increased")
+
+
+
 class ProxyTestMixin(object):
     def setUp(self):
         self.listeningPorts = {}
@@ -99,19 +143,24 @@ class ProxyTestMixin(object):
         port = reactor.listenTCP(0, proxyFactory)
         self.listeningPorts["proxy"] = port
 
-        target = buildTarget()
+        target = self.buildTarget()
         port = reactor.listenTCP(0, target)
         self.listeningPorts["target"] = port
 
 
-    def get(self, path="/", query="", fragment="", headers=None, proxy=True):
+    def buildTarget(self):
+        return buildTarget()
+
+
+    def get(self, path="/", query="", fragment="", headers=None, proxy=True,
+            **kwargs):
         url = self._buildURL(path, query, fragment)
 
         if proxy:
             proxy = self.listeningPorts["proxy"].getHost()
-            return getWithProxy(url, proxy.host, proxy.port, headers)
+            return getWithProxy(url, proxy.host, proxy.port, headers, **kwargs)
         else:
-            return getWithoutProxy(url, headers)
+            return getWithoutProxy(url, headers, **kwargs)
 
 
     def _buildURL(self, path, query, fragment):
@@ -234,3 +283,77 @@ class ResponseManglingTest(ProxyTestMixin, TestCase):
 
     def test_responseMangled(self):
         return self._responseManglingTest(True)
+
+
+
+class StreamingResponseManglingTest(ResponseManglingTest):
+    proxyConstructor = streamingManglingProxyConstructor
+
+
+
+class SpillingResponseManglingTest(ResponseManglingTest):
+    proxyConstructor = spillingManglingProxyConstructor
+
+    def test_unchangedResponse(self):
+        """
+        Spilled responses that weren't changed are replayed from disk.
+        """
+        d = self.get("/book").deferred
+        d.addCallback(self.assertEqual, _Book().render_GET(None))
+        return d
+
+
+
+class BodyStreamingTest(RequestManglingTest):
+    proxyConstructor = bodyStreamingProxyConstructor
+
+    def test_bodyRelayed(self):
+        """
+        Request bodies are relayed to the remote server.
+        """
+        body = "Who controls the past controls the future. " * 10000
+        d = self.get("/telescreen", method="POST", postdata=body).deferred
+        d.addCallback(self.assertEqual, body)
+        return d
+
+
+
+class PredicateTest(ProxyTestMixin, TestCase):
+    """
+    Tests for response manglers that only mangle some responses.
+    """
+    contentTypes = ["text/plain"]
+    expectMangled = False
+
+    def proxyConstructor(self):
+        self.metrics = metrics.Metrics()
+
+        @proxy.mangles(contentTypes=self.contentTypes, maxLength=1024)
+        def mangler(response):
+            return responseMangler(response)
+
+        return proxy.MinitrueFactory(responseMangler=mangler,
+                                     metrics=self.metrics)
+
+
+    def test_predicate(self):
+        """
+        Responses that match the predicate are mangled, others are passed
+        through without being buffered.
+        """
+        d = self.get("/news").deferred
+
+        @d.addCallback
+        def verify(content):
+            mangled = "increased" in content
+            self.assertEqual(mangled, self.expectMangled)
+            unmangled = self.metrics.counters["unmangled"]
+            self.assertEqual(unmangled, int(not self.expectMangled))
+
+        return d
+
+
+
+class MatchingPredicateTest(PredicateTest):
+    contentTypes = ["text/html"]
+    expectMangled = True
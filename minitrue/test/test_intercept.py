@@ -0,0 +1,395 @@
+"""
+Tests for intercepting TLS connections.
+"""
+import os
+
+from twisted.internet import defer, protocol, reactor
+from twisted.trial.unittest import TestCase
+
+from minitrue import intercept, proxy
+from minitrue.test import test_tunnel
+from minitrue.test.test_functional import buildTarget, responseMangler
+
+try: # pragma: no cover
+    from twisted.internet import ssl
+except ImportError:
+    ssl = None
+
+
+def _buildCA(path):
+    """
+    Creates a CA certificate and key, and writes them to a file.
+    """
+    crypto = intercept.crypto
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 1024)
+
+    certificate = crypto.X509()
+    certificate.set_version(2)
+    certificate.set_serial_number(1)
+    certificate.get_subject().CN = "Ministry of Truth"
+    certificate.set_issuer(certificate.get_subject())
+    certificate.gmtime_adj_notBefore(0)
+    certificate.gmtime_adj_notAfter(24 * 60 * 60)
+    certificate.set_pubkey(key)
+    certificate.add_extensions([
+        crypto.X509Extension("basicConstraints", True, "CA:TRUE"),
+    ])
+    certificate.sign(key, "sha256")
+
+    with open(path, "w") as f:
+        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, certificate))
+        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+
+
+
+class CertificateAuthorityTest(TestCase):
+    if intercept.crypto is None:
+        skip = "pyOpenSSL is not installed"
+
+    def setUp(self):
+        self.caFile = self.mktemp()
+        _buildCA(self.caFile)
+        self.cacheDirectory = self.mktemp()
+        os.mkdir(self.cacheDirectory)
+
+
+    def buildAuthority(self, **kwargs):
+        return intercept.CertificateAuthority(self.caFile, keyBits=1024,
+                                              **kwargs)
+
+
+    def test_mint(self):
+        """
+        Minted certificates are for the hostname, and issued by the CA.
+        """
+        authority = self.buildAuthority()
+        certificate = authority.mint("minitrue.oc")
+        self.assertEqual(certificate.get_subject().CN, "minitrue.oc")
+        self.assertEqual(certificate.get_issuer().CN, "Ministry of Truth")
+
+        other = authority.mint("miniluv.oc")
+        self.assertNotEqual(certificate.get_serial_number(),
+                            other.get_serial_number())
+
+
+    def test_contextCached(self):
+        """
+        Contexts are cached per hostname, so that sessions can be resumed.
+        """
+        authority = self.buildAuthority()
+        first = authority.serverContextFactory("minitrue.oc").getContext()
+        second = authority.serverContextFactory("MINITRUE.oc").getContext()
+        self.assertIdentical(first, second)
+
+
+    def test_diskCache(self):
+        """
+        Certificates and the leaf key are persisted in the cache directory,
+        and reused by later authorities.
+        """
+        first = self.buildAuthority(cacheDirectory=self.cacheDirectory)
+        certificate = first.certificate("minitrue.oc")
+
+        second = self.buildAuthority(cacheDirectory=self.cacheDirectory)
+        cached = second.certificate("minitrue.oc")
+        self.assertEqual(cached.get_serial_number(),
+                         certificate.get_serial_number())
+
+        dump = intercept.crypto.dump_privatekey
+        pem = intercept.crypto.FILETYPE_PEM
+        self.assertEqual(dump(pem, first.leafKey), dump(pem, second.leafKey))
+
+
+
+    def assertReminted(self, first, second):
+        """
+        Asserts that the second authority mints a new certificate instead of
+        using the one the first stored in the cache directory.
+        """
+        certificate = first.certificate("minitrue.oc")
+        cached = second.certificate("minitrue.oc")
+        self.assertNotEqual(cached.get_serial_number(),
+                            certificate.get_serial_number())
+        self.assertTrue(second._isUsable(cached))
+
+
+    def test_diskCacheExpiring(self):
+        """
+        Cached certificates that are about to expire are minted again.
+        """
+        first = self.buildAuthority(cacheDirectory=self.cacheDirectory)
+        first.validity = 60 * 60
+        second = self.buildAuthority(cacheDirectory=self.cacheDirectory)
+        self.assertReminted(first, second)
+
+
+    def test_diskCacheOtherCA(self):
+        """
+        Cached certificates that were minted by another CA are minted again.
+        """
+        first = self.buildAuthority(cacheDirectory=self.cacheDirectory)
+        _buildCA(self.caFile)
+        second = self.buildAuthority(cacheDirectory=self.cacheDirectory)
+        self.assertReminted(first, second)
+
+
+    def test_diskCacheOtherKey(self):
+        """
+        Cached certificates that are for another key are minted again.
+        """
+        first = self.buildAuthority(cacheDirectory=self.cacheDirectory)
+        os.remove(os.path.join(self.cacheDirectory, "leaf.key"))
+        second = self.buildAuthority(cacheDirectory=self.cacheDirectory)
+        self.assertReminted(first, second)
+
+
+    def test_leafKeyRace(self):
+        """
+        When another process stores its leaf key first, that one is used.
+        """
+        other = self.buildAuthority()
+        pem = intercept.crypto.dump_privatekey(intercept.crypto.FILETYPE_PEM,
+                                               other.leafKey)
+        link = os.link
+
+        def racingLink(source, destination):
+            with open(destination, "w") as f:
+                f.write(pem)
+            link(source, destination)
+
+        self.patch(os, "link", racingLink)
+        authority = self.buildAuthority(cacheDirectory=self.cacheDirectory)
+        dump = intercept.crypto.dump_privatekey
+        self.assertEqual(dump(intercept.crypto.FILETYPE_PEM,
+                              authority.leafKey), pem)
+        self.assertEqual(os.listdir(self.cacheDirectory), ["leaf.key"])
+
+
+
+class IsIPAddressTest(TestCase):
+    def test_addresses(self):
+        self.assertTrue(intercept._isIPAddress("127.0.0.1"))
+        self.assertTrue(intercept._isIPAddress("::1"))
+        self.assertFalse(intercept._isIPAddress("minitrue.oc"))
+
+
+
+class _Client(protocol.Protocol):
+    """
+    A client that makes a request through an intercepted tunnel.
+    """
+    def __init__(self, port):
+        self.port = port
+        self.received = ""
+        self.intercepted = False
+        self.closed = defer.Deferred()
+
+
+    def connectionMade(self):
+        self.transport.write("CONNECT 127.0.0.1:%d HTTP/1.1\r\n\r\n"
+                             % (self.port,))
+
+
+    def dataReceived(self, data):
+        self.received += data
+        if not self.intercepted and "\r\n\r\n" in self.received:
+            self.intercepted = True
+            self.status, self.received = self.received.split("\r\n\r\n", 1)
+            self.transport.startTLS(ssl.ClientContextFactory())
+            self.transport.write("GET /news HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+                                 "Connection: close\r\n\r\n")
+
+
+    def connectionLost(self, reason):
+        self.closed.callback(None)
+
+
+
+class InterceptionTest(TestCase):
+    if intercept.crypto is None:
+        skip = "pyOpenSSL is not installed"
+
+    def setUp(self):
+        caFile = self.mktemp()
+        _buildCA(caFile)
+        authority = intercept.CertificateAuthority(caFile, keyBits=1024)
+
+        self.factory = proxy.MinitrueFactory(
+            responseMangler=responseMangler, interceptor=authority,
+            clientContexts=intercept.ClientContexts(caFile), connectPorts=None)
+        self.proxy = reactor.listenTCP(0, self.factory,
+                                       interface="127.0.0.1")
+
+        self.authority = authority
+        self.target = self.listen("127.0.0.1")
+
+
+    def listen(self, hostname):
+        """
+        Serves the target site over TLS, with a certificate for the hostname.
+        """
+        contextFactory = self.authority.serverContextFactory(hostname)
+        return reactor.listenSSL(0, buildTarget(), contextFactory,
+                                 interface="127.0.0.1")
+
+
+    def tearDown(self):
+        return defer.gatherResults([self.proxy.stopListening(),
+                                    self.target.stopListening()])
+
+
+    @defer.inlineCallbacks
+    def request(self, target):
+        """
+        Makes a request to the target through an intercepted tunnel.
+        """
+        creator = protocol.ClientCreator(reactor, _Client,
+                                         target.getHost().port)
+        client = yield creator.connectTCP("127.0.0.1",
+                                          self.proxy.getHost().port)
+        yield client.closed
+        defer.returnValue(client)
+
+
+    @defer.inlineCallbacks
+    def test_intercepted(self):
+        """
+        Requests made through intercepted tunnels are mangled.
+        """
+        client = yield self.request(self.target)
+
+        self.assertEqual(client.status, "HTTP/1.1 200 Connection established")
+        self.assertIn("HTTP/1.1 200 OK", client.received)
+        self.assertIn("increased", client.received)
+
+
+    @defer.inlineCallbacks
+    def test_untrusted(self):
+        """
+        Remote servers with certificates that aren't issued by a trusted CA
+        aren't talked to.
+        """
+        otherCA = self.mktemp()
+        _buildCA(otherCA)
+        self.factory.clientContexts = intercept.ClientContexts(otherCA)
+
+        client = yield self.request(self.target)
+        self.assertIn("HTTP/1.1 502", client.received)
+        self.assertNotIn("increased", client.received)
+
+
+    @defer.inlineCallbacks
+    def test_wrongHostname(self):
+        """
+        Remote servers with certificates for other hostnames aren't talked
+        to.
+        """
+        target = self.listen("minitrue.oc")
+        self.addCleanup(target.stopListening)
+
+        client = yield self.request(target)
+        self.assertIn("HTTP/1.1 502", client.received)
+        self.assertNotIn("increased", client.received)
+
+
+
+class NoClientContextsTest(TestCase):
+    def setUp(self):
+        factory = proxy.MinitrueFactory()
+        factory.clientContexts = None
+        self.proxy = reactor.listenTCP(0, factory, interface="127.0.0.1")
+
+
+    def tearDown(self):
+        return self.proxy.stopListening()
+
+
+    @defer.inlineCallbacks
+    def test_https(self):
+        """
+        Without client contexts (because pyOpenSSL isn't installed),
+        requests for https URLs are answered with a 501.
+        """
+        creator = protocol.ClientCreator(reactor, test_tunnel._Client)
+        client = yield creator.connectTCP("127.0.0.1",
+                                          self.proxy.getHost().port)
+        self.addCleanup(client.transport.loseConnection)
+
+        client.transport.write("GET https://127.0.0.1/news HTTP/1.1\r\n"
+                               "Host: 127.0.0.1\r\n\r\n")
+        received = yield client.waitFor("pyOpenSSL")
+        self.assertTrue(received.startswith("HTTP/1.1 501"))
+
+
+
+class ClientContextsTest(TestCase):
+    if intercept.crypto is None:
+        skip = "pyOpenSSL is not installed"
+
+    def test_contextCached(self):
+        """
+        Contexts are cached per hostname, so that they can be reused.
+        """
+        contexts = intercept.ClientContexts()
+        first = contexts.contextFactory("minitrue.oc")
+        second = contexts.contextFactory("MINITRUE.oc")
+        self.assertTrue(first.isClient)
+        self.assertIdentical(first.getContext(), second.getContext())
+
+
+    def test_verified(self):
+        """
+        Contexts verify the certificates of remote servers.
+        """
+        context = intercept.ClientContexts().contextFactory("minitrue.oc")
+        mode = context.getContext().get_verify_mode()
+        self.assertEqual(mode, intercept.SSL.VERIFY_PEER)
+
+
+
+class CertificateMatchesTest(TestCase):
+    if intercept.crypto is None:
+        skip = "pyOpenSSL is not installed"
+
+    def setUp(self):
+        caFile = self.mktemp()
+        _buildCA(caFile)
+        self.authority = intercept.CertificateAuthority(caFile, keyBits=1024)
+
+
+    def assertMatches(self, name, hostname, matches=True):
+        certificate = self.authority.mint(name)
+        result = intercept._certificateMatches(certificate, hostname)
+        self.assertEqual(result, matches)
+
+
+    def test_hostname(self):
+        self.assertMatches("minitrue.oc", "minitrue.oc")
+        self.assertMatches("minitrue.oc", "MINITRUE.oc")
+        self.assertMatches("minitrue.oc", "miniluv.oc", False)
+
+
+    def test_wildcard(self):
+        self.assertMatches("*.minitrue.oc", "records.minitrue.oc")
+        self.assertMatches("*.minitrue.oc", "minitrue.oc", False)
+        self.assertMatches("*.minitrue.oc", "a.records.minitrue.oc", False)
+        self.assertMatches("*.oc", "minitrue.oc", False)
+
+
+    def test_address(self):
+        self.assertMatches("127.0.0.1", "127.0.0.1")
+        self.assertMatches("::1", "::1")
+        self.assertMatches("127.0.0.1", "127.0.0.2", False)
+        self.assertMatches("minitrue.oc", "127.0.0.1", False)
+
+
+    def test_commonName(self):
+        """
+        The common name is only checked if there is no subjectAltName.
+        """
+        certificate = intercept.crypto.X509()
+        certificate.get_subject().CN = "minitrue.oc"
+        matches = intercept._certificateMatches
+        self.assertTrue(matches(certificate, "minitrue.oc"))
+        self.assertFalse(matches(certificate, "miniluv.oc"))
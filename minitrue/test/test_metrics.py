@@ -0,0 +1,76 @@
+"""
+Tests for instrumentation of the proxy.
+"""
+import json
+
+from twisted.trial.unittest import TestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+from minitrue import metrics, proxy
+from minitrue.test.test_functional import ProxyTestMixin
+from minitrue.test.test_functional import requestMangler, responseMangler
+
+
+class HistogramTest(TestCase):
+    def test_percentiles(self):
+        histogram = metrics.Histogram()
+        for value in range(1, 101):
+            histogram.record(value / 1000.0)
+
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.max, 0.1)
+        self.assertApproximates(histogram.percentile(0.5), 0.05, 0.0125)
+        self.assertApproximates(histogram.percentile(0.99), 0.099, 0.025)
+        self.assertEqual(histogram.percentile(1), 0.1)
+
+
+    def test_empty(self):
+        self.assertIdentical(metrics.Histogram().percentile(0.5), None)
+
+
+
+class MetricsTest(TestCase):
+    def test_publish(self):
+        snapshots = []
+        m = metrics.Metrics(sinks=[snapshots.append])
+        m.record("connect", 0.01)
+        m.increment("inFlight")
+        m.publish()
+
+        snapshot, = snapshots
+        self.assertEqual(snapshot["phases"]["connect"]["count"], 1)
+        self.assertEqual(snapshot["counters"], {"inFlight": 1})
+
+
+    def test_resource(self):
+        m = metrics.Metrics()
+        m.increment("inFlight")
+        request = DummyRequest([])
+        body = metrics.MetricsResource(m).render_GET(request)
+        self.assertEqual(json.loads(body)["counters"], {"inFlight": 1})
+
+
+
+class ProxyMetricsTest(ProxyTestMixin, TestCase):
+    def proxyConstructor(self):
+        self.metrics = metrics.Metrics()
+        return proxy.MinitrueFactory(requestMangler=requestMangler,
+                                     responseMangler=responseMangler,
+                                     metrics=self.metrics)
+
+
+    def verifyMetrics(self, _):
+        snapshot = self.metrics.snapshot()
+        phases = ["requestMangler", "connect", "firstByte", "download",
+                  "responseMangler", "replay", "total"]
+        for phase in phases:
+            self.assertEqual(snapshot["phases"][phase]["count"], 1)
+
+        counters = snapshot["counters"]
+        self.assertEqual(counters, {"inFlight": 0, "bufferedBytes": 0})
+
+
+    def test_phases(self):
+        d = self.get("/news").deferred
+        d.addCallback(self.verifyMetrics)
+        return d
@@ -0,0 +1,161 @@
+"""
+Tests for misdirection.
+"""
+from twisted.trial.unittest import TestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+from minitrue import misdirection
+from minitrue.utils import replace
+
+
+class RulesTest(TestCase):
+    def setUp(self):
+        self.rules = misdirection.Rules()
+
+
+    def addRule(self, **kw):
+        @self.rules.rule(**kw)
+        def misdirector(url):
+            return replace(url, netloc="minitrue.oc")
+
+
+    def assertMisdirected(self, url, expected=True):
+        misdirected = self.rules(url)
+        if expected:
+            self.assertEqual(misdirected, replace(url, netloc="minitrue.oc"))
+        else:
+            self.assertIdentical(misdirected, None)
+
+
+    def test_hostnames(self):
+        self.addRule(hostnames=["Truth.example"])
+        self.assertMisdirected("http://truth.example/")
+        self.assertMisdirected("http://TRUTH.example:8080/x")
+        self.assertMisdirected("http://lies.truth.example/", False)
+
+
+    def test_domains(self):
+        self.addRule(domains=["truth.example"])
+        self.assertMisdirected("http://truth.example/")
+        self.assertMisdirected("http://lies.truth.example/")
+        self.assertMisdirected("http://truth.example.org/", False)
+        self.assertMisdirected("http://untruth.example/", False)
+
+
+    def test_strictDomains(self):
+        self.addRule(domains=["*.truth.example"])
+        self.assertMisdirected("http://truth.example/", False)
+        self.assertMisdirected("http://lies.truth.example/")
+
+
+    def test_paths(self):
+        self.addRule(paths=["/book"])
+        self.assertMisdirected("http://a.example/book")
+        self.assertMisdirected("http://a.example/book/1", False)
+
+
+    def test_pathPrefixes(self):
+        self.addRule(pathPrefixes=["/ministry/"])
+        self.assertMisdirected("http://a.example/ministry")
+        self.assertMisdirected("http://a.example/ministry/truth")
+        self.assertMisdirected("http://a.example/ministryoftruth", False)
+
+
+    def test_hostnamesAndPaths(self):
+        self.addRule(hostnames=["truth.example"], pathPrefixes=["/news"])
+        self.assertMisdirected("http://truth.example/news/today")
+        self.assertMisdirected("http://truth.example/book", False)
+        self.assertMisdirected("http://lies.example/news", False)
+
+
+    def test_order(self):
+        """
+        The first rule that applies and misdirects the URL wins.
+        """
+        @self.rules.affectPaths(["/news"])
+        def ignore(url):
+            pass
+
+        @self.rules.affectDomains(["example"])
+        def first(url):
+            return "first"
+
+        @self.rules.affectHostnames(["truth.example"])
+        def second(url):
+            return "second"
+
+        self.assertEqual(self.rules("http://truth.example/news"), "first")
+
+
+    def test_manyRules(self):
+        for i in xrange(10000):
+            self.addRule(hostnames=["%d.example" % i])
+        self.assertMisdirected("http://9999.example/")
+        self.assertMisdirected("http://10000.example/", False)
+
+
+    def test_manyPathRules(self):
+        """
+        Rules for many paths on the same host are indexed by path too.
+        """
+        for i in xrange(10000):
+            @self.rules.rule(domains=["truth.example"], paths=["/%d" % i])
+            def misdirector(url, i=i):
+                return "/%d" % (i,)
+
+        self.addRule(hostnames=["truth.example"], pathPrefixes=["/news"])
+        self.assertEqual(self.rules("http://truth.example/9999"), "/9999")
+        self.assertEqual(self.rules("http://a.truth.example/42"), "/42")
+        self.assertMisdirected("http://truth.example/news/today")
+        self.assertMisdirected("http://truth.example/10000", False)
+        self.assertMisdirected("http://lies.example/42", False)
+
+
+
+class CachingMisdirectorTest(TestCase):
+    def setUp(self):
+        self.calls = []
+
+        @misdirection.misdirector(cacheSize=2)
+        def misdirector(url):
+            self.calls.append(url)
+            if "book" in url:
+                return url.replace("book", "news")
+
+        self.misdirector = misdirector
+
+
+    def misdirect(self, uri):
+        request = DummyRequest([])
+        request.uri = uri
+        self.misdirector(request)
+        return request.uri
+
+
+    def test_cached(self):
+        """
+        Decisions are cached, including decisions not to misdirect.
+        """
+        for _ in range(2):
+            self.assertEqual(self.misdirect("/book"), "/news")
+            self.assertEqual(self.misdirect("/news"), "/news")
+
+        self.assertEqual(self.calls, ["/book", "/news"])
+        cache = self.misdirector.cache
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+
+    def test_evicted(self):
+        """
+        The least recently used decisions are evicted when the cache is full.
+        """
+        for uri in ["/a", "/b", "/a", "/c", "/b"]:
+            self.misdirect(uri)
+        self.assertEqual(self.calls, ["/a", "/b", "/c", "/b"])
+
+
+    def test_invalidate(self):
+        self.misdirect("/book")
+        self.misdirector.cache.invalidate()
+        self.misdirect("/book")
+        self.assertEqual(self.calls, ["/book", "/book"])
@@ -0,0 +1,261 @@
+"""
+Tests for offloading response manglers to worker processes.
+"""
+import os
+import sys
+import time
+
+from twisted.python import reflect
+from twisted.trial.unittest import TestCase
+from twisted.web import error
+
+import minitrue
+from minitrue import offload, proxy
+from minitrue.utils import SpillingBuffer
+from minitrue.test import test_compression
+from minitrue.test.test_functional import ProxyTestMixin, _News
+from minitrue.test.test_functional import responseMangler
+
+
+def crashingMangler(response):
+    os._exit(1)
+
+
+def slowMangler(response):
+    time.sleep(10)
+
+
+def codeMangler(response):
+    request = response.client.father
+    request.setResponseCode(200, "Doubleplusgood")
+    request.setHeader("X-Mangled", "yes")
+
+
+
+class SharedMemoryTest(TestCase):
+    def test_writeView(self):
+        """
+        Spilled buffers are copied to shared memory from their memory map,
+        in chunks.
+        """
+        self.patch(offload, "_copyChunkSize", 4)
+        buffer = SpillingBuffer(threshold=4)
+        buffer.write("Ignorance is Strength")
+        self.assertTrue(buffer.spilled)
+
+        path = self.mktemp()
+        offload._writeShared(path, buffer.view())
+        buffer.close()
+        self.assertEqual(offload._readShared(path), "Ignorance is Strength")
+
+
+
+class WorkerTest(TestCase):
+    """
+    Tests for mangling in the worker process.
+    """
+    def mangle(self, mangler, body, encoding=None, path=u"/report"):
+        job = {"mangler": reflect.qual(mangler),
+               "input": self.mktemp(), "output": self.mktemp(),
+               "method": u"GET", "uri": u"http://minitrue.oc" + path,
+               "requestHeaders": [], "responseHeaders": [],
+               "requestCode": 200, "message": u"OK", "code": 200,
+               "encoding": encoding, "maxDecodedBytes": None}
+        offload._writeShared(job["input"], body)
+        reply = offload._mangle(job)
+        if reply["changed"]:
+            reply["body"] = offload._readShared(job["output"])
+        return reply
+
+
+    def test_inPlace(self):
+        """
+        Manglers can write to the body in place.
+        """
+        reply = self.mangle(test_compression.inPlaceMangler, _News.message)
+        self.assertTrue(reply["changed"])
+        self.assertFalse(reply["raw"])
+        self.assertIn("increased", reply["body"])
+
+
+    def test_decoded(self):
+        """
+        Compressed bodies are decompressed in the worker.
+        """
+        body = proxy._encode(_News.message, "gzip", 9)
+        reply = self.mangle(test_compression.inPlaceMangler, body, "gzip")
+        self.assertFalse(reply["raw"])
+        self.assertIn("increased", reply["body"])
+
+
+    def test_unchanged(self):
+        """
+        Bodies the mangler didn't change aren't sent back.
+        """
+        body = proxy._encode(_News.message, "gzip", 9)
+        reply = self.mangle(responseMangler, body, "gzip", u"/book")
+        self.assertFalse(reply["changed"])
+
+
+    def test_undecodable(self):
+        """
+        Bodies that can't be decompressed are mangled as they are, and
+        replace the received body.
+        """
+        body = "Not " + _News.message
+        reply = self.mangle(test_compression.inPlaceMangler, body, "gzip")
+        self.assertTrue(reply["raw"])
+        self.assertIn("increased", reply["body"])
+
+
+
+class OffloadTestMixin(ProxyTestMixin):
+    bufferThreshold = 1024 * 1024
+
+    def proxyConstructor(self):
+        self.pool = offload.ProcessPool(size=1, timeout=5.0)
+        return proxy.MinitrueFactory(responseMangler=self.mangler,
+                                     offload=self.pool,
+                                     bufferThreshold=self.bufferThreshold)
+
+
+    def tearDown(self):
+        ProxyTestMixin.tearDown(self)
+        return self.pool.stop()
+
+
+
+class OffloadTest(OffloadTestMixin, TestCase):
+    mangler = staticmethod(responseMangler)
+
+    def test_mangled(self):
+        d = self.get("/news").deferred
+
+        @d.addCallback
+        def verify(content):
+            self.assertIn("increased", content)
+            self.assertNotIn("decreased", content)
+
+        return d
+
+
+    def test_workerReused(self):
+        d = self.get("/news").deferred
+        d.addCallback(lambda _: self.get("/news").deferred)
+        d.addCallback(lambda _: self.assertEqual(len(self.pool.workers), 1))
+        return d
+
+
+    def test_relativePath(self):
+        """
+        Workers can import minitrue even if it is only on the path relative
+        to the directory this process started in, which isn't theirs.
+        """
+        root = os.path.dirname(os.path.dirname(os.path.abspath(
+            minitrue.__file__)))
+        path = [entry for entry in sys.path
+                if os.path.abspath(entry) != root]
+        self.patch(sys, "path", ["minitrue-checkout"] + path)
+        self.patch(offload, "_absolutePaths", {"minitrue-checkout": root})
+        return self.test_mangled()
+
+
+
+class SpilledOffloadTest(OffloadTest):
+    """
+    Bodies that were spilled to disk are offloaded too.
+    """
+    bufferThreshold = 10
+
+
+
+class _OffloadedCompressionMixin(object):
+    """
+    Runs the tests for mangling compressed responses with the mangler
+    offloaded.
+    """
+    def proxyConstructor(self):
+        factory = super(_OffloadedCompressionMixin, self).proxyConstructor()
+        self.pool = factory.offload = offload.ProcessPool(size=1, timeout=5.0)
+        return factory
+
+
+    def tearDown(self):
+        super(_OffloadedCompressionMixin, self).tearDown()
+        return self.pool.stop()
+
+
+
+class OffloadedCompressedTest(_OffloadedCompressionMixin,
+                              test_compression.CompressedManglingTest):
+    """
+    Compressed bodies are decompressed in the worker, and the ones the
+    mangler didn't change are sent as they were received.
+    """
+
+
+
+class OffloadedInPlaceTest(_OffloadedCompressionMixin,
+                           test_compression.InPlaceCompressedTest):
+    """
+    Offloaded manglers can write to the body in place.
+    """
+
+
+
+class OffloadedReplacedTest(_OffloadedCompressionMixin,
+                            test_compression.ReplacedCompressedTest):
+    pass
+
+
+
+class OffloadedCodeTest(OffloadTestMixin, TestCase):
+    mangler = staticmethod(codeMangler)
+
+    def test_codeAndHeaders(self):
+        factory = self.get("/news")
+
+        @factory.deferred.addCallback
+        def verify(_):
+            self.assertEqual(factory.message, "Doubleplusgood")
+            self.assertEqual(factory.response_headers["x-mangled"], ["yes"])
+
+        return factory.deferred
+
+
+
+class OffloadCrashTest(OffloadTestMixin, TestCase):
+    mangler = staticmethod(crashingMangler)
+
+    def test_crash(self):
+        d = self.assertFailure(self.get("/news").deferred, error.Error)
+
+        @d.addCallback
+        def verify(e):
+            self.assertEqual(e.status, "502")
+            errors = self.flushLoggedErrors(offload.OffloadError)
+            self.assertEqual(len(errors), 1)
+
+        return d
+
+
+
+class OffloadTimeoutTest(OffloadTestMixin, TestCase):
+    mangler = staticmethod(slowMangler)
+
+    def proxyConstructor(self):
+        factory = OffloadTestMixin.proxyConstructor(self)
+        self.pool.timeout = 0.5
+        return factory
+
+
+    def test_timeout(self):
+        d = self.assertFailure(self.get("/news").deferred, error.Error)
+
+        @d.addCallback
+        def verify(e):
+            self.assertEqual(e.status, "504")
+            errors = self.flushLoggedErrors(offload.OffloadTimeout)
+            self.assertEqual(len(errors), 1)
+
+        return d
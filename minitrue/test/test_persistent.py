@@ -0,0 +1,191 @@
+"""
+Tests for keeping connections to clients alive.
+"""
+from twisted.internet import defer, protocol, reactor
+from twisted.trial.unittest import TestCase
+
+from minitrue import proxy
+from minitrue.utils import StringIO
+from minitrue.test.test_functional import buildTarget
+from minitrue.test.test_tunnel import _Client
+
+
+def _lengthChangingMangler(response):
+    """
+    Makes the chocolate ration sound more generous, in more words.
+    """
+    content = response.content.read()
+    response.content = StringIO(content.replace("20g", "twenty grams"))
+
+
+
+class _ProxyConnectionMixin(object):
+    def tearDown(self):
+        return defer.gatherResults([self.proxy.stopListening(),
+                                    self.target.stopListening()])
+
+
+    @defer.inlineCallbacks
+    def connect(self):
+        creator = protocol.ClientCreator(reactor, _Client)
+        client = yield creator.connectTCP("127.0.0.1",
+                                          self.proxy.getHost().port)
+        self.addCleanup(client.transport.loseConnection)
+        defer.returnValue(client)
+
+
+    def request(self, path, version="HTTP/1.1", headers=""):
+        url = "http://127.0.0.1:%d%s" % (self.target.getHost().port, path)
+        return "GET %s %s\r\nHost: 127.0.0.1\r\n%s\r\n" % (url, version,
+                                                           headers)
+
+
+
+class PersistentConnectionTest(_ProxyConnectionMixin, TestCase):
+    responseMangler = staticmethod(_lengthChangingMangler)
+
+    def setUp(self):
+        factory = proxy.MinitrueFactory(responseMangler=self.responseMangler)
+        self.proxy = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        self.target = reactor.listenTCP(0, buildTarget(),
+                                        interface="127.0.0.1")
+
+
+    def assertResponses(self, received, bodies):
+        """
+        Asserts that the received data consists of responses with the given
+        bodies, each delimited by its ``Content-Length``.
+        """
+        for body in bodies:
+            head, received = received.split("\r\n\r\n", 1)
+            self.assertIn("Content-Length: %d" % (len(body),), head)
+            self.assertEqual(received[:len(body)], body)
+            received = received[len(body):]
+
+        self.assertEqual(received, "")
+
+
+    @defer.inlineCallbacks
+    def test_pipelined(self):
+        """
+        Pipelined requests are answered in order over the same connection,
+        with the length of the (mangled) bodies.
+        """
+        client = yield self.connect()
+        client.transport.write(self.request("/news") + self.request("/book"))
+        received = yield client.waitFor("...")
+
+        news = ("Chocolate rations have been decreased to twenty grams per "
+                "week.")
+        book = "Chapter I: Ignorance is Strength\n\n..."
+        if self.responseMangler is None:
+            news = news.replace("twenty grams", "20g")
+        self.assertResponses(received, [news, book])
+        self.assertTrue(client.transport.connected)
+
+
+    @defer.inlineCallbacks
+    def test_sequential(self):
+        """
+        The connection stays open for another request after a response.
+        """
+        client = yield self.connect()
+        client.transport.write(self.request("/book"))
+        yield client.waitFor("...")
+
+        client.received = ""
+        client.transport.write(self.request("/book"))
+        received = yield client.waitFor("...")
+        self.assertResponses(received, ["Chapter I: Ignorance is Strength"
+                                        "\n\n..."])
+
+
+    @defer.inlineCallbacks
+    def test_http10KeepAlive(self):
+        """
+        HTTP/1.0 clients that ask for it have their connections kept alive.
+        """
+        client = yield self.connect()
+        request = self.request("/book", "HTTP/1.0",
+                               "Connection: keep-alive\r\n")
+        client.transport.write(request)
+        received = yield client.waitFor("...")
+        self.assertIn("Connection: Keep-Alive", received)
+
+        client.received = ""
+        client.transport.write(request)
+        yield client.waitFor("...")
+
+
+    @defer.inlineCallbacks
+    def test_http10Close(self):
+        """
+        Connections to other HTTP/1.0 clients are closed after the response.
+        """
+        client = yield self.connect()
+        client.transport.write(self.request("/book", "HTTP/1.0"))
+        received = yield client.closed
+        self.assertTrue(received.endswith("..."))
+
+
+
+class PassthroughPersistentConnectionTest(PersistentConnectionTest):
+    """
+    Responses that aren't mangled are relayed over persistent connections
+    too, including to pipelined requests.
+    """
+    responseMangler = None
+
+
+
+class _Truncating(protocol.Protocol):
+    """
+    A remote server that promises a longer body than it sends, and then
+    hangs up.
+    """
+    def dataReceived(self, data):
+        self.transport.write("HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n")
+        self.transport.write("x" * 40)
+        self.transport.loseConnection()
+
+
+
+class TruncatedResponseTest(_ProxyConnectionMixin, TestCase):
+    """
+    Responses that the remote server cuts short aren't passed off as
+    complete.
+    """
+    def setUp(self):
+        self.mangled = []
+        factory = proxy.MinitrueFactory(responseMangler=self.mangled.append)
+        self.proxy = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        target = protocol.Factory()
+        target.protocol = _Truncating
+        self.target = reactor.listenTCP(0, target, interface="127.0.0.1")
+
+
+    @defer.inlineCallbacks
+    def test_mangled(self):
+        """
+        An incomplete response isn't mangled, and the client gets a 502.
+        """
+        client = yield self.connect()
+        client.transport.write(self.request("/"))
+        received = yield client.waitFor("incomplete.")
+        self.assertTrue(received.startswith("HTTP/1.1 502 "))
+        self.assertEqual(self.mangled, [])
+        self.assertTrue(client.transport.connected)
+
+
+    @defer.inlineCallbacks
+    def test_relayed(self):
+        """
+        If the incomplete response was already being relayed, the connection
+        to the client is closed, so it can tell it's incomplete.
+        """
+        self.proxy.factory.responseMangler = None
+        client = yield self.connect()
+        client.transport.write(self.request("/"))
+        received = yield client.closed
+        self.assertIn("Content-Length: 100", received)
+        self.assertTrue(received.endswith("x" * 40))
@@ -0,0 +1,163 @@
+"""
+Tests for persistent connections to upstream servers.
+"""
+from twisted.internet import protocol, reactor
+from twisted.trial.unittest import TestCase
+from twisted.web import error, resource, server
+
+from minitrue import pool, proxy
+from minitrue.test.test_functional import ProxyTestMixin, buildTarget
+
+
+class _Chunked(resource.Resource):
+    """
+    A resource that doesn't know how long it is in advance.
+    """
+    def render_GET(self, request):
+        request.write("War is Peace. ")
+        reactor.callLater(0, self._finish, request)
+        return server.NOT_DONE_YET
+
+
+    def _finish(self, request):
+        request.write("Freedom is Slavery.")
+        request.finish()
+
+
+
+class _PoolTestMixin(ProxyTestMixin):
+    streamBodies = False
+
+    def proxyConstructor(self):
+        self.pool = pool.ConnectionPool()
+        return proxy.MinitrueFactory(pool=self.pool,
+                                     streamBodies=self.streamBodies)
+
+
+    def tearDown(self):
+        ProxyTestMixin.tearDown(self)
+        return self.pool.closeCachedConnections()
+
+
+    def verifyConnectionCounts(self, result, created, reused):
+        self.assertEqual(self.pool.created, created)
+        self.assertEqual(self.pool.reused, reused)
+        return result
+
+
+
+class PoolingTest(_PoolTestMixin, TestCase):
+    def buildTarget(self):
+        site = buildTarget()
+        site.resource.putChild("slogans", _Chunked())
+        return site
+
+
+    def test_reused(self):
+        """
+        Consecutive requests to the same server are made over the same
+        connection.
+        """
+        d = self.get("/news").deferred
+        d.addCallback(self.verifyConnectionCounts, 1, 0)
+        d.addCallback(lambda _: self.get("/book").deferred)
+        d.addCallback(self.verifyConnectionCounts, 1, 1)
+        d.addCallback(lambda content: self.assertIn("Ignorance", content))
+        return d
+
+
+    def test_chunked(self):
+        """
+        Chunked responses are decoded, and the connection is reused
+        afterwards.
+        """
+        d = self.get("/slogans").deferred
+        d.addCallback(self.assertEqual, "War is Peace. Freedom is Slavery.")
+        d.addCallback(lambda _: self.get("/news").deferred)
+        d.addCallback(self.verifyConnectionCounts, 1, 1)
+        return d
+
+
+
+class _Forgetful(protocol.Protocol):
+    """
+    A remote server that keeps connections alive after the first response,
+    but then closes them instead of answering another request.
+    """
+    def connectionMade(self):
+        self.received = ""
+        self.answered = False
+
+
+    def dataReceived(self, data):
+        self.received += data
+        if "\r\n\r\n" not in self.received:
+            return
+        elif self.answered:
+            self.transport.loseConnection()
+            return
+
+        self.factory.requests.append(self.received.split(" ", 1)[0])
+        self.received = ""
+        self.answered = True
+        self.transport.write("HTTP/1.1 200 OK\r\n"
+                             "Content-Length: 2\r\n\r\nok")
+
+
+
+class RetryTest(_PoolTestMixin, TestCase):
+    """
+    Requests over reused connections that the remote server closed are
+    retried, but only if that is safe.
+    """
+    def buildTarget(self):
+        self.target = protocol.Factory()
+        self.target.protocol = _Forgetful
+        self.target.requests = []
+        return self.target
+
+
+    def send(self, method):
+        body = "Down with Big Brother"
+        return self.get("/", method=method, postdata=body).deferred
+
+
+    def test_reused(self):
+        """
+        Idempotent requests are retried over a new connection.
+        """
+        d = self.get("/").deferred
+        d.addCallback(lambda _: self.get("/").deferred)
+        d.addCallback(self.assertEqual, "ok")
+        d.addCallback(self.verifyConnectionCounts, 2, 1)
+        return d
+
+
+    def test_notIdempotent(self):
+        """
+        Requests that aren't idempotent aren't retried, because the server
+        may have acted on them. The client gets a 502 instead.
+        """
+        d = self.get("/").deferred
+        d.addCallback(lambda _: self.send("POST"))
+        d = self.assertFailure(d, error.Error)
+        d.addCallback(lambda e: self.assertEqual(e.status, "502"))
+        d.addCallback(lambda _: self.assertEqual(self.target.requests,
+                                                 ["GET"]))
+        return d
+
+
+
+class StreamedBodyRetryTest(RetryTest):
+    streamBodies = True
+
+    def test_streamedBody(self):
+        """
+        Requests with a streamed body aren't retried, because the body has
+        already been consumed.
+        """
+        d = self.get("/").deferred
+        d.addCallback(lambda _: self.send("PUT"))
+        d = self.assertFailure(d, error.Error)
+        d.addCallback(lambda e: self.assertEqual(e.status, "502"))
+        return d
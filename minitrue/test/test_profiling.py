@@ -0,0 +1,138 @@
+"""
+Tests for profiling manglers.
+"""
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+
+from minitrue import profiling, proxy, utils
+from minitrue.test.observer import ObserverMixin, SubstringObserver
+from minitrue.test.test_functional import ProxyTestMixin, responseMangler
+
+
+class _Request(object):
+    uri = "http://minitrue.oc/news"
+
+
+
+def _rectify(request):
+    return _rewrite(request.uri)
+
+
+def _rewrite(uri):
+    return uri.replace("news", "lies")
+
+
+
+class ProfilerTest(ObserverMixin, TestCase):
+    def test_run(self):
+        """
+        Calls are counted and timed per function.
+        """
+        profiler = profiling.Profiler()
+        self.assertEqual(profiler.run(_rectify, _Request()),
+                         "http://minitrue.oc/lies")
+        profiler.run(_rectify, _Request())
+
+        stats = profiler.snapshot()["_rectify"]
+        self.assertEqual(stats["calls"], 2)
+        self.assertTrue(stats["wallTime"] >= stats["cpuTime"] >= 0)
+        self.assertEqual(stats["slowCalls"], 0)
+
+
+    def test_slow(self):
+        """
+        Slow calls are logged with the URI of the request.
+        """
+        observer = SubstringObserver("Slow call to _rectify")
+        self.addObserver(observer)
+        profiler = profiling.Profiler(slowThreshold=0)
+        profiler.run(_rectify, _Request())
+
+        self.verifyObserved(None, observer)
+        self.assertEqual(profiler.stats["_rectify"].slowCalls, 1)
+        uriObserver = SubstringObserver("for http://minitrue.oc/news")
+        self.addObserver(uriObserver)
+        profiler.run(_rectify, _Request())
+        self.verifyObserved(None, uriObserver)
+
+
+    def test_call(self):
+        """
+        For calls that return deferreds, the wall time is recorded when the
+        deferred fires.
+        """
+        profiler = profiling.Profiler()
+        pending = defer.Deferred()
+        d = profiler.call(lambda request: pending, _Request())
+        self.assertEqual(profiler.stats, {})
+
+        pending.callback("Doubleplusgood")
+        self.assertEqual(profiler.stats["<lambda>"].calls, 1)
+        d.addCallback(self.assertEqual, "Doubleplusgood")
+        return d
+
+
+    def test_sampledStacks(self):
+        """
+        The stacks of sampled calls are captured, in folded format.
+        """
+        profiler = profiling.Profiler(sampleRate=0.5, random=lambda: 0.25)
+        for _ in range(100):
+            profiler.run(_rectify, _Request())
+
+        stacks = profiler.foldedStacks()
+        self.assertIn("_rectify;test_profiling.py:_rectify;"
+                      "test_profiling.py:_rewrite", stacks)
+        for line in stacks.splitlines():
+            stack, microseconds = line.rsplit(" ", 1)
+            self.assertTrue(stack.startswith("_rectify"))
+            self.assertTrue(int(microseconds) > 0)
+
+
+    def test_notSampled(self):
+        profiler = profiling.Profiler(sampleRate=0.5, random=lambda: 0.75)
+        profiler.run(_rectify, _Request())
+        self.assertEqual(profiler.foldedStacks(), "")
+
+
+
+class CombinedProfilingTest(TestCase):
+    @defer.inlineCallbacks
+    def test_parts(self):
+        """
+        Parts of combined manglers are profiled by name, including blocking
+        parts.
+        """
+        profiler = profiling.Profiler()
+        combined = utils.Combined()
+
+        @combined.part
+        def inReactor(request):
+            pass
+
+        @combined.part(blocking=True)
+        def inThread(request):
+            pass
+
+        combined.profiler = profiler
+        yield combined(_Request())
+        self.assertEqual(profiler.stats["inReactor"].calls, 1)
+        self.assertEqual(profiler.stats["inThread"].calls, 1)
+
+
+
+class ProxyProfilingTest(ProxyTestMixin, TestCase):
+    def proxyConstructor(self):
+        self.profiler = profiling.Profiler()
+        return proxy.MinitrueFactory(responseMangler=responseMangler,
+                                     profiler=self.profiler)
+
+
+    def test_responseMangler(self):
+        """
+        The response mangler is profiled.
+        """
+        d = self.get("/news").deferred
+        d.addCallback(lambda _: self.profiler.stats["responseMangler"].calls)
+        d.addCallback(self.assertEqual, 1)
+        return d
@@ -0,0 +1,97 @@
+"""
+Tests for recording and replaying responses from remote servers.
+"""
+from twisted.internet import defer, reactor
+from twisted.trial.unittest import TestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+from minitrue import metrics, proxy, recording
+from minitrue.test.connect import getWithProxy
+from minitrue.test.test_functional import ProxyTestMixin, responseMangler
+
+
+class RecordingTest(ProxyTestMixin, TestCase):
+    def proxyConstructor(self):
+        self.path = self.mktemp()
+        self.recorder = recording.Recorder(self.path)
+        return proxy.MinitrueFactory(recorder=self.recorder)
+
+
+    def tearDown(self):
+        self.recorder.close()
+        return ProxyTestMixin.tearDown(self)
+
+
+    def replayingProxy(self):
+        """
+        Starts a proxy that replays the recording, and mangles the responses.
+        """
+        self.recorder.close()
+        replayer = recording.Replayer(self.path)
+        self.addCleanup(replayer.close)
+
+        self.metrics = metrics.Metrics()
+        factory = proxy.MinitrueFactory(responseMangler=responseMangler,
+                                        replayer=replayer,
+                                        metrics=self.metrics)
+        port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        return port.getHost().port
+
+
+    def replay(self, port, url):
+        return getWithProxy(url, "127.0.0.1", port)
+
+
+    @defer.inlineCallbacks
+    def test_replayed(self):
+        """
+        Recorded responses are replayed without contacting the remote
+        server, and are mangled.
+        """
+        original = yield self.get("/news").deferred
+        yield self.get("/book").deferred
+        self.assertIn("decreased", original)
+
+        newsURL = self._buildURL("/news", "", "")
+        bookURL = self._buildURL("/book", "", "")
+        port = self.replayingProxy()
+        yield self.listeningPorts.pop("target").stopListening()
+
+        replayed = yield self.replay(port, newsURL).deferred
+        self.assertEqual(replayed, original.replace("decreased", "increased"))
+        book = yield self.replay(port, bookURL).deferred
+        self.assertTrue(book.startswith("Chapter I"))
+
+
+    @defer.inlineCallbacks
+    def test_notRecorded(self):
+        """
+        Requests that weren't recorded get a 502.
+        """
+        port = self.replayingProxy()
+        factory = self.replay(port, self._buildURL("/news", "", ""))
+        yield self.assertFailure(factory.deferred, Exception)
+        self.assertEqual(factory.status, "502")
+        self.assertEqual(self.metrics.counters["notRecorded"], 1)
+
+
+    @defer.inlineCallbacks
+    def test_index(self):
+        """
+        The index has the method, URL and location of each response.
+        """
+        yield self.get("/book").deferred
+        self.recorder.close()
+        replayer = recording.Replayer(self.path)
+        self.addCleanup(replayer.close)
+
+        [(method, url)] = replayer.entries.keys()
+        self.assertEqual(method, "GET")
+        self.assertTrue(url.endswith("/book"))
+
+        request = DummyRequest([])
+        request.method, request.uri = method, url
+        view = replayer.lookup(request)
+        self.assertTrue(str(view).startswith("HTTP/1.1 200 OK\r\n"))
+        self.assertTrue(str(view).endswith("Strength\n\n..."))
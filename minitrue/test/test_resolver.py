@@ -0,0 +1,112 @@
+"""
+Tests for caching hostname resolution.
+"""
+import urlparse
+
+from twisted.internet import defer, error, task
+from twisted.trial.unittest import TestCase
+
+from minitrue import proxy, resolver
+from minitrue.test.test_functional import ProxyTestMixin
+
+
+class _FakeResolver(object):
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.lookups = []
+        self.pending = []
+
+
+    def getHostByName(self, name):
+        self.lookups.append(name)
+        d = defer.Deferred()
+        self.pending.append((d, name))
+        return d
+
+
+    def answer(self):
+        pending, self.pending = self.pending, []
+        for d, name in pending:
+            if name in self.hosts:
+                d.callback(self.hosts[name])
+            else:
+                d.errback(error.DNSLookupError(name))
+
+
+
+class CachingResolverTest(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.fake = _FakeResolver({"minitrue.oc": "10.0.0.1"})
+        self.resolver = resolver.CachingResolver(ttl=10, negativeTTL=1,
+                                                 resolver=self.fake,
+                                                 reactor=self.clock)
+
+
+    def lookup(self, name):
+        results = []
+        self.resolver.getHostByName(name).addBoth(results.append)
+        self.fake.answer()
+        return results[0]
+
+
+    def test_cached(self):
+        self.assertEqual(self.lookup("minitrue.oc"), "10.0.0.1")
+        self.assertEqual(self.lookup("MINITRUE.oc"), "10.0.0.1")
+        self.assertEqual(self.fake.lookups, ["minitrue.oc"])
+
+
+    def test_expired(self):
+        self.lookup("minitrue.oc")
+        self.clock.advance(10)
+        self.lookup("minitrue.oc")
+        self.assertEqual(self.fake.lookups, ["minitrue.oc"] * 2)
+
+
+    def test_negative(self):
+        for _ in range(2):
+            self.lookup("minipax.oc").trap(error.DNSLookupError)
+        self.assertEqual(self.fake.lookups, ["minipax.oc"])
+
+        self.clock.advance(1)
+        self.lookup("minipax.oc")
+        self.assertEqual(self.fake.lookups, ["minipax.oc"] * 2)
+
+
+    def test_concurrent(self):
+        """
+        Concurrent lookups of the same name share a single lookup.
+        """
+        ds = [self.resolver.getHostByName("minitrue.oc") for _ in range(3)]
+        self.fake.answer()
+        self.assertEqual(self.fake.lookups, ["minitrue.oc"])
+        d = defer.gatherResults(ds)
+        d.addCallback(self.assertEqual, ["10.0.0.1"] * 3)
+        return d
+
+
+    def test_hosts(self):
+        self.resolver.addHosts({"Miniluv.oc": "10.0.0.2"})
+        self.assertEqual(self.lookup("miniluv.oc"), "10.0.0.2")
+        self.assertEqual(self.lookup("10.0.0.3"), "10.0.0.3")
+        self.assertEqual(self.fake.lookups, [])
+
+
+
+class ResolvingProxyTest(ProxyTestMixin, TestCase):
+    def proxyConstructor(self):
+        self.resolver = resolver.CachingResolver()
+        self.resolver.addHosts({"minitrue.oc": "127.0.0.1"})
+        return proxy.MinitrueFactory(resolver=self.resolver)
+
+
+    def _buildURL(self, path, query, fragment):
+        port = self.listeningPorts["target"].getHost().port
+        netloc = "minitrue.oc:%s" % (port,)
+        return urlparse.urlunsplit(("http", netloc, path, query, fragment))
+
+
+    def test_resolved(self):
+        d = self.get("/book").deferred
+        d.addCallback(lambda content: self.assertIn("Ignorance", content))
+        return d
@@ -0,0 +1,116 @@
+"""
+Tests for running the proxy from the command line.
+"""
+import signal
+
+from twisted.python import usage
+from twisted.trial.unittest import TestCase
+
+from minitrue import pool, serve
+from minitrue.test.test_functional import requestMangler
+from minitrue.utils import Combined
+
+
+combined = Combined()
+
+
+class OptionsTest(TestCase):
+    def parse(self, *argv):
+        options = serve.Options()
+        options.parseOptions(argv)
+        return options
+
+
+    def test_defaults(self):
+        options = self.parse()
+        self.assertEqual(options["port"], 8080)
+        self.assertEqual(options["workers"], 1)
+
+
+    def test_noWorkers(self):
+        self.assertRaises(usage.UsageError, self.parse, "--workers", "0")
+
+
+    def test_buildFactory(self):
+        name = "minitrue.test.test_functional.requestMangler"
+        options = self.parse("--request-mangler", name, "--pool")
+        factory = serve.buildFactory(options)
+        self.assertIdentical(factory.requestMangler, requestMangler)
+        self.assertIdentical(factory.responseMangler, None)
+        self.assertIsInstance(factory.pool, pool.ConnectionPool)
+
+
+    def test_admission(self):
+        options = self.parse("--max-per-host", "4", "--max-queued", "8")
+        admission = serve.buildFactory(options).admission
+        self.assertEqual(admission.maxPerHost, 4)
+        self.assertIdentical(admission.maxTotal, None)
+        self.assertEqual(admission.maxQueued, 8)
+
+
+    def test_deadlines(self):
+        options = self.parse("--first-byte-timeout", "2.5",
+                             "--mangler-timeout", "1")
+        deadlines = serve.buildFactory(options).deadlines
+        self.assertEqual(deadlines.firstByte, 2.5)
+        self.assertEqual(deadlines.responseMangler, 1.0)
+        self.assertIdentical(deadlines.connect, None)
+
+
+    def test_connectPorts(self):
+        factory = serve.buildFactory(self.parse())
+        self.assertEqual(factory.connectPorts, (443,))
+        options = self.parse("--connect-ports", "443,8443")
+        self.assertEqual(serve.buildFactory(options).connectPorts, (443, 8443))
+
+
+    def test_upstreamCA(self):
+        options = self.parse("--upstream-ca", "ca.pem")
+        clientContexts = serve.buildFactory(options).clientContexts
+        self.assertEqual(clientContexts.caFile, "ca.pem")
+
+
+    def test_recordWithWorkers(self):
+        self.assertRaises(usage.UsageError, self.parse, "--record", "r",
+                          "--workers", "2")
+
+
+    def test_profiler(self):
+        name = "minitrue.test.test_serve.combined"
+        options = self.parse("--response-mangler", name, "--profile-slow", "1")
+        factory = serve.buildFactory(options)
+        self.addCleanup(setattr, combined, "profiler", None)
+        self.assertEqual(factory.profiler.slowThreshold, 1.0)
+        self.assertIdentical(combined.profiler, factory.profiler)
+
+
+
+class _Exited(Exception):
+    pass
+
+
+
+class SupervisorTest(TestCase):
+    def test_workerSignals(self):
+        """
+        Workers don't keep the supervisor's signal handlers.
+        """
+        handlers = []
+
+        def runWorker(sock, options):
+            handlers.append(signal.getsignal(signal.SIGTERM))
+            handlers.append(signal.getsignal(signal.SIGINT))
+
+        def exit(status):
+            raise _Exited(status)
+
+        supervisor = serve.Supervisor(None, {})
+        for signum in [signal.SIGTERM, signal.SIGINT]:
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+            signal.signal(signum, supervisor.stop)
+
+        self.patch(serve.os, "fork", lambda: 0)
+        self.patch(serve.os, "_exit", exit)
+        self.patch(serve, "runWorker", runWorker)
+        self.assertRaises(_Exited, supervisor.spawn)
+        self.assertEqual(handlers, [signal.SIG_DFL, signal.SIG_DFL])
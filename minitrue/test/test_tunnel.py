@@ -0,0 +1,130 @@
+"""
+Tests for tunnelling ``CONNECT`` requests.
+"""
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols import wire
+from twisted.trial.unittest import TestCase
+
+from minitrue import metrics, proxy
+
+
+class _Client(protocol.Protocol):
+    """
+    A client that records everything it receives.
+    """
+    def __init__(self):
+        self.received = ""
+        self.waiting = []
+        self.closed = defer.Deferred()
+
+
+    def dataReceived(self, data):
+        self.received += data
+        for expected, d in self.waiting[:]:
+            if expected in self.received:
+                self.waiting.remove((expected, d))
+                d.callback(self.received)
+
+
+    def waitFor(self, expected):
+        if expected in self.received:
+            return defer.succeed(self.received)
+        d = defer.Deferred()
+        self.waiting.append((expected, d))
+        return d
+
+
+    def connectionLost(self, reason):
+        self.closed.callback(self.received)
+
+
+
+class TunnelTest(TestCase):
+    def setUp(self):
+        echo = protocol.Factory()
+        echo.protocol = wire.Echo
+        self.target = reactor.listenTCP(0, echo, interface="127.0.0.1")
+
+        self.metrics = metrics.Metrics()
+        factory = proxy.MinitrueFactory(
+            metrics=self.metrics, tunnelIdleTimeout=0.5,
+            connectPorts=[self.target.getHost().port])
+        self.proxy = reactor.listenTCP(0, factory, interface="127.0.0.1")
+
+
+    def tearDown(self):
+        ports = [self.proxy, self.target]
+        return defer.gatherResults([defer.maybeDeferred(port.stopListening)
+                                    for port in ports])
+
+
+    @defer.inlineCallbacks
+    def connect(self, port):
+        creator = protocol.ClientCreator(reactor, _Client)
+        client = yield creator.connectTCP("127.0.0.1",
+                                          self.proxy.getHost().port)
+        request = "CONNECT 127.0.0.1:%d HTTP/1.1\r\n\r\n" % (port,)
+        client.transport.write(request + "Big Brother")
+        defer.returnValue(client)
+
+
+    @defer.inlineCallbacks
+    def test_relayed(self):
+        """
+        After the tunnel is established, data is relayed in both directions.
+        """
+        client = yield self.connect(self.target.getHost().port)
+        received = yield client.waitFor("Big Brother")
+        self.assertEqual(received, "HTTP/1.1 200 Connection established"
+                                   "\r\n\r\nBig Brother")
+
+        client.transport.write(" is watching you")
+        yield client.waitFor("watching you")
+        self.assertEqual(self.metrics.counters["openTunnels"], 1)
+
+        client.transport.loseConnection()
+        yield client.closed
+        self.assertEqual(self.metrics.counters["tunnels"], 1)
+
+
+    @defer.inlineCallbacks
+    def test_idle(self):
+        """
+        Idle tunnels are closed.
+        """
+        client = yield self.connect(self.target.getHost().port)
+        yield client.closed
+        self.assertEqual(self.metrics.counters["openTunnels"], 0)
+        self.assertEqual(self.metrics.counters["inFlight"], 0)
+
+
+    @defer.inlineCallbacks
+    def test_connectionFailed(self):
+        """
+        When the remote server can't be reached, the client gets an error.
+        """
+        port = self.target.getHost().port
+        yield self.target.stopListening()
+        client = yield self.connect(port)
+        received = yield client.closed
+        self.assertTrue(received.startswith("HTTP/1.1 502"))
+
+
+    @defer.inlineCallbacks
+    def test_portNotAllowed(self):
+        """
+        Tunnels can only be opened to the allowed ports. Requests for others
+        are refused.
+        """
+        client = yield self.connect(self.proxy.getHost().port)
+        received = yield client.closed
+        self.assertTrue(received.startswith("HTTP/1.1 403"))
+        self.assertEqual(self.metrics.counters["connectRefused"], 1)
+        self.assertEqual(self.metrics.counters["tunnels"], 0)
+
+
+    def test_defaultPorts(self):
+        """
+        By default, tunnels can only be opened to port 443.
+        """
+        self.assertEqual(proxy.MinitrueFactory().connectPorts, (443,))
@@ -0,0 +1,170 @@
+"""
+Tests for the generically useful utilities.
+"""
+import threading
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+
+from minitrue import metrics, utils
+
+
+class CombinedTest(TestCase):
+    def setUp(self):
+        self.combined = utils.Combined()
+
+
+    @defer.inlineCallbacks
+    def test_blocking(self):
+        threads = []
+
+        @self.combined.part
+        def inReactor():
+            threads.append(("inReactor", threading.currentThread()))
+
+        @self.combined.part(blocking=True)
+        def inThread():
+            threads.append(("inThread", threading.currentThread()))
+
+        yield self.combined()
+        threads = dict(threads)
+        self.assertIdentical(threads["inReactor"], threading.currentThread())
+        self.assertNotIdentical(threads["inThread"], threading.currentThread())
+
+
+    @defer.inlineCallbacks
+    def test_concurrency(self):
+        release = threading.Event()
+
+        @self.combined.part(blocking=True, concurrency=1)
+        def block():
+            release.wait(10)
+
+        d = defer.gatherResults([self.combined() for _ in range(3)])
+        queue = self.combined.queues[block]
+        self.assertEqual(queue.running, 1)
+        self.assertEqual(queue.waiting, 2)
+
+        release.set()
+        yield d
+        self.assertEqual(queue.running, 0)
+        self.assertEqual(queue.waiting, 0)
+        self.assertEqual(queue.peakWaiting, 2)
+
+
+    @defer.inlineCallbacks
+    def test_failure(self):
+        @self.combined.part(blocking=True)
+        def broken():
+            raise RuntimeError()
+
+        queue = self.combined.queues[broken]
+        yield self.assertFailure(queue(), RuntimeError)
+        self.assertEqual(queue.running, 0)
+
+
+    @defer.inlineCallbacks
+    def test_metrics(self):
+        self.combined.metrics = recorded = metrics.Metrics()
+
+        @self.combined.part(blocking=True)
+        def part():
+            pass
+
+        yield self.combined()
+        self.assertEqual(recorded.histograms["queued:part"].count, 1)
+
+
+
+class OrderedCombinedTest(TestCase):
+    @defer.inlineCallbacks
+    def test_order(self):
+        combined = utils.OrderedCombined()
+        calls = []
+
+        @combined.part(blocking=True)
+        def first():
+            calls.append("first")
+
+        @combined.part
+        def second():
+            calls.append("second")
+
+        yield combined()
+        self.assertEqual(calls, ["first", "second"])
+
+
+
+class SpillingBufferTest(TestCase):
+    def test_inMemory(self):
+        buffer = utils.SpillingBuffer(threshold=10)
+        buffer.write("small")
+        self.assertFalse(buffer.spilled)
+        self.assertEqual(buffer.view(), "small")
+        self.assertEqual(len(buffer), 5)
+
+
+    def test_spilled(self):
+        buffer = utils.SpillingBuffer(threshold=10)
+        buffer.write("small")
+        buffer.write(" and then large")
+        self.assertTrue(buffer.spilled)
+        self.assertEqual(len(buffer), 20)
+        self.assertEqual(buffer.view()[:], "small and then large")
+        self.assertEqual(buffer.getvalue(), "small and then large")
+
+        buffer.seek(0, 0)
+        self.assertEqual(buffer.read(5), "small")
+        buffer.close()
+
+
+    def test_budget(self):
+        budget = utils.BufferBudget(8)
+        first = utils.SpillingBuffer(threshold=10, budget=budget)
+        first.write("abcdef")
+        second = utils.SpillingBuffer(threshold=10, budget=budget)
+        second.write("ghijkl")
+        self.assertFalse(first.spilled)
+        self.assertTrue(second.spilled)
+        self.assertEqual(budget.used, 6)
+
+        first.close()
+        second.close()
+        self.assertEqual(budget.used, 0)
+
+
+    def test_fileMethods(self):
+        """
+        Buffers support the file methods manglers use, both in memory and
+        spilled.
+        """
+        for threshold in [1024, 10]:
+            buffer = utils.SpillingBuffer(threshold=threshold)
+            buffer.writelines(["first\n", "second\n", "third\n"])
+            buffer.flush()
+
+            buffer.seek(0, 0)
+            self.assertEqual(buffer.readline(), "first\n")
+            self.assertEqual(buffer.readlines(), ["second\n", "third\n"])
+            buffer.seek(0, 0)
+            self.assertEqual(list(buffer), ["first\n", "second\n", "third\n"])
+
+            buffer.seek(6, 0)
+            changes = buffer.changes
+            buffer.truncate()
+            self.assertEqual(buffer.changes, changes + 1)
+            self.assertEqual(len(buffer), 6)
+            self.assertEqual(buffer.view()[:], "first\n")
+            buffer.close()
+
+
+    def test_truncateReleases(self):
+        budget = utils.BufferBudget(8)
+        buffer = utils.SpillingBuffer(threshold=10, budget=budget)
+        buffer.write("abcdef")
+        buffer.truncate(2)
+        self.assertEqual(budget.used, 2)
+        self.assertEqual(buffer.getvalue(), "ab")
+
+        buffer.close()
+        self.assertEqual(budget.used, 0)
@@ -0,0 +1,121 @@
+"""
+Tunnelling of ``CONNECT`` requests.
+
+Once the connection to the remote server is made, bytes are relayed between
+the client and the remote server as they are, without parsing them. Each
+side is registered as the producer for the other, so neither side can make
+the proxy buffer more than a transport's worth of data.
+"""
+from twisted.internet import protocol
+
+
+class TunnelProtocol(protocol.Protocol):
+    """
+    The connection to the remote server of a tunnel.
+
+    Tunnels that have been idle (in both directions) for ``idleTimeout``
+    seconds are closed. Activity is only noted per chunk, and checked
+    periodically, to keep the per-chunk overhead low.
+    """
+    _active = False
+    _idleCheck = None
+
+    def __init__(self, request, idleTimeout):
+        self.request = request
+        self.channel = request.channel
+        self.idleTimeout = idleTimeout
+        self._pending = []
+
+
+    def connectionMade(self):
+        """
+        Tells the client the tunnel is established, and starts relaying.
+        """
+        request, channel = self.request, self.channel
+        request.metrics.increment("tunnels")
+        request.metrics.increment("openTunnels")
+
+        status = "%s 200 Connection established\r\n\r\n"
+        channel.transport.write(status % (request.clientproto,))
+
+        if self._pending:
+            self.transport.writeSequence(self._pending)
+            self._pending = None
+
+        self.transport.registerProducer(channel.transport, True)
+        channel.transport.registerProducer(self.transport, True)
+        channel.transport.resumeProducing()
+
+        if self.idleTimeout is not None:
+            self._scheduleIdleCheck()
+
+
+    def _scheduleIdleCheck(self):
+        clock = self.request.reactor
+        self._idleCheck = clock.callLater(self.idleTimeout, self._checkIdle)
+
+
+    def _checkIdle(self):
+        if self._active:
+            self._active = False
+            self._scheduleIdleCheck()
+        else:
+            self._idleCheck = None
+            self.transport.loseConnection()
+
+
+    def dataReceived(self, data):
+        """
+        Relays data from the remote server to the client.
+        """
+        self._active = True
+        self.channel.transport.write(data)
+
+
+    def relayFromClient(self, data):
+        """
+        Relays data from the client to the remote server.
+        """
+        self._active = True
+        if self._pending is None:
+            self.transport.write(data)
+        else:
+            self._pending.append(data)
+
+
+    def clientConnectionLost(self):
+        """
+        Called when the connection to the client is lost.
+        """
+        if self.transport is not None:
+            self.transport.loseConnection()
+
+
+    def connectionLost(self, reason):
+        if self._idleCheck is not None:
+            self._idleCheck.cancel()
+            self._idleCheck = None
+
+        self.request.metrics.increment("openTunnels", -1)
+        self.channel.transport.unregisterProducer()
+        self.channel.transport.loseConnection()
+
+
+
+class TunnelFactory(protocol.ClientFactory):
+    """
+    Builds the connection to the remote server of a tunnel.
+    """
+    noisy = False
+
+    def __init__(self, tunnel):
+        self.tunnel = tunnel
+
+
+    def buildProtocol(self, _):
+        self.tunnel.factory = self
+        return self.tunnel
+
+
+    def clientConnectionFailed(self, connector, reason):
+        self.tunnel.request._tunnelFailed(reason)
@@ -1,9 +1,14 @@
 """
 Generically useful utilities.
 """
+import collections
+import functools
+import mmap
+import tempfile
+import time
 import urlparse
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor, threads
 from twisted.python import log
 
 try: # pragma: no cover
@@ -46,24 +51,404 @@ def replace(url, **kw):
 
 
 
+class LRUCache(object):
+    """
+    A cache that holds at most ``maxSize`` entries, evicting the least
+    recently used entries first.
+
+    If ``sizeOf`` is given, it is called with each value to determine its
+    size, and the total size of all values is limited instead. The current
+    total is available as ``size``.
+
+    ``hits`` and ``misses`` count the lookups that did and didn't find an
+    entry, respectively.
+    """
+    def __init__(self, maxSize, sizeOf=None):
+        self.maxSize = maxSize
+        self.sizeOf = sizeOf
+        self._entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key, default=None):
+        """
+        Looks up an entry, marking it as recently used.
+        """
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._entries[key] = value
+        return value
+
+
+    def __setitem__(self, key, value):
+        self.invalidate(key)
+        self._entries[key] = value
+        self.size += self._sizeOf(value)
+
+        while self.size > self.maxSize:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= self._sizeOf(evicted)
+
+
+    def _sizeOf(self, value):
+        return 1 if self.sizeOf is None else self.sizeOf(value)
+
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def invalidate(self, key=None):
+        """
+        Removes an entry, or all entries if no key is given.
+        """
+        if key is None:
+            self._entries.clear()
+            self.size = 0
+        elif key in self._entries:
+            self.size -= self._sizeOf(self._entries.pop(key))
+
+
+
+class BufferBudget(object):
+    """
+    A limit on the total number of bytes that buffers keep in memory.
+    """
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.used = 0
+
+
+    def reserve(self, size):
+        """
+        Reserves memory for some bytes, if that doesn't exceed the limit.
+
+        Returns ``True`` if the memory was reserved.
+        """
+        if self.used + size > self.maxBytes:
+            return False
+        self.used += size
+        return True
+
+
+    def release(self, size):
+        self.used -= size
+
+
+
+class SpillingBuffer(object):
+    """
+    A file-like buffer that is kept in memory while it is small, and spills
+    to a temporary file when it gets larger than ``threshold`` bytes, or
+    when keeping it in memory would exceed the given ``BufferBudget``.
+
+    Apart from that, it can be used like a ``cStringIO`` or a file. The
+    contents of a spilled buffer can be read without copying them into
+    memory with ``view``, which returns a memory map of the file.
+
+    ``changes`` counts the writes to the buffer, so that users can tell if
+    it was changed since they last looked.
+    """
+    spilled = False
+    changes = 0
+
+    def __init__(self, threshold=1024 * 1024, budget=None):
+        self.threshold = threshold
+        self.budget = budget
+        self._file = StringIO()
+        self._reserved = 0
+        self._length = 0
+        self._view = None
+
+
+    def write(self, data):
+        if not self.spilled:
+            size = self._reserved + len(data)
+            if size > self.threshold or not self._reserve(len(data)):
+                self._spill()
+
+        self._closeView()
+        self._file.write(data)
+        self._length = max(self._length, self._file.tell())
+        self.changes += 1
+
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+
+    def truncate(self, size=None):
+        """
+        Truncates the buffer to the given size, or the current position.
+        """
+        if size is None:
+            size = self._file.tell()
+
+        self._closeView()
+        self._file.truncate(size)
+        self._length = min(self._length, size)
+        self.changes += 1
+
+        if not self.spilled and self.budget is not None:
+            excess = self._reserved - self._length
+            if excess > 0:
+                self.budget.release(excess)
+                self._reserved -= excess
+
+
+    def flush(self):
+        self._file.flush()
+
+
+    def _closeView(self):
+        if self._view is not None:
+            self._view.close()
+            self._view = None
+
+
+    def _reserve(self, size):
+        if self.budget is not None and not self.budget.reserve(size):
+            return False
+        self._reserved += size
+        return True
+
+
+    def _release(self):
+        if self.budget is not None:
+            self.budget.release(self._reserved)
+        self._reserved = 0
+
+
+    def _spill(self):
+        """
+        Moves the contents of this buffer to a temporary file.
+        """
+        spilled = tempfile.TemporaryFile()
+        spilled.write(self._file.getvalue())
+        spilled.seek(self._file.tell(), 0)
+        self._file = spilled
+        self.spilled = True
+        self._release()
+
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+
+    def readline(self, size=-1):
+        return self._file.readline(size)
+
+
+    def readlines(self, sizehint=0):
+        return self._file.readlines(sizehint)
+
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+
+    def seek(self, offset, whence=0):
+        self._file.seek(offset, whence)
+
+
+    def tell(self):
+        return self._file.tell()
+
+
+    def __len__(self):
+        return self._length
+
+
+    def view(self):
+        """
+        Gets the contents of this buffer without copying them, if possible.
+
+        Returns a string, or a read-only memory map of the spilled buffer.
+        Either supports ``len``, slicing and searching.
+        """
+        if not self.spilled:
+            return self._file.getvalue()
+        elif not self._length:
+            return ""
+
+        if self._view is None:
+            self._file.flush()
+            fileno = self._file.fileno()
+            self._view = mmap.mmap(fileno, self._length,
+                                   access=mmap.ACCESS_READ)
+        return self._view
+
+
+    def getvalue(self):
+        if self.spilled:
+            return self.view()[:]
+        return self._file.getvalue()
+
+
+    def close(self):
+        """
+        Discards the contents of this buffer.
+        """
+        self._closeView()
+        self._file.close()
+        self._release()
+
+
+
+class _BlockingPart(object):
+    """
+    A blocking part of a combined function, which is run in a thread pool.
+
+    At most ``concurrency`` calls run at the same time; the others wait in a
+    queue. The number of waiting and running calls is available as
+    ``waiting`` and ``running``, and the largest number of calls that have
+    been waiting at the same time as ``peakWaiting``.
+    """
+    profiler = None
+
+    def __init__(self, f, concurrency, threadpool, reactor, metrics):
+        self.f = f
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+        self.threadpool = threadpool
+        self.reactor = reactor
+        self.metrics = metrics
+        self.name = getattr(f, "__name__", repr(f))
+
+        self.waiting = 0
+        self.running = 0
+        self.peakWaiting = 0
+
+
+    def __call__(self, *a, **kw):
+        self.waiting += 1
+        self.peakWaiting = max(self.peakWaiting, self.waiting)
+        queued = time.time()
+
+        d = self.semaphore.acquire()
+        d.addCallback(self._run, queued, a, kw)
+        return d
+
+
+    def _run(self, _, queued, a, kw):
+        self.waiting -= 1
+        self.running += 1
+        if self.metrics is not None:
+            self.metrics.recordSince("queued:" + self.name, queued)
+
+        if self.profiler is None:
+            f = self.f
+        else:
+            f = functools.partial(self.profiler.run, self.f)
+        d = threads.deferToThreadPool(self.reactor, self.threadpool,
+                                      f, *a, **kw)
+        d.addBoth(self._done)
+        return d
+
+
+    def _done(self, result):
+        self.running -= 1
+        self.semaphore.release()
+        return result
+
+
+
 class Combined(object):
-    def __init__(self):
+    """
+    A function that calls all of its parts.
+
+    Parts that block (because they do a lot of work, or blocking I/O) can
+    be marked as such, so that they are run in a thread pool instead of in
+    the reactor thread. Unless a thread pool is given, the reactor's thread
+    pool is used. If metrics are given, the time calls to blocking parts
+    spend waiting is recorded.
+
+    If a profiler (a ``minitrue.profiling.Profiler``) is given, or set as
+    ``profiler`` later, calls to each part are profiled. Blocking parts are
+    profiled in the thread they run in.
+    """
+    def __init__(self, threadpool=None, reactor=reactor, metrics=None,
+                 profiler=None):
         self._fs = []
+        self.queues = {}
+        self.threadpool = threadpool
+        self.reactor = reactor
+        self.metrics = metrics
+        self._profiler = None
+        self.profiler = profiler
+
+
+    @property
+    def profiler(self):
+        return self._profiler
 
 
-    def part(self, f):
-        self._fs.append(f)
+    @profiler.setter
+    def profiler(self, profiler):
+        self._profiler = profiler
+        for queue in self.queues.itervalues():
+            queue.profiler = profiler
+
+
+    def part(self, f=None, blocking=False, concurrency=1):
+        """
+        Decorator to add a part.
+
+        Blocking parts are run in a thread pool, with at most
+        ``concurrency`` calls at the same time. Their queues are available
+        in ``queues``, keyed by the part.
+        """
+        if f is None:
+            return functools.partial(self.part, blocking=blocking,
+                                     concurrency=concurrency)
+
+        if blocking:
+            threadpool = self.threadpool
+            if threadpool is None:
+                threadpool = self.reactor.getThreadPool()
+            queue = _BlockingPart(f, concurrency, threadpool,
+                                  self.reactor, self.metrics)
+            queue.profiler = self.profiler
+            self.queues[f] = queue
+            self._fs.append(queue)
+        else:
+            self._fs.append(f)
+
         return f
 
 
+    def _call(self, f, *a, **kw):
+        """
+        Calls a part, profiling it if it isn't profiled already.
+        """
+        if self.profiler is None or isinstance(f, _BlockingPart):
+            return defer.maybeDeferred(f, *a, **kw)
+        return self.profiler.call(f, *a, **kw)
+
+
     def __call__(self, *a, **kw):
-        ds = [defer.maybeDeferred(f, *a, **kw) for f in self._fs]
+        ds = [self._call(f, *a, **kw) for f in self._fs]
         return defer.DeferredList(ds)
 
 
 
 class OrderedCombined(Combined):
+    """
+    A function that calls all of its parts in order, waiting for each one
+    to finish before calling the next one.
+    """
     @defer.inlineCallbacks
     def __call__(self, *a, **kw):
         for f in self._fs:
-            yield defer.maybeDeferred(f, *a, **kw)
+            yield self._call(f, *a, **kw)
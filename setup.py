@@ -11,6 +11,10 @@ setup(name='minitrue',
       packages=find_packages(),
 
       install_requires=['twisted'],
+      extras_require={'intercept': ['pyOpenSSL']},
+      entry_points={
+          'console_scripts': ['minitrue = minitrue.serve:main'],
+      },
 
       license='ISC',
       classifiers=[